@@ -1,4 +1,5 @@
 -- schema.sql
+-- generated by www/schema.py from www/models.py, do not edit by hand.
 
 drop database if exists awesome;
 
@@ -8,11 +9,11 @@ use awesome;
 
 grant select, insert, update, delete on awesome.* to 'www-data'@'localhost' identified by 'www-data';
 
-create table users (
-    `id` varchar(50) not null,
+create table `users` (
+    `id` char(13) not null,
     `email` varchar(50) not null,
-    `passwd` varchar(50) not null,
-    `admin` bool not null,
+    `passwd` varchar(100) not null,
+    `admin` boolean not null,
     `name` varchar(50) not null,
     `image` varchar(500) not null,
     `created_at` real not null,
@@ -21,27 +22,67 @@ create table users (
     primary key (`id`)
 ) engine=innodb default charset=utf8;
 
-create table blogs (
-    `id` varchar(50) not null,
-    `user_id` varchar(50) not null,
+create table `blogs` (
+    `id` char(13) not null,
+    `user_id` char(13) not null,
     `user_name` varchar(50) not null,
     `user_image` varchar(500) not null,
     `name` varchar(50) not null,
     `summary` varchar(200) not null,
     `content` mediumtext not null,
     `created_at` real not null,
+    `comment_count` bigint not null,
+    `view_count` bigint not null,
+    key `idx_user_id` (`user_id`),
     key `idx_created_at` (`created_at`),
     primary key (`id`)
 ) engine=innodb default charset=utf8;
 
-create table comments (
-    `id` varchar(50) not null,
-    `blog_id` varchar(50) not null,
-    `user_id` varchar(50) not null,
+create table `comments` (
+    `id` char(13) not null,
+    `blog_id` char(13) not null,
+    `user_id` char(13) not null,
     `user_name` varchar(50) not null,
     `user_image` varchar(500) not null,
     `content` mediumtext not null,
     `created_at` real not null,
+    key `idx_blog_id` (`blog_id`),
     key `idx_created_at` (`created_at`),
     primary key (`id`)
-) engine=innodb default charset=utf8;
\ No newline at end of file
+) engine=innodb default charset=utf8;
+
+create table `materialized_views` (
+    `name` varchar(100) not null,
+    `value` mediumtext not null,
+    `updated_at` real not null,
+    primary key (`name`)
+) engine=innodb default charset=utf8;
+
+create table `blogs_archive` (
+    `id` char(13) not null,
+    `user_id` char(13) not null,
+    `user_name` varchar(50) not null,
+    `user_image` varchar(500) not null,
+    `name` varchar(50) not null,
+    `summary` varchar(200) not null,
+    `content` mediumtext not null,
+    `created_at` real not null,
+    `comment_count` bigint not null,
+    `view_count` bigint not null,
+    key `idx_user_id` (`user_id`),
+    key `idx_created_at` (`created_at`),
+    primary key (`id`)
+) engine=innodb default charset=utf8;
+
+create table `comments_archive` (
+    `id` char(13) not null,
+    `blog_id` char(13) not null,
+    `user_id` char(13) not null,
+    `user_name` varchar(50) not null,
+    `user_image` varchar(500) not null,
+    `content` mediumtext not null,
+    `created_at` real not null,
+    key `idx_blog_id` (`blog_id`),
+    key `idx_created_at` (`created_at`),
+    primary key (`id`)
+) engine=innodb default charset=utf8;
@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Admission control and load shedding.
+
+Every request passes a per-route limiter and then a global limiter. A limiter admits up to
+`limit` concurrent requests and queues at most `max_queue` more, ordered by priority class
+(/api/* and /manage/* before page loads). Queueing delay is watched CoDel-style: once the
+delay of dequeued requests stays above `target` for a whole `interval`, the limiter enters
+the dropping state and sheds low-priority requests with a fast 503 + Retry-After until the
+delay falls back below target.
+'''
+
+__author__ = 'Hongqing Wang'
+
+import asyncio, heapq, itertools, logging
+
+from aiohttp import web
+
+import metrics
+from config import configs
+
+HIGH, LOW = 0, 1
+
+shed_total = metrics.REGISTRY.counter('admission_shed_total', 'Requests rejected by admission control.', ('route', 'reason'))
+queue_depth = metrics.REGISTRY.gauge('admission_queue_depth', 'Requests waiting for admission.', ('limiter',))
+queue_delay = metrics.REGISTRY.histogram('admission_queue_delay_seconds', 'Time spent waiting for admission.', ('limiter',))
+
+class Shed(Exception):
+    def __init__(self, reason):
+        super(Shed, self).__init__(reason)
+        self.reason = reason
+
+class Limiter(object):
+    '''
+    Concurrency limit + bounded priority queue + CoDel-like dropping state.
+    '''
+
+    def __init__(self, name, limit, max_queue, target=0.05, interval=0.1):
+        self.name = name
+        self.limit = limit
+        self.max_queue = max_queue
+        self.target = target
+        self.interval = interval
+        self.active = 0
+        self.dropping = False
+        self._first_above = None
+        self._waiters = []
+        self._seq = itertools.count()
+
+    def _loop_time(self):
+        return asyncio.get_event_loop().time()
+
+    async def acquire(self, priority):
+        if self.active < self.limit and not self._waiters:
+            self.active += 1
+            return
+        if len(self._waiters) >= self.max_queue:
+            raise Shed('queue_full')
+        if self.dropping and priority != HIGH:
+            raise Shed('queue_delay')
+        fut = asyncio.get_event_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._seq), self._loop_time(), fut))
+        queue_depth.set(self.name, value=len(self._waiters))
+        try:
+            await fut
+        except asyncio.CancelledError:
+            # 客户端断开：如果名额已经分给了这个请求就还回去
+            if fut.done() and not fut.cancelled() and fut.exception() is None:
+                self.release()
+            raise
+
+    def release(self):
+        self.active -= 1
+        while self._waiters and self.active < self.limit:
+            priority, seq, enqueued, fut = heapq.heappop(self._waiters)
+            queue_depth.set(self.name, value=len(self._waiters))
+            if fut.done():
+                continue
+            now = self._loop_time()
+            sojourn = now - enqueued
+            queue_delay.observe(self.name, value=sojourn)
+            self._update_state(now, sojourn)
+            if self.dropping and priority != HIGH:
+                fut.set_exception(Shed('queue_delay'))
+                continue
+            self.active += 1
+            fut.set_result(None)
+        if not self._waiters:
+            # 和CoDel一样，队列排空后退出dropping状态
+            self._first_above = None
+            self.dropping = False
+
+    # CoDel：排队延迟持续interval都高于target时进入dropping状态，延迟一旦低于target立即退出
+    def _update_state(self, now, sojourn):
+        if sojourn < self.target:
+            self._first_above = None
+            if self.dropping:
+                logging.info('admission %s: queue delay back to normal' % self.name)
+            self.dropping = False
+        elif self._first_above is None:
+            self._first_above = now + self.interval
+        elif now >= self._first_above and not self.dropping:
+            self.dropping = True
+            logging.warning('admission %s: queue delay %.3fs above target, shedding low priority requests' % (self.name, sojourn))
+
+class AdmissionController(object):
+
+    def __init__(self, options):
+        self.options = options
+        self.global_limiter = Limiter('*', options.global_limit, options.max_queue, options.target, options.interval)
+        self.route_limiters = dict()
+
+    def priority(self, path):
+        for prefix in self.options.high_priority:
+            if path.startswith(prefix):
+                return HIGH
+        return LOW
+
+    def exempt(self, path):
+        for prefix in self.options.exempt:
+            if path.startswith(prefix):
+                return True
+        return False
+
+    def limiter(self, route):
+        l = self.route_limiters.get(route)
+        if l is None:
+            o = self.options
+            l = self.route_limiters[route] = Limiter(route, o.route_limit, o.max_queue, o.target, o.interval)
+        return l
+
+    # 依次获取路由和全局的名额，返回已获取的limiter，用完后交给release()；被拒绝时计数并抛出Shed
+    async def acquire(self, route, priority):
+        acquired = []
+        try:
+            for l in (self.limiter(route), self.global_limiter):
+                await l.acquire(priority)
+                acquired.append(l)
+        except Shed as e:
+            self.release(acquired)
+            shed_total.inc(route, e.reason)
+            raise
+        except BaseException:
+            self.release(acquired)
+            raise
+        return acquired
+
+    def release(self, acquired):
+        for l in acquired:
+            l.release()
+
+def init_admission(app, options=None):
+    app['__admission__'] = AdmissionController(options or configs.admission)
+
+def shed_response(options):
+    return web.HTTPServiceUnavailable(headers={'Retry-After': str(options.retry_after)})
+
+async def admission_factory(app, handler):
+    # 老式的middleware factory每个请求都会被调用一次，限流状态在init_admission()中挂到app上共享
+    controller = app['__admission__']
+    async def admission(request):
+        if controller.exempt(request.path):
+            return (await handler(request))
+        route = metrics.route_template(request)
+        try:
+            acquired = await controller.acquire(route, controller.priority(request.path))
+        except Shed:
+            return shed_response(controller.options)
+        try:
+            return (await handler(request))
+        finally:
+            controller.release(acquired)
+    return admission
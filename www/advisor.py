@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Index advisor: explain the query shapes recorded by orm and suggest missing indexes.
+
+The shapes are recorded in memory by each worker, so the report served by /manage/advisor
+covers the queries that worker has run since it started.
+'''
+
+__author__ = 'Hongqing Wang'
+
+import re, logging
+
+import orm
+from orm import Model
+
+# 从where/order by形状中提取列名，如"`blog_id`=? and created_at>?"提取出blog_id(等值)和created_at(范围)
+_RE_CONDITION = re.compile(r'`?(\w+)`?\s*(=|<=>|<>|!=|>=|<=|>|<|\blike\b|\bin\b|\bbetween\b|\bis\b)', re.IGNORECASE)
+
+# 找到表名对应的Model子类
+def find_model(table):
+    for cls in Model.__subclasses__():
+        if cls.__table__ == table:
+            return cls
+    return None
+
+# 由where和order by推导出一个组合索引的列顺序：等值条件在前，范围条件其次，排序列最后
+def index_columns(model, where, orderBy):
+    known = set(model.__mappings__.keys()) if model else None
+    eq, rng = [], []
+    for column, op in _RE_CONDITION.findall(where or ''):
+        if known is not None and column not in known:
+            continue
+        target = eq if op.lower() in ('=', '<=>', 'is', 'in') else rng
+        if column not in eq and column not in rng:
+            target.append(column)
+    columns = eq + rng[:1]
+    # 范围条件之后的排序列无法使用索引排序，只有在没有范围条件时才把order by的列加进来
+    if not rng:
+        for part in (orderBy or '').split(','):
+            if not part.strip():
+                continue
+            column = part.split()[0].strip('`')
+            if known is not None and column not in known:
+                continue
+            if column not in columns:
+                columns.append(column)
+    return columns
+
+# 表上已有的索引（含主键），每个索引是一个列名的tuple
+def existing_indexes(model):
+    return [(model.__primary_key__,)] + [(k,) for k in model.__indexes__]
+
+# 判断某个列组合是否已被声明的索引（或主键）覆盖：要求这些列是某个索引的最左前缀，
+# 只有第一列相同是不够的，如(blog_id)不能为where blog_id=? order by created_at省掉filesort
+def is_covered(model, columns):
+    if model is None or not columns:
+        return False
+    columns = tuple(columns)
+    return any(index[:len(columns)] == columns for index in existing_indexes(model))
+
+def suggest_ddl(table, columns):
+    return 'create index `idx_%s` on `%s` (%s);' % ('_'.join(columns), table, ', '.join(map(lambda c: '`%s`' % c, columns)))
+
+# 在表所在的每个分片上执行EXPLAIN，没有分片的表只在默认的pool上执行
+async def explain(model, sql, args):
+    pools = (model._pools() if model is not None else None) or [None]
+    rs = []
+    for pool in pools:
+        rs.extend(await orm.select('explain %s' % sql, args, pool=pool))
+    return rs
+
+# 对每个记录下来的查询形状执行EXPLAIN，报告全表扫描和filesort，并给出建议的CREATE INDEX语句
+async def analyze(shapes=None):
+    if shapes is None:
+        shapes = orm.get_query_shapes()
+    report = []
+    for shape in shapes:
+        model = find_model(shape['table'])
+        try:
+            rs = await explain(model, shape['sql'], shape['args'])
+        except Exception as e:
+            logging.warning('failed to explain %s: %s' % (shape['sql'], e))
+            continue
+        full_scan = any(r.get('type') == 'ALL' for r in rs)
+        filesort = any('filesort' in (r.get('Extra') or '') for r in rs)
+        if not full_scan and not filesort:
+            continue
+        columns = index_columns(model, shape['where'], shape['orderBy'])
+        item = dict(table=shape['table'], where=shape['where'], orderBy=shape['orderBy'], count=shape['count'],
+                    full_scan=full_scan, filesort=filesort, explain=rs, suggestion=None)
+        if columns and not is_covered(model, columns):
+            item['suggestion'] = suggest_ddl(shape['table'], columns)
+        report.append(item)
+    # 出现次数越多的查询越值得优先处理
+    report.sort(key=lambda item: item['count'], reverse=True)
+    return report
+
+def format_report(report):
+    L = []
+    for item in report:
+        problems = []
+        if item['full_scan']:
+            problems.append('full scan')
+        if item['filesort']:
+            problems.append('filesort')
+        L.append('%s x%s where [%s] order by [%s]: %s' % (item['table'], item['count'], item['where'], item['orderBy'], ', '.join(problems)))
+        if item['suggestion']:
+            L.append('    %s' % item['suggestion'])
+    return '\n'.join(L)
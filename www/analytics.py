@@ -0,0 +1,243 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Activity histograms over created_at for the admin dashboard (/manage/analytics).
+
+Only (created_at, id) is read, in chunks of plain selects ordered by (created_at, id), into NumPy
+arrays bucketed with bincount; rolling windows and percentiles are computed on the bucket counts.
+Each table keeps its counts in memory together with a (created_at, id) cursor per source, so a
+refresh only scans rows after the cursor, including later rows with the same created_at. Every
+chunk is applied before the next one is read, so a scan cut short by the request deadline keeps
+its progress. Scheduler jobs keep the series fresh in the background; rows deleted or inserted
+with an older created_at are picked up by the periodic full rebuild. Without NumPy the same
+numbers are computed in plain Python, just slower.
+'''
+
+__author__ = 'Hongqing Wang'
+
+import math, time, asyncio, logging
+
+import orm
+from config import configs
+from models import User, Blog, Comment
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+    logging.warning('numpy not installed, analytics will be computed in pure python.')
+
+MODELS = dict((m.__table__, m) for m in (User, Blog, Comment))
+
+DAY = 86400
+
+class Series(object):
+    '''
+    Per-bucket row counts of one table, extended incrementally from the watermark.
+    '''
+
+    def __init__(self, model, bucket=DAY, offset=0, chunk=10000):
+        self.model = model
+        self.bucket = bucket
+        # 时区偏移（秒），按当地时间的0点分桶
+        self.offset = offset
+        self.chunk = chunk
+        self.origin = None
+        self.counts = self._empty()
+        # 每个(表, 分片)读到的最后一行的(created_at, id)
+        self.cursors = dict()
+        self.watermark = None
+        self.refreshed_at = None
+        self._pending = None
+
+    def _empty(self):
+        return np.zeros(0, dtype=np.int64) if np is not None else []
+
+    # 时间戳 => 桶序号，第0个桶是最早一行所在的那一天
+    def _index(self, t):
+        return int(math.floor((t + self.offset) / self.bucket))
+
+    def _add(self, values):
+        if np is not None:
+            idx = np.floor((values + self.offset) / self.bucket).astype(np.int64)
+            if self.origin is None:
+                self.origin = int(idx.min())
+            idx -= self.origin
+            if idx.min() < 0:
+                # 比最早的桶还早（全量重建之前不会出现），前面补0
+                self.counts = np.concatenate([np.zeros(-idx.min(), dtype=np.int64), self.counts])
+                self.origin += int(idx.min())
+                idx -= idx.min()
+            add = np.bincount(idx)
+            if len(add) > len(self.counts):
+                self.counts = np.concatenate([self.counts, np.zeros(len(add) - len(self.counts), dtype=np.int64)])
+            self.counts[:len(add)] += add
+            return
+        for t in values:
+            i = self._index(t)
+            if self.origin is None:
+                self.origin = i
+            if i < self.origin:
+                self.counts[0:0] = [0] * (self.origin - i)
+                self.origin = i
+            i -= self.origin
+            if i >= len(self.counts):
+                self.counts.extend([0] * (i + 1 - len(self.counts)))
+            self.counts[i] += 1
+
+    # 分片的表要查每个分片，按表归档时还要查归档表；返回((表, 分片序号), pool)
+    def _sources(self):
+        tables = [self.model.__table__]
+        archived = orm.archive_table(self.model)
+        if archived is not None:
+            tables.append(archived)
+        pools = self.model._pools() or [None]
+        return [((t, i), p) for t in tables for i, p in enumerate(pools)]
+
+    # 从cursor之后按(created_at, id)读一块；created_at上的二级索引里带着主键，顺序读就是索引顺序
+    async def _chunk(self, table, pool, cursor):
+        pk = self.model.__primary_key__
+        if cursor is None:
+            sql, args = 'select `%s`, `created_at` from `%s` order by `created_at`, `%s` limit ?' % (pk, table, pk), [self.chunk]
+        else:
+            # 只用created_at>?会漏掉和水位线同一时刻、还没有读到的行
+            sql = 'select `%s`, `created_at` from `%s` where `created_at`>? or (`created_at`=? and `%s`>?) order by `created_at`, `%s` limit ?' % (pk, table, pk, pk)
+            args = [cursor[0], cursor[0], cursor[1], self.chunk]
+        return (await orm.select(sql, args, pool=pool))
+
+    async def _scan(self, full):
+        if full:
+            # 在新的对象里重建完再替换，重建期间的查询仍然用旧的计数
+            fresh = Series(self.model, self.bucket, self.offset, self.chunk)
+            rows = await fresh._scan(False)
+            self.origin, self.counts, self.cursors, self.watermark, self.refreshed_at = fresh.origin, fresh.counts, fresh.cursors, fresh.watermark, fresh.refreshed_at
+            return rows
+        pk = self.model.__primary_key__
+        rows = 0
+        # 每次一块的普通select，不长时间占用连接；请求里的扫描受截止时间限制，每块读完就记下进度，超时后下次接着读
+        for key, pool in self._sources():
+            while True:
+                rs = await self._chunk(key[0], pool, self.cursors.get(key))
+                if not rs:
+                    break
+                if np is not None:
+                    values = np.fromiter((r['created_at'] for r in rs), dtype=np.float64, count=len(rs))
+                else:
+                    values = [r['created_at'] for r in rs]
+                self._add(values)
+                last = rs[-1]
+                self.cursors[key] = (last['created_at'], last[pk])
+                self.watermark = last['created_at'] if self.watermark is None else max(self.watermark, last['created_at'])
+                rows += len(rs)
+                if len(rs) < self.chunk:
+                    break
+        self.refreshed_at = time.time()
+        return rows
+
+    # 同一时间只有一次扫描，并发的请求等待同一次的结果
+    async def refresh(self, full=False):
+        if self._pending is None:
+            self._pending = asyncio.ensure_future(self._scan(full))
+            self._pending.add_done_callback(lambda f: setattr(self, '_pending', None))
+        return (await asyncio.shield(self._pending))
+
+    # 最近days个桶（含今天）的计数，没有数据的桶为0
+    def window(self, days, now=None):
+        end = self._index(time.time() if now is None else now) + 1
+        start = end - days
+        if np is not None:
+            out = np.zeros(days, dtype=np.int64)
+            if self.origin is not None:
+                lo, hi = max(start, self.origin), min(end, self.origin + len(self.counts))
+                if lo < hi:
+                    out[lo - start:hi - start] = self.counts[lo - self.origin:hi - self.origin]
+            return start, out
+        out = [0] * days
+        if self.origin is not None:
+            for i in range(max(start, self.origin), min(end, self.origin + len(self.counts))):
+                out[i - start] = self.counts[i - self.origin]
+        return start, out
+
+    def total(self):
+        return int(self.counts.sum()) if np is not None else sum(self.counts)
+
+# 滑动窗口的和，结果的第i个值是counts[i-window+1..i]之和，开头不足window个桶的部分按已有的桶计算
+def rolling_sum(counts, window):
+    if np is not None:
+        c = np.cumsum(np.concatenate([np.zeros(1, dtype=np.int64), np.asarray(counts, dtype=np.int64)]))
+        lo = np.maximum(np.arange(1, len(counts) + 1) - window, 0)
+        return c[1:] - c[lo]
+    out, s = [], 0
+    for i, n in enumerate(counts):
+        s += n
+        if i >= window:
+            s -= counts[i - window]
+        out.append(s)
+    return out
+
+# 线性插值的百分位数，和numpy.percentile的默认方法一致
+def percentiles(counts, qs):
+    if len(counts) == 0:
+        return [0 for q in qs]
+    if np is not None:
+        return [float(v) for v in np.percentile(np.asarray(counts, dtype=np.float64), qs)]
+    values = sorted(counts)
+    out = []
+    for q in qs:
+        pos = (len(values) - 1) * q / 100.0
+        lo = int(math.floor(pos))
+        hi = min(lo + 1, len(values) - 1)
+        out.append(values[lo] + (values[hi] - values[lo]) * (pos - lo))
+    return out
+
+series = dict()
+
+def get_series(table):
+    s = series.get(table)
+    if s is None:
+        o = configs.analytics
+        s = series[table] = Series(MODELS[table], DAY, o.tz_offset, o.chunk)
+    return s
+
+async def histogram(table, days=30, window=7, qs=(50, 90, 99)):
+    s = get_series(table)
+    complete = True
+    # 数据不超过interval秒就直接用，否则先增量扫描；超过请求的截止时间就返回已经读到的部分，后台任务会继续
+    if s.refreshed_at is None or time.time() - s.refreshed_at > configs.analytics.interval:
+        try:
+            await s.refresh()
+        except orm.DeadlineExceeded as e:
+            logging.warning('analytics scan of %s not finished: %s' % (table, e))
+            complete = False
+    start, counts = s.window(days)
+    rolling = rolling_sum(counts, window)
+    return dict(
+        table=table,
+        bucket=s.bucket,
+        # 第一个桶开始的时间戳
+        start=start * s.bucket - s.offset,
+        counts=[int(n) for n in counts],
+        rolling=[int(n) for n in rolling],
+        window=window,
+        percentiles=dict(zip([str(q) for q in qs], percentiles(counts, qs))),
+        total=s.total(),
+        watermark=s.watermark,
+        complete=complete,
+        vectorized=np is not None
+    )
+
+# 在后台增量扫描看过的表，/manage/analytics通常直接用内存里的计数
+async def refresh():
+    for table in list(series):
+        await series[table].refresh()
+
+# 定时全量重建，纠正删除和时间早于水位线的插入造成的偏差
+async def rebuild():
+    for table in list(series):
+        await series[table].refresh(full=True)
+
+def register(scheduler):
+    scheduler.add('analytics:refresh', refresh, interval=configs.analytics.interval, lock=False)
+    if configs.analytics.rebuild_interval:
+        scheduler.add('analytics:rebuild', rebuild, interval=configs.analytics.rebuild_interval, lock=False)
@@ -58,6 +58,31 @@ class Page(object):
 
     __repr__ = __str__
 
+# JavaScript的Number只能精确表示2^53以内的整数，更大的整数（如以bigint存储的snowflake id）输出为字符串
+MAX_SAFE_INTEGER = 2 ** 53 - 1
+
+def _js_safe(obj):
+    if obj is None or isinstance(obj, (bool, str, float)):
+        return obj
+    if isinstance(obj, int):
+        return str(obj) if abs(obj) > MAX_SAFE_INTEGER else obj
+    if isinstance(obj, dict):
+        return dict((k, _js_safe(v)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return [_js_safe(v) for v in obj]
+    if hasattr(obj, '__dict__'):
+        # Page之类的对象按__dict__输出
+        return _js_safe(obj.__dict__)
+    return obj
+
+def json_dumps(obj):
+    '''
+    Serialize API results to JSON; integers beyond 2^53 become strings.
+    >>> json_dumps(dict(id=2 ** 60, n=1, ids=[2 ** 53]))
+    '{"id": "1152921504606846976", "n": 1, "ids": ["9007199254740992"]}'
+    '''
+    return json.dumps(_js_safe(obj), ensure_ascii=False)
+
 class APIError(Exception):
     '''
     the base APIError which contains error(required), data(optional) and message(optional).
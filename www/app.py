@@ -9,14 +9,23 @@ async web application.
 
 import logging; logging.basicConfig(level=logging.INFO)
 
-import asyncio, os, json, time
+import asyncio, os, json, time, signal
 from datetime import datetime
 
 from aiohttp import web
 from jinja2 import Environment, FileSystemLoader
 
-import orm
-from coroweb import add_routes, add_static
+import orm, idgen
+from config import configs
+from apis import json_dumps
+from coroweb import add_routes, add_static, init_cpu_pool
+from metrics import metrics_factory, monitor_loop
+from admission import admission_factory, init_admission
+from profiler import BlockingWatchdog
+from auth import auth_factory
+from fragcache import FragmentCacheExtension
+import content, counters, archive, analytics, search, hub
+from scheduler import scheduler, init_scheduler
 
 # 初始化jinja2的目的是给app添加一个'__templating__'属性，这个属性是一个Environment实例
 # 这个实例包含了对html模板路径、内容的设置，另外还添加了filters
@@ -29,7 +38,9 @@ def init_jinja2(app, **kw):
         block_end_string = kw.get('block_end_string', '%}'),
         variable_start_string = kw.get('variable_start_string', '{{'),
         variable_end_string = kw.get('variable_end_string', '}}'),
-        auto_reload = kw.get('auto_reload', True)
+        auto_reload = kw.get('auto_reload', True),
+        # {% cache key, ttl, tags... %}片段缓存，见fragcache.py
+        extensions = kw.get('extensions', [FragmentCacheExtension])
     )
     path = kw.get('path', None)
     if path is None:
@@ -80,10 +91,11 @@ async def response_factory(app, handler):
         if isinstance(r, dict):
             template = r.get('__template__')
             if template is None:
-                resp = web.Response(body=json.dumps(r, ensure_ascii=False, default=lambda o: o.__dict__).encode('utf-8'))
+                resp = web.Response(body=json_dumps(r).encode('utf-8'))
                 resp.content_type = 'application/json;charset=utf-8'
                 return resp
             else:
+                r['__user__'] = getattr(request, '__user__', None)
                 resp = web.Response(body=app['__templating__'].get_template(template).render(**r).encode('utf-8'))
                 resp.content_type = 'text/html;charset=utf-8'
                 return resp
@@ -112,21 +124,78 @@ def datetime_filter(t):
     dt = datetime.fromtimestamp(t)
     return u'%s年%s月%s日' % (dt.year, dt.month, dt.day)
 
-async def init(loop):
-    await orm.create_pool(loop=loop, host='localhost', port=3306, user='www-data', password='www-data', db='awesome')
+# search_options替换configs.search，bench.py用它让索引只放在内存里
+async def create_app(loop, search_options=None):
+    # 如果已经通过orm.set_pool()指定了数据库（如bench.py用的sqlite替身），就不再连接MySQL
+    if orm.get_pool() is None:
+        await orm.create_pool(loop=loop, **configs.db)
+        await orm.create_shard_pools(loop, configs.shards, configs.db)
+    # 每个进程领取不同的worker id，多个worker同一毫秒生成的id也不会重复
+    await idgen.claim_worker_id()
     # 这里middlewares就是一个大型装饰器
     # for factory in reversed(self._middlewares):
     #   handler = yield from factory(app, handler)
     # resp = yield from handler(request)
     # 这里相当于反复对handler进行装饰，reversed(self._middlewares)表示装饰时是倒序包装的，这样执行时就是按照顺序执行
-    app = web.Application(loop=loop, middlewares=[logger_factory, response_factory])
+    # metrics_factory放在最外层，这样统计到的状态码是response_factory最终转换出来的
+    # admission_factory紧随其后，被拒绝的请求不会再去查数据库
+    app = web.Application(loop=loop, middlewares=[metrics_factory, admission_factory, logger_factory, auth_factory, response_factory])
     init_jinja2(app, filters=dict(datetime=datetime_filter))
+    init_admission(app)
+    # 路由没有单独指定timeout时使用的默认截止时间
+    app['__request_timeout__'] = configs.request_timeout
+    init_cpu_pool(**configs.cpu_pool)
+    content.check_renderer()
     add_routes(app, 'handlers')
     add_static(app)
-    srv = await loop.create_server(app.make_handler(), '127.0.0.1', 9000)
-    logging.info('server started at http://127.0.0.1:9000...')
+    # 后台定时检测事件循环的延迟，结果在/metrics中的event_loop_lag_seconds
+    loop.create_task(monitor_loop(loop))
+    # 评论数、阅读数的定时写回和核对
+    counters.register(scheduler)
+    # 超过保留时间的评论和博客定时归档，findAll默认只查热数据
+    archive.configure()
+    archive.register(scheduler)
+    # /manage/analytics的计数定时全量重建
+    analytics.register(scheduler)
+    # 全文搜索索引：打开索引目录，启动时加载或重建，之后定期同步
+    search.init_search(search_options)
+    search.register(scheduler)
+    # 多个worker时轮询其他worker新建的评论和博客，推送给本worker的/stream/订阅者
+    hub.register(scheduler)
+    # 回调阻塞事件循环超过阈值时打印出事件循环线程的调用栈
+    BlockingWatchdog(loop, configs.profiler.block_threshold).start()
+    # 开始监听之前先把物化视图等预热好，冷启动的worker不会一起去查MySQL
+    await init_scheduler(app, loop)
+    # on_shutdown按加入的顺序执行，计数的写回在scheduler.stop()之后，不会和定时写回同时进行
+    app.on_shutdown.append(counters.on_shutdown)
+    return app
+
+async def init(loop, host='127.0.0.1', port=9000, search_options=None):
+    app = await create_app(loop, search_options)
+    srv = await loop.create_server(app.make_handler(), host, port)
+    logging.info('server started at http://%s:%s...' % (host, port))
     return srv
 
-loop = asyncio.get_event_loop()
-loop.run_until_complete(init(loop))
-loop.run_forever()
\ No newline at end of file
+# 先停止接受新连接，再执行app的on_shutdown（停止scheduler、写回计数），等正在处理的请求结束后清理
+async def shutdown(app, srv, handler, timeout=10):
+    srv.close()
+    await srv.wait_closed()
+    await app.shutdown()
+    await handler.shutdown(timeout)
+    await app.cleanup()
+    logging.info('server stopped.')
+
+if __name__ == '__main__':
+    loop = asyncio.get_event_loop()
+    app = loop.run_until_complete(create_app(loop))
+    handler = app.make_handler()
+    srv = loop.run_until_complete(loop.create_server(handler, '127.0.0.1', 9000))
+    logging.info('server started at http://127.0.0.1:9000...')
+    # 重启、发布时收到SIGTERM，按顺序关闭而不是直接退出，内存里的计数增量才不会丢
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, loop.stop)
+    try:
+        loop.run_forever()
+    finally:
+        loop.run_until_complete(shutdown(app, srv, handler))
+        loop.close()
@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Time-based archival of comments and blogs, see configs.archive.
+
+mode 'table': a scheduler job moves rows older than max_age seconds to <table>_archive in small
+batches (lock, copy and delete one batch per transaction, with a pause in between so no lock is
+held for long).
+mode 'partition': rows stay in a table range-partitioned by month on an integer column generated
+from created_at (configs.archive.partition_column). The web app's account cannot alter tables, so
+partitions are created and extended offline by an administrator:
+
+    python3 archive.py partitions comments
+    python3 archive.py add-partitions comments --user root --password ...
+
+Either way Model.findAll only reads the hot rows unless it is called with includeArchived=True.
+'''
+
+__author__ = 'Hongqing Wang'
+
+import sys, time, asyncio, logging, argparse
+from datetime import datetime
+
+import orm, metrics
+from config import configs
+from models import Blog, Comment
+
+MODELS = dict((m.__table__, m) for m in (Blog, Comment))
+
+archived_rows = metrics.REGISTRY.counter('archived_rows_total', 'Rows moved to archive tables.', ('table',))
+
+# 归档表和原表结构相同
+def archive_ddl(model):
+    return orm.create_table_ddl('%s_archive' % model.__table__, model.__mappings__, model.__primary_key__)
+
+def configure(options=None):
+    options = options or configs.archive
+    orm.clear_archives()
+    if not options.enabled:
+        return
+    for table, max_age in options.tables.items():
+        orm.set_archive(table, options.column, max_age, options.mode, options.partition_column)
+        logging.info('archive %s: rows older than %ss (%s)' % (table, max_age, options.mode))
+
+async def archive_model(model, column, max_age, batch=500, pause=0.1):
+    table = '%s_archive' % model.__table__
+    pk = model.__primary_key__
+    cols = ', '.join('`%s`' % c for c in [pk] + model.__fields__)
+    cutoff = time.time() - max_age
+    moved = 0
+    for pool in (model._pools() or [None]):
+        while True:
+            # 一批行的复制和删除在同一个事务里：先用for update锁住这些行，复制之后、删除之前它们不会被修改，
+            # 失败时整批回滚，不会出现只复制了没删除的行
+            async with orm.transaction(pool) as tx:
+                rs = await tx.select('select `%s` from `%s` where `%s`<? order by `%s` limit ? for update' % (pk, model.__table__, column, column), [cutoff, batch])
+                if not rs:
+                    break
+                ids = [r[pk] for r in rs]
+                marks = orm.create_args_string(len(ids))
+                # 用replace复制，归档表里已经有同一主键的行（如从备份恢复过）时以原表为准
+                await tx.execute('replace into `%s` (%s) select %s from `%s` where `%s` in (%s)' % (table, cols, cols, model.__table__, pk, marks), ids)
+                await tx.execute('delete from `%s` where `%s` in (%s)' % (model.__table__, pk, marks), ids)
+            moved += len(ids)
+            archived_rows.inc(model.__table__, value=len(ids))
+            # 每批之间停一下，不长时间占用锁和IO，也给正常的请求让出连接
+            await asyncio.sleep(pause)
+    if moved:
+        logging.info('archived %s rows of %s' % (moved, model.__table__))
+    return moved
+
+# 每月一个分区，分区值为下个月1日0点的时间戳
+def month_start(year, month):
+    return int(datetime(year + (month - 1) // 12, (month - 1) % 12 + 1, 1).timestamp())
+
+def months(start, count):
+    year, month = start.year, start.month
+    for i in range(count):
+        m = month + i
+        yield (year + (m - 1) // 12, (m - 1) % 12 + 1)
+
+def partition_clause(year, month):
+    return 'partition p%04d%02d values less than (%s)' % (year, month, month_start(year, month + 1))
+
+# MySQL不能按DOUBLE列（也不能按floor(DOUBLE)）分区，先加一个由时间列生成的整数列，按它分区；
+# findAll加的条件也在这一列上，MySQL才能裁剪分区
+# MySQL要求分区列包含在每个唯一键里，所以主键要改成(主键, 分区列)；按主键查询仍然可以用这个索引
+def partition_ddl(model, column, partition_column, start, count):
+    parts = [partition_clause(y, m) for y, m in months(start, count)]
+    parts.append('partition pmax values less than maxvalue')
+    return ('alter table `%s` add column `%s` bigint as (floor(`%s`)) stored not null;\n' % (model.__table__, partition_column, column) +
+            'alter table `%s` drop primary key, add primary key (`%s`, `%s`)\n    partition by range (`%s`) (\n        %s\n    );' % (
+                model.__table__, model.__primary_key__, partition_column, partition_column, ',\n        '.join(parts)))
+
+# 把pmax拆开，补上从现在开始ahead个月里还没有的分区；需要alter权限，只在管理员运行的archive.py add-partitions中执行
+async def add_partitions(model, ahead=3, pool=None):
+    rs = await orm.select('select `partition_name` from information_schema.partitions where `table_schema`=database() and `table_name`=?', [model.__table__], pool=pool)
+    existing = set(r['partition_name'] for r in rs)
+    if 'pmax' not in existing:
+        logging.warning('%s is not partitioned, run: python3 archive.py partitions %s' % (model.__table__, model.__table__))
+        return 0
+    missing = [(y, m) for y, m in months(datetime.now(), ahead) if 'p%04d%02d' % (y, m) not in existing]
+    if missing:
+        parts = [partition_clause(y, m) for y, m in missing] + ['partition pmax values less than maxvalue']
+        await orm.execute('alter table `%s` reorganize partition pmax into (%s)' % (model.__table__, ', '.join(parts)), [], pool=pool)
+        logging.info('added %s partitions to %s' % (len(missing), model.__table__))
+    return len(missing)
+
+async def run(options=None):
+    options = options or configs.archive
+    for table, max_age in options.tables.items():
+        await archive_model(MODELS[table], options.column, max_age, options.batch, options.pause)
+
+# 只有table模式需要定时任务；partition模式下的数据不用移动，分区由管理员离线维护
+def register(scheduler):
+    if configs.archive.enabled and configs.archive.mode == 'table':
+        scheduler.add('archive', run, interval=configs.archive.interval)
+
+async def maintain(loop, options):
+    kw = dict(configs.db)
+    kw.update(user=options.user, password=options.password)
+    await orm.create_pool(loop=loop, **kw)
+    await orm.create_shard_pools(loop, configs.shards, kw)
+    added = 0
+    for table in options.tables:
+        for pool in (MODELS[table]._pools() or [None]):
+            added += await add_partitions(MODELS[table], options.ahead, pool)
+    return added
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Offline partition maintenance for configs.archive.mode = partition.')
+    commands = parser.add_subparsers(dest='command', required=True)
+    ddl = commands.add_parser('partitions', help='print the DDL that partitions a table')
+    ddl.add_argument('table', choices=sorted(MODELS))
+    add = commands.add_parser('add-partitions', help='add partitions for the coming months, needs ALTER privilege')
+    add.add_argument('tables', nargs='+', choices=sorted(MODELS))
+    add.add_argument('--ahead', type=int, default=3, help='months to cover from now')
+    add.add_argument('--user', required=True, help='MySQL account with ALTER privilege')
+    add.add_argument('--password', default='')
+    options = parser.parse_args(argv)
+    if options.command == 'partitions':
+        # 从当前月份往前覆盖max_age，往后留3个月
+        max_age = configs.archive.tables.get(options.table, 365 * 86400)
+        start = datetime.fromtimestamp(time.time() - max_age).replace(day=1)
+        print(partition_ddl(MODELS[options.table], configs.archive.column, configs.archive.partition_column, start, int(max_age // (30 * 86400)) + 5))
+        return
+    loop = asyncio.get_event_loop()
+    print('added %s partitions.' % loop.run_until_complete(maintain(loop, options)))
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
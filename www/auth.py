@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Stateless signed-cookie sessions.
+
+cookie: "<user id>-<expires>-<hmac-sha256(user id-expires, session secret)>"
+Verifying a cookie never touches the database; the User itself comes from a
+short-TTL in-process cache which is invalidated when the user row is written.
+'''
+
+__author__ = 'Hongqing Wang'
+
+import os, time, hmac, base64, hashlib, asyncio, logging
+from collections import OrderedDict
+
+import orm
+from config import configs
+from coroweb import cpu_bound
+from models import User
+
+COOKIE_NAME = 'awesession'
+
+_COOKIE_KEY = configs.session.secret.encode('utf-8')
+
+def _sign(payload):
+    return hmac.new(_COOKIE_KEY, payload.encode('utf-8'), hashlib.sha256).hexdigest()
+
+# 生成cookie字符串
+def user2cookie(user, max_age):
+    expires = int(time.time() + max_age)
+    payload = '%s-%s' % (user.id, expires)
+    return '%s-%s' % (payload, _sign(payload))
+
+# 校验cookie并返回其中的用户id，签名不对或已过期返回None
+def cookie2uid(cookie):
+    if not cookie:
+        return None
+    try:
+        payload, sig = cookie.rsplit('-', 1)
+        uid, expires = payload.rsplit('-', 1)
+        if int(expires) < time.time():
+            return None
+    except ValueError:
+        return None
+    # compare_digest是常数时间比较，避免通过响应时间逐字节猜出签名
+    if not hmac.compare_digest(sig, _sign(payload)):
+        logging.info('invalid cookie signature.')
+        return None
+    return uid
+
+# 口令哈希：pbkdf2_sha256$迭代次数$salt$hash，都是base64，长度在100以内
+# pbkdf2_hmac计算时会释放GIL，所以放到cpu pool的线程里就不会卡住事件循环
+@cpu_bound
+def hash_password(passwd, iterations=None):
+    if iterations is None:
+        iterations = configs.password.iterations
+    salt = os.urandom(16)
+    dk = hashlib.pbkdf2_hmac('sha256', passwd.encode('utf-8'), salt, iterations)
+    return 'pbkdf2_sha256$%s$%s$%s' % (iterations, base64.b64encode(salt).decode('ascii'), base64.b64encode(dk).decode('ascii'))
+
+@cpu_bound
+def check_password(passwd, hashed):
+    try:
+        algorithm, iterations, salt, expected = hashed.split('$')
+        iterations = int(iterations)
+    except (AttributeError, ValueError):
+        return False
+    if algorithm != 'pbkdf2_sha256':
+        return False
+    dk = hashlib.pbkdf2_hmac('sha256', passwd.encode('utf-8'), base64.b64decode(salt), iterations)
+    return hmac.compare_digest(base64.b64encode(dk).decode('ascii'), expected)
+
+def set_user_cookie(resp, user, max_age=None):
+    if max_age is None:
+        max_age = configs.session.max_age
+    resp.set_cookie(COOKIE_NAME, user2cookie(user, max_age), max_age=max_age, httponly=True)
+
+class UserCache(object):
+    '''
+    A small TTL + LRU cache of User rows keyed by id, passwd is masked.
+    '''
+
+    def __init__(self, ttl=30, maxsize=10000):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        # 同一个id同时未命中时只查一次数据库
+        self._pending = dict()
+
+    async def get(self, uid):
+        entry = self._data.get(uid)
+        if entry is not None:
+            user, expires = entry
+            if expires > time.time():
+                self._data.move_to_end(uid)
+                return user
+            del self._data[uid]
+        fut = self._pending.get(uid)
+        if fut is not None:
+            return await asyncio.shield(fut)
+        fut = asyncio.get_event_loop().create_future()
+        self._pending[uid] = fut
+        try:
+            user = await User.find(uid)
+            if user is not None:
+                user.passwd = '******'
+                self.put(uid, user)
+            fut.set_result(user)
+            return user
+        except BaseException as e:
+            fut.set_exception(e)
+            # 没有其他等待者时避免"exception was never retrieved"警告
+            fut.exception()
+            raise
+        finally:
+            self._pending.pop(uid, None)
+
+    def put(self, uid, user):
+        self._data[uid] = (user, time.time() + self.ttl)
+        self._data.move_to_end(uid)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def invalidate(self, uid):
+        self._data.pop(uid, None)
+
+    def clear(self):
+        self._data.clear()
+
+user_cache = UserCache(configs.session.user_cache_ttl, configs.session.user_cache_size)
+
+@orm.add_listener
+def _invalidate_user(event, model):
+    if isinstance(model, User) and event in ('update', 'remove'):
+        user_cache.invalidate(model.getValue('id'))
+
+async def auth_factory(app, handler):
+    async def auth(request):
+        request.__user__ = None
+        uid = cookie2uid(request.cookies.get(COOKIE_NAME))
+        if uid:
+            request.__user__ = await user_cache.get(uid)
+            if request.__user__ is not None:
+                logging.info('set current user: %s' % request.__user__.email)
+        return (await handler(request))
+    return auth
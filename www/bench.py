@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Load-testing harness: start app.init against a seeded SQLite stand-in and report latency as JSON.
+
+    python3 bench.py --users 1000 --blogs 2000 --comments 10000 --concurrency 50 --requests 2000
+'''
+
+__author__ = 'Hongqing Wang'
+
+import sys, time, json, random, asyncio, logging, argparse
+
+import aiohttp
+
+import orm, idgen, sqlitepool
+from config import configs, toDict
+from models import User, Blog, Comment, MaterializedView
+
+DEFAULT_PATHS = ('/', '/api/users', '/manage/users')
+
+def seed(pool, users, blogs, comments):
+    rnd = random.Random(42)
+    now = time.time()
+    us = []
+    for n in range(users):
+        us.append(User(name='user%s' % n, email='user%s@example.com' % n, passwd='x' * 40, image='about:blank',
+                       admin=(n == 0), created_at=now - rnd.random() * 86400 * 365))
+    pool.insert_many(User, us)
+    bs = []
+    for n in range(blogs):
+        u = rnd.choice(us)
+        bs.append(Blog(user_id=u.id, user_name=u.name, user_image=u.image, name='blog %s' % n, summary='summary %s' % n,
+                       content='# blog %s\n\n' % n + 'lorem ipsum ' * 200, created_at=now - rnd.random() * 86400 * 365))
+    pool.insert_many(Blog, bs)
+    cs = []
+    for n in range(comments):
+        u, b = rnd.choice(us), rnd.choice(bs)
+        cs.append(Comment(blog_id=b.id, user_id=u.id, user_name=u.name, user_image=u.image, content='comment %s' % n,
+                          created_at=b.created_at + rnd.random() * 86400))
+    pool.insert_many(Comment, cs)
+    logging.warning('seeded %s users, %s blogs, %s comments' % (users, blogs, comments))
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return None
+    k = max(int(round(p / 100.0 * len(sorted_values))) - 1, 0)
+    return sorted_values[min(k, len(sorted_values) - 1)]
+
+# 以concurrency个并发worker一共发出total个请求，返回该路径的统计结果
+async def drive(session, url, total, concurrency):
+    latencies = []
+    errors = 0
+    remaining = [total]
+
+    async def worker():
+        nonlocal errors
+        while remaining[0] > 0:
+            remaining[0] -= 1
+            start = time.perf_counter()
+            try:
+                async with session.get(url) as resp:
+                    await resp.read()
+                    if resp.status >= 400:
+                        errors += 1
+            except aiohttp.ClientError:
+                errors += 1
+                continue
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[worker() for i in range(concurrency)])
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    ms = lambda v: None if v is None else round(v * 1000, 3)
+    return dict(requests=total, errors=errors, seconds=round(elapsed, 3), rps=round(len(latencies) / elapsed, 1) if elapsed else None,
+                p50_ms=ms(percentile(latencies, 50)), p95_ms=ms(percentile(latencies, 95)), p99_ms=ms(percentile(latencies, 99)),
+                max_ms=ms(latencies[-1] if latencies else None))
+
+async def run(loop, options):
+    import app
+    pool = sqlitepool.create_pool(options.db)
+    pool.create_tables((User, Blog, Comment, MaterializedView))
+    orm.set_pool(pool)
+    await idgen.claim_worker_id()
+    seed(pool, options.users, options.blogs, options.comments)
+    # 假数据的索引只放在内存里，不能写进线上的索引目录
+    srv = await app.init(loop, options.host, options.port, search_options=toDict(dict(configs.search, index_dir=None)))
+    base = 'http://%s:%s' % (options.host, options.port)
+    report = dict(users=options.users, blogs=options.blogs, comments=options.comments, concurrency=options.concurrency, paths=dict())
+    try:
+        async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=options.concurrency)) as session:
+            for path in options.paths:
+                # 先预热，避免模板编译等一次性开销混进统计
+                await drive(session, base + path, min(options.concurrency, options.requests), options.concurrency)
+                report['paths'][path] = await drive(session, base + path, options.requests, options.concurrency)
+    finally:
+        srv.close()
+        await srv.wait_closed()
+        pool.close()
+    return report
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark awesome-python3-webapp against a local SQLite stand-in.')
+    parser.add_argument('--users', type=int, default=500)
+    parser.add_argument('--blogs', type=int, default=1000)
+    parser.add_argument('--comments', type=int, default=5000)
+    parser.add_argument('--requests', type=int, default=1000, help='requests per path')
+    parser.add_argument('--concurrency', type=int, default=20)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=9001)
+    parser.add_argument('--db', default=':memory:', help='SQLite database path')
+    parser.add_argument('--output', help='write the JSON report to this file instead of stdout')
+    parser.add_argument('paths', nargs='*', default=list(DEFAULT_PATHS))
+    options = parser.parse_args(argv)
+    # 每个请求都会打印多行INFO日志，压测时关掉，否则测的是日志输出速度
+    logging.disable(logging.INFO)
+    loop = asyncio.get_event_loop()
+    report = loop.run_until_complete(run(loop, options))
+    text = json.dumps(report, indent=2)
+    if options.output:
+        with open(options.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -16,7 +16,146 @@ configs = {
         'password': 'www-data',
         'db': 'awesome'
     },
+    # 水平分片：databases是各分片库的连接参数（没写的项取db里的），tables是表 => 分片名列表
+    # 表按模型的__shard_key__的crc32分布到列表中的分片上，列表的顺序确定后不能再改；没有列出的表都在db这一个库里，如
+    # 'databases': {'s0': {'host': '10.0.0.1'}, 's1': {'host': '10.0.0.2'}}, 'tables': {'comments': ['s0', 's1']}
+    'shards': {
+        'databases': {},
+        'tables': {}
+    },
+    # 请求默认的截止时间（秒），可以用@get(path, timeout=...)单独设置，0表示不限制
+    'request_timeout': 10,
     'session': {
-        'secret': 'Awesome'
+        'secret': 'Awesome',
+        # cookie有效期（秒）
+        'max_age': 86400,
+        # 进程内User缓存的过期时间（秒）和最大条数
+        'user_cache_ttl': 30,
+        'user_cache_size': 10000
+    },
+    # 主键生成器：snowflake（storage为base32或bigint）或legacy
+    # worker_id为None时每个进程启动时用MySQL命名锁领取一个空闲的（见idgen.claim_worker_id），也可以为每个进程单独配置
+    'id': {
+        'generator': 'snowflake',
+        'storage': 'base32',
+        'worker_id': None
+    },
+    # CPU密集型任务（如口令哈希）使用的执行器，kind为thread或process；排队满了返回503，Retry-After为retry_after秒
+    'cpu_pool': {
+        'kind': 'thread',
+        'workers': 4,
+        'max_queue': 64,
+        'retry_after': 1
+    },
+    'password': {
+        'iterations': 100000
+    },
+    # 博客正文markdown渲染缓存：内存LRU的总大小、可选的磁盘缓存目录、超过多少字符放到cpu pool里渲染
+    'content': {
+        'max_bytes': 32 * 1024 * 1024,
+        'cache_dir': None,
+        'offload_size': 20000
+    },
+    # 模板片段缓存最多保存的片段数
+    'fragment_cache': {
+        'maxsize': 1000
+    },
+    # 准入控制：每个路由和全局的并发上限、排队上限，排队延迟超过target持续interval秒后对低优先级请求返回503
+    # /api/batch本身不占名额，它的每个子请求按各自的路由分别计入，否则批量请求占着全局名额等子请求会互相卡死
+    'admission': {
+        'route_limit': 32,
+        'global_limit': 64,
+        'max_queue': 128,
+        'target': 0.05,
+        'interval': 0.1,
+        'retry_after': 1,
+        'high_priority': ['/api/', '/manage/'],
+        'exempt': ['/static/', '/metrics', '/stream/', '/api/batch']
+    },
+    # 实时推送：每个连接最多缓冲的消息数（满了就断开这个慢消费者），心跳间隔和客户端重连等待（秒）
+    # 多个worker时，每个worker每隔poll_interval秒查一次最近poll_lookback秒内新建的行，把其他worker保存的评论和博客
+    # 也推给自己的订阅者；只有一个worker时可以设为0关掉轮询
+    'hub': {
+        'buffer_size': 100,
+        'heartbeat': 15,
+        'retry': 3,
+        'poll_interval': 1,
+        'poll_lookback': 5,
+        'poll_limit': 500
+    },
+    # 计数列每隔interval秒批量写回一次，每条update最多max_batch行
+    # 每隔reconcile_interval秒（0表示不做）用count(*)核对最近reconcile_window秒内有新评论的博客，
+    # 最后一条评论不到reconcile_settle秒的博客其他worker可能还没写回，跳过；reconcile_settle要比interval大好几倍
+    'counters': {
+        'interval': 5,
+        'max_batch': 500,
+        'reconcile_interval': 3600,
+        'reconcile_window': 86400,
+        'reconcile_settle': 60
+    },
+    # 后台任务：周期执行时间的随机抖动比例，失败后从retry秒开始指数退避、最长max_backoff秒，启动预热最多等待warm_timeout秒
+    # 数据变化触发的执行遇到锁在其他worker手里时，最多等待lock_wait秒，拿不到锁就等那一次结束后再试
+    'scheduler': {
+        'jitter': 0.1,
+        'retry': 1,
+        'max_backoff': 300,
+        'warm_timeout': 10,
+        'lock_wait': 10
+    },
+    # 物化视图：每隔interval秒重新计算，各worker最多ttl秒从数据库重新读取一次
+    'views': {
+        'interval': 60,
+        'ttl': 5
+    },
+    # 按时间归档：tables为表名 => 热数据保留的秒数，超过的行在mode为table时被移到<表名>_archive，
+    # 为partition时留在按partition_column（由column生成的整数列）每月分区的原表里，
+    # 分区由管理员用archive.py partitions / add-partitions离线维护；findAll默认只查热数据
+    'archive': {
+        'enabled': False,
+        'mode': 'table',
+        'column': 'created_at',
+        'partition_column': 'created_ts',
+        'tables': {
+            'comments': 365 * 86400,
+            'blogs': 365 * 86400
+        },
+        # 每批移动的行数、两批之间暂停的秒数、多久执行一次
+        'batch': 500,
+        'pause': 0.1,
+        'interval': 3600
+    },
+    # /manage/analytics：按天统计created_at，tz_offset为分桶用的时区偏移（秒），每次读取chunk行；
+    # 后台每interval秒从(created_at, id)游标增量扫描，请求看到超过interval秒的结果时也会在截止时间内补扫；
+    # 每隔rebuild_interval秒全量重建一次
+    'analytics': {
+        'chunk': 10000,
+        'tz_offset': 8 * 3600,
+        'interval': 300,
+        'rebuild_interval': 86400,
+        'max_days': 366
+    },
+    # 全文搜索：段文件放在index_dir（None时只在内存里；放在源码目录之外，相对路径按www目录解析），
+    # 每sync_interval秒读取别的worker写出的段，delta满flush_docs个文档或超过flush_interval秒写成新的段，
+    # 每rebuild_interval秒全量重建一次
+    'search': {
+        'index_dir': '/var/lib/awesome/search_index',
+        'title_boost': 3,
+        'page_size': 10,
+        'max_query_length': 100,
+        'chunk': 1000,
+        'sync_interval': 10,
+        'flush_docs': 1000,
+        'flush_interval': 60,
+        'rebuild_interval': 86400
+    },
+    # /api/batch一次最多包含的子请求数
+    'batch': {
+        'max_requests': 20
+    },
+    'profiler': {
+        # 单个回调阻塞事件循环超过这么多秒就打印调用栈
+        'block_threshold': 0.2,
+        # /manage/profile允许的最长采样时间
+        'max_seconds': 60
     }
 }
\ No newline at end of file
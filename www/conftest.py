@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+pytest fixtures. Tests run against the SQLite stand-in (sqlitepool.py), no MySQL server is needed:
+
+    cd www && python3 -m pytest -q
+'''
+
+__author__ = 'Hongqing Wang'
+
+import asyncio
+
+import pytest
+
+import orm, idgen, sqlitepool
+from models import User, Blog, Comment, MaterializedView
+
+# 早期的手工测试脚本，导入时就会连接MySQL或启动服务器，不作为测试收集
+collect_ignore = ['test.py', 'app_test.py', 'x.py']
+
+@pytest.fixture
+def loop():
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    yield loop
+    # 取消测试里留下的后台任务（如心跳、定时任务），避免关闭时报"Task was destroyed but it is pending"
+    pending = asyncio.all_tasks(loop)
+    for t in pending:
+        t.cancel()
+    loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
+    loop.close()
+    asyncio.set_event_loop(None)
+
+# 建好所有表的内存SQLite库，作为orm的默认pool；测试结束后恢复orm的全局状态
+@pytest.fixture
+def db(loop):
+    pool = sqlitepool.create_pool()
+    pool.create_tables((User, Blog, Comment, MaterializedView))
+    old = orm.get_pool()
+    orm.set_pool(pool)
+    loop.run_until_complete(idgen.claim_worker_id())
+    yield pool
+    orm.set_pool(old)
+    orm.set_shard_tables({})
+    orm.clear_archives()
+    orm.reset_query_shapes()
+    pool.close()
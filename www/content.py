@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Markdown -> sanitized HTML rendering with a content-hash keyed cache.
+
+A rendered body is looked up by sha1(content) in a bounded in-memory LRU, then in an
+optional on-disk cache; only on a miss is the markdown parsed, and documents larger
+than configs.content.offload_size are parsed in the cpu pool instead of on the event loop.
+'''
+
+__author__ = 'Hongqing Wang'
+
+import os, re, html, hashlib, asyncio, logging
+from collections import OrderedDict
+
+from config import configs
+from coroweb import cpu_bound
+import metrics
+
+# markdown2是必需的依赖（pip3 install markdown2）；没有安装时退回到转义后的纯文本，启动时由check_renderer()报警
+try:
+    import markdown2
+except ImportError:
+    markdown2 = None
+
+# 渲染逻辑变了就改这个版本号，旧的缓存自然失效
+RENDER_VERSION = '2'
+
+cache_hits = metrics.REGISTRY.counter('content_cache_hits_total', 'Rendered content cache hits by layer.', ('layer',))
+cache_misses = metrics.REGISTRY.counter('content_cache_misses_total', 'Rendered content cache misses.')
+
+_RE_TAG = re.compile(r'<[a-zA-Z][^<>]*>')
+_RE_EVENT_ATTR = re.compile(r'\s+on[a-z]+\s*=\s*("[^"]*"|\'[^\']*\'|[^\s>]+)', re.IGNORECASE)
+_RE_BAD_URL = re.compile(r'(href|src)\s*=\s*(["\']?)\s*(javascript|vbscript|data):', re.IGNORECASE)
+
+def _sanitize_tag(m):
+    tag = _RE_EVENT_ATTR.sub('', m.group(0))
+    return _RE_BAD_URL.sub(r'\1=\2#', tag)
+
+# 输入中的原始HTML已被转义，这里再去掉markdown链接可能带进来的事件属性和javascript:之类的URL
+# 只处理标签内部，正文里的"x onload=1"之类的文字原样保留
+def sanitize(text):
+    return _RE_TAG.sub(_sanitize_tag, text)
+
+def text2html(text):
+    lines = map(lambda s: '<p>%s</p>' % html.escape(s), filter(lambda s: s.strip() != '', text.split('\n')))
+    return ''.join(lines)
+
+def render_markdown(text):
+    if markdown2 is None:
+        return text2html(text)
+    return sanitize(markdown2.markdown(text, safe_mode='escape', extras=['fenced-code-blocks', 'tables']))
+
+@cpu_bound
+def render_markdown_offloaded(text):
+    return render_markdown(text)
+
+def renderer():
+    return 'text' if markdown2 is None else 'markdown2'
+
+# 在app.init中调用：退回到纯文本时每次启动都打出警告，不让渲染结果悄悄地变掉
+def check_renderer():
+    if markdown2 is None:
+        logging.warning('markdown2 is not installed: blog content is rendered as escaped plain text. Run: pip3 install markdown2')
+        return False
+    return True
+
+# 键里带上渲染方式，装上markdown2之后不会继续用磁盘上纯文本的结果
+def content_key(text):
+    return hashlib.sha1(('%s:%s:%s' % (RENDER_VERSION, renderer(), text)).encode('utf-8')).hexdigest()
+
+class ContentCache(object):
+    '''
+    LRU of rendered HTML bounded by total size, backed by an optional directory of <sha1>.html files.
+    '''
+
+    def __init__(self, max_bytes=32 * 1024 * 1024, cache_dir=None, offload_size=20000):
+        self.max_bytes = max_bytes
+        self.cache_dir = cache_dir
+        self.offload_size = offload_size
+        self.size = 0
+        self._data = OrderedDict()
+        self._pending = dict()
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def _put(self, key, value):
+        old = self._data.pop(key, None)
+        if old is not None:
+            self.size -= len(old)
+        self._data[key] = value
+        self.size += len(value)
+        while self.size > self.max_bytes and len(self._data) > 1:
+            k, v = self._data.popitem(last=False)
+            self.size -= len(v)
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + '.html')
+
+    def _read_disk(self, key):
+        try:
+            with open(self._path(key), 'r', encoding='utf-8') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def _write_disk(self, key, value):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = '%s.%s.tmp' % (path, os.getpid())
+        with open(tmp, 'w', encoding='utf-8') as f:
+            f.write(value)
+        # 先写临时文件再rename，多个worker同时写也不会读到半个文件
+        os.replace(tmp, path)
+
+    async def _render(self, key, text):
+        loop = asyncio.get_event_loop()
+        if self.cache_dir:
+            value = await loop.run_in_executor(None, self._read_disk, key)
+            if value is not None:
+                cache_hits.inc('disk')
+                return value
+        cache_misses.inc()
+        if len(text) > self.offload_size:
+            value = await render_markdown_offloaded(text)
+        else:
+            value = render_markdown(text)
+        if self.cache_dir:
+            try:
+                await loop.run_in_executor(None, self._write_disk, key, value)
+            except OSError as e:
+                logging.warning('failed to write content cache %s: %s' % (key, e))
+        return value
+
+    async def render(self, text):
+        if not text:
+            return ''
+        key = content_key(text)
+        value = self._data.get(key)
+        if value is not None:
+            self._data.move_to_end(key)
+            cache_hits.inc('memory')
+            return value
+        # 同一篇文章同时被多个请求访问时只渲染一次
+        fut = self._pending.get(key)
+        if fut is None:
+            fut = self._pending[key] = asyncio.ensure_future(self._render(key, text))
+            fut.add_done_callback(lambda f: self._pending.pop(key, None))
+        value = await asyncio.shield(fut)
+        self._put(key, value)
+        return value
+
+content_cache = ContentCache(configs.content.max_bytes, configs.content.cache_dir, configs.content.offload_size)
+
+async def markdown(text):
+    return await content_cache.render(text)
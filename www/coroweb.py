@@ -3,17 +3,21 @@
 
 __author__ = 'Michael Liao'
 
-import asyncio, os, inspect, logging, functools
+import asyncio, os, re, inspect, logging, functools, time, importlib
 
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from urllib import parse
 
 from aiohttp import web
 
 from apis import APIError
+import metrics, orm
 
-def get(path):
+def get(path, timeout=None, batch=None):
     '''
-    Define decorator @get('/path')
+    Define decorator @get('/path') or @get('/path', timeout=5)
+    timeout: request deadline in seconds, None uses the app default, 0 disables it.
+    batch: whether /api/batch may call this route, None means only /api/* routes.
     '''
     def decorator(func):
         @functools.wraps(func)
@@ -23,12 +27,14 @@ def get(path):
         # 添加两个属性__method__和__route__
         wrapper.__method__ = 'GET'
         wrapper.__route__ = path
+        wrapper.__timeout__ = timeout
+        wrapper.__batch__ = path.startswith('/api/') if batch is None else batch
         return wrapper
     return decorator
 
-def post(path):
+def post(path, timeout=None, batch=None):
     '''
-    Define decorator @post('/path')
+    Define decorator @post('/path') or @post('/path', timeout=5)
     '''
     def decorator(func):
         @functools.wraps(func)
@@ -36,9 +42,84 @@ def post(path):
             return func(*args, **kw)
         wrapper.__method__ = 'POST'
         wrapper.__route__ = path
+        wrapper.__timeout__ = timeout
+        wrapper.__batch__ = path.startswith('/api/') if batch is None else batch
         return wrapper
     return decorator
 
+cpu_queue_depth = metrics.REGISTRY.gauge('cpu_pool_queue_depth', 'CPU-bound tasks submitted and not yet finished.')
+cpu_task_latency = metrics.REGISTRY.histogram('cpu_task_duration_seconds', 'CPU-bound task latency including queueing, by function.', ('func',))
+cpu_rejected = metrics.REGISTRY.counter('cpu_tasks_rejected_total', 'CPU-bound tasks rejected because the queue was full.', ('func',))
+
+class CPUPool(object):
+    '''
+    A bounded executor for CPU-bound work, so it does not run on the event loop.
+    kind is 'thread' (for C code that releases the GIL, e.g. hashlib) or 'process'.
+    '''
+
+    def __init__(self, kind='thread', workers=4, max_queue=64, retry_after=1):
+        if kind == 'process':
+            self._executor = ProcessPoolExecutor(max_workers=workers)
+        else:
+            self._executor = ThreadPoolExecutor(max_workers=workers)
+        self.kind = kind
+        self.max_queue = max_queue
+        self.retry_after = retry_after
+        self.pending = 0
+
+    async def run(self, fn, *args, name=None):
+        name = name or getattr(fn, '__name__', str(fn))
+        # 队列满了直接拒绝，不让登录风暴之类的请求无限堆积；和准入控制一样返回503，负载均衡和客户端才能看出是过载
+        if self.pending >= self.max_queue:
+            cpu_rejected.inc(name)
+            raise web.HTTPServiceUnavailable(headers={'Retry-After': str(self.retry_after)})
+        self.pending += 1
+        cpu_queue_depth.set(value=self.pending)
+        start = time.time()
+        try:
+            return await asyncio.get_event_loop().run_in_executor(self._executor, functools.partial(fn, *args))
+        finally:
+            self.pending -= 1
+            cpu_queue_depth.set(value=self.pending)
+            cpu_task_latency.observe(name, value=time.time() - start)
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
+
+_cpu_pool = None
+
+# 在app.init中按配置创建，没有调用时使用默认参数的线程池
+def init_cpu_pool(kind='thread', workers=4, max_queue=64, retry_after=1):
+    global _cpu_pool
+    if _cpu_pool is not None:
+        _cpu_pool.shutdown(wait=False)
+    _cpu_pool = CPUPool(kind, workers, max_queue, retry_after)
+    logging.info('init cpu pool: %s x %s, max queue %s' % (kind, workers, max_queue))
+    return _cpu_pool
+
+def get_cpu_pool():
+    if _cpu_pool is None:
+        init_cpu_pool()
+    return _cpu_pool
+
+# 子进程里按模块名和函数名找到被@cpu_bound修饰的函数，再调用原函数
+# 被修饰后模块里的名字指向的是wrapper，原函数本身无法被pickle，只能这样间接调用
+def _invoke_wrapped(module, name, args):
+    return getattr(importlib.import_module(module), name).__wrapped__(*args)
+
+def cpu_bound(func):
+    '''
+    Define decorator @cpu_bound: calling the function returns a coroutine which runs it in the cpu pool.
+    For a process pool the function must be defined at module level.
+    '''
+    @functools.wraps(func)
+    async def wrapper(*args):
+        pool = get_cpu_pool()
+        if pool.kind == 'process':
+            return await pool.run(_invoke_wrapped, func.__module__, func.__qualname__, args, name=func.__name__)
+        return await pool.run(func, *args)
+    return wrapper
+
 # 获得命名关键字参数的key名称，注意这里获得的key是没有指定默认值的
 def get_required_kw_args(fn):
     args = []
@@ -106,6 +187,10 @@ class RequestHandler(object):
         self._has_named_kw_args = has_named_kw_args(fn)
         self._named_kw_args = get_named_kw_args(fn)
         self._required_kw_args = get_required_kw_args(fn)
+        self._timeout = getattr(fn, '__timeout__', None)
+        # 页面路由、设置cookie的路由等不能在/api/batch中调用，在执行之前就拒绝
+        self.route = getattr(fn, '__route__', None)
+        self.batch = getattr(fn, '__batch__', False)
 
     # __call__()方法，可以将实例当作函数来调用，如rh = RequestHandler(app,fn); rh(request);
     # 这里request参数是RequestHandler作为函数时所接收的参数
@@ -169,9 +254,14 @@ class RequestHandler(object):
                         # https://docs.python.org/3/library/urllib.parse.html?highlight=parse.parse_qs#urllib.parse.parse_qs
                         kw[k] = v[0]
                         # parse_qs()取出的value是一个单元素的list，这里需要取出真正的value值
+        return (await self.invoke(request, kw, request.match_info))
+
+    # 用已经解析好的参数kw（body或query string，可以为None）和URL变量match_info调用处理函数
+    # /api/batch也通过它直接调用其他路由的处理函数，不必再走一遍HTTP和middleware
+    async def invoke(self, request, kw, match_info):
         # 再次检查kw值，如果kw为零，表示URL中没有
         if kw is None:
-            kw = dict(**request.match_info)
+            kw = dict(**match_info)
             # match_info获取URL中的变量keys-values对，key值直接在定义的时候确定，value值会根据key值的位置在URL中自动提取
             # 如get(/home/{name})，name是key值，实际URL请求时localhost/home/whq，whq是value值
             # match_info应该是返回一个类似dict的实例（不确定，看不懂document）
@@ -185,7 +275,7 @@ class RequestHandler(object):
                         copy[name] = kw[name]
                 kw = copy
             # check named arg:
-            for k, v in request.match_info.items():
+            for k, v in match_info.items():
                 if k in kw:
                     logging.warning('Duplicate arg name in named arg and kw args: %s' % k)
                 kw[k] = v
@@ -198,12 +288,23 @@ class RequestHandler(object):
                 if not name in kw:
                     return web.HTTPBadRequest('Missing argument: %s' % name)
         logging.info('call with args: %s' % str(kw))
+        # 设置请求的截止时间，orm中的每条sql只能使用剩余的时间预算
+        timeout = self._timeout
+        if timeout is None:
+            timeout = self._app.get('__request_timeout__')
+        token = orm.set_deadline(timeout) if timeout else None
         try:
             # 执行处理函数
             r = await self._func(**kw)
             return r
         except APIError as e:
             return dict(error=e.error, data=e.data, message=e.message)
+        except orm.DeadlineExceeded as e:
+            logging.warning('%s: %s' % (request.path, e))
+            return web.HTTPGatewayTimeout()
+        finally:
+            if token is not None:
+                orm.reset_deadline(token)
 
 # 添加一个静态路径到app中
 def add_static(app):
@@ -220,8 +321,33 @@ def add_route(app, fn):
     if not asyncio.iscoroutinefunction(fn) and not inspect.isgeneratorfunction(fn):
         fn = asyncio.coroutine(fn)
     logging.info('add route %s %s => %s(%s)' % (method, path, fn.__name__, ', '.join(inspect.signature(fn).parameters.keys())))
-    app.router.add_route(method, path, RequestHandler(app, fn))
+    handler = RequestHandler(app, fn)
+    app.router.add_route(method, path, handler)
     # add_route()方法用于将请求方法、路径和响应函数绑定并添加到app中
+    # 同时记下路由，供find_route()在进程内把路径直接解析到RequestHandler
+    app.setdefault('__routes__', []).append((method, compile_route(path), handler))
+
+_RE_ROUTE_VAR = re.compile(r'\{(\w+)(?::([^{}]+))?\}')
+
+# 把'/blog/{id}'这样的路由模板编译成正则表达式，和aiohttp的规则一致：变量默认匹配一段不含'/'的内容
+def compile_route(path):
+    pattern, last = [], 0
+    for m in _RE_ROUTE_VAR.finditer(path):
+        pattern.append(re.escape(path[last:m.start()]))
+        pattern.append('(?P<%s>%s)' % (m.group(1), m.group(2) or '[^{}/]+'))
+        last = m.end()
+    pattern.append(re.escape(path[last:]))
+    return re.compile('^%s$' % ''.join(pattern))
+
+# 返回(RequestHandler, match_info)，找不到时返回(None, None)
+def find_route(app, method, path):
+    for m, regex, handler in app.get('__routes__', ()):
+        if m != method:
+            continue
+        match = regex.match(path)
+        if match:
+            return handler, match.groupdict()
+    return None, None
 
 # 将所有响应函数添加到app中，module_name是响应函数所在的py文件名，即‘handlers’
 def add_routes(app, module_name):
@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Write-behind counters for denormalized columns such as blogs.comment_count and blogs.view_count.
+
+Increments are added up in memory and written back every `interval` seconds with batched
+
+    update `blogs` set `view_count`=`view_count`+? where `id` in (?, ?, ...)
+
+one statement per distinct delta. Reads add the deltas not flushed yet to the persisted value.
+Counts derived from another table are rebuilt with Model.findNumber:
+
+    python3 counters.py backfill     # recount every row, e.g. after adding the columns
+    python3 counters.py reconcile    # recount rows with recent activity and fix drift
+'''
+
+__author__ = 'Hongqing Wang'
+
+import sys, time, asyncio, logging
+
+import orm, metrics
+from config import configs
+from models import Blog, Comment
+
+# 由其他表派生的计数：(模型, 计数列, 子表模型, 子表中引用模型主键的列)
+DERIVED = [
+    (Blog, 'comment_count', Comment, 'blog_id'),
+]
+
+flushed_rows = metrics.REGISTRY.counter('counter_flushed_rows_total', 'Counter rows written back.', ('column',))
+flush_errors = metrics.REGISTRY.counter('counter_flush_errors_total', 'Failed counter flushes.')
+pending_rows = metrics.REGISTRY.gauge('counter_pending_rows', 'Counter rows with deltas not written back yet.')
+drift_total = metrics.REGISTRY.counter('counter_drift_fixed_total', 'Counter rows corrected by reconciliation.', ('column',))
+
+class Counters(object):
+    '''
+    In-memory deltas keyed by (model, column) and primary key, flushed in batches.
+    '''
+
+    def __init__(self, max_batch=500):
+        self.max_batch = max_batch
+        # (model, 列名) => {主键: 增量}
+        self._pending = dict()
+        # 正在写回的增量，写回完成前读取时也要算上
+        self._inflight = dict()
+        self._lock = asyncio.Lock()
+
+    def incr(self, model, field, pk, n=1):
+        deltas = self._pending.setdefault((model, field), dict())
+        deltas[pk] = deltas.get(pk, 0) + n
+        pending_rows.set(value=self.size())
+
+    def pending(self, model, field, pk):
+        key = (model, field)
+        return self._pending.get(key, {}).get(pk, 0) + self._inflight.get(key, {}).get(pk, 0)
+
+    def size(self):
+        return sum(len(d) for d in self._pending.values())
+
+    def value(self, obj, field):
+        return (obj.getValue(field) or 0) + self.pending(obj.__class__, field, obj.getValue(obj.__primary_key__))
+
+    # 把未写回的增量加到刚查出来的对象上，同一个对象只能调用一次
+    def apply(self, *objs):
+        for obj in objs:
+            for field in obj.__counters__:
+                obj[field] = self.value(obj, field)
+        return objs
+
+    def _merge(self, pending):
+        for key, deltas in pending.items():
+            target = self._pending.setdefault(key, dict())
+            for pk, n in deltas.items():
+                target[pk] = target.get(pk, 0) + n
+
+    async def flush(self):
+        async with self._lock:
+            if not self._pending:
+                return 0
+            pending, self._pending = self._pending, dict()
+            self._inflight = pending
+            rows = 0
+            try:
+                for (model, field), deltas in pending.items():
+                    # 增量相同的行合并成一条update
+                    groups = dict()
+                    for pk, n in deltas.items():
+                        if n:
+                            groups.setdefault(n, []).append(pk)
+                    for n, pks in groups.items():
+                        for i in range(0, len(pks), self.max_batch):
+                            chunk = pks[i:i + self.max_batch]
+                            sql = 'update `%s` set `%s`=`%s`+? where `%s` in (%s)' % (model.__table__, field, field, model.__primary_key__, ', '.join('?' * len(chunk)))
+                            # 热表和归档表的update在同一个事务里，要么都写入要么都不写入，
+                            # 失败后放回去重写时不会把增量在热表上加两次
+                            async with orm.transaction() as tx:
+                                affected = await tx.execute(sql, [n] + chunk)
+                                table = orm.archive_table(model)
+                                if table is not None and affected < len(chunk):
+                                    # 有的行已经被归档了
+                                    await tx.execute(sql.replace('`%s`' % model.__table__, '`%s`' % table, 1), [n] + chunk)
+                            for pk in chunk:
+                                del deltas[pk]
+                            flushed_rows.inc('%s.%s' % (model.__table__, field), value=len(chunk))
+                            rows += len(chunk)
+            except Exception as e:
+                # 没写成功的增量放回去，下次再写
+                flush_errors.inc()
+                logging.exception('failed to flush counters: %s' % e)
+                self._merge(pending)
+            finally:
+                self._inflight = dict()
+                pending_rows.set(value=self.size())
+            return rows
+
+    async def run(self, interval):
+        while True:
+            await asyncio.sleep(interval)
+            await self.flush()
+
+counters = Counters(configs.counters.max_batch)
+
+@orm.add_listener
+def _count_children(event, model):
+    if event not in ('save', 'remove'):
+        return
+    for parent, field, child, fk in DERIVED:
+        if isinstance(model, child):
+            counters.incr(parent, field, model.getValue(fk), 1 if event == 'save' else -1)
+
+# 用findNumber重新统计一行的计数并写回
+# 统计期间本worker新增的子记录已经记在pending里，写回时减掉，这样flush之后正好是真实值；
+# 其他worker未写回的增量看不到，所以只能在没有写入的时候调用（离线的backfill，或者reconcile挑出的静止的行）
+async def recount(model, field, child, fk, pk):
+    n = await child.findNumber(child.__primary_key__, '`%s`=?' % fk, [pk], includeArchived=True)
+    await orm.execute('update `%s` set `%s`=? where `%s`=?' % (model.__table__, field, model.__primary_key__), [n - counters.pending(model, field, pk), pk])
+    return n
+
+async def backfill(batch=500):
+    total = 0
+    for model, field, child, fk in DERIVED:
+        pk = model.__primary_key__
+        last = ''
+        while True:
+            # 按主键分页，只查主键，不把正文之类的大字段读出来
+            rs = await orm.select('select `%s` from `%s` where `%s`>? order by `%s` limit ?' % (pk, model.__table__, pk, pk), [last, batch])
+            for r in rs:
+                await recount(model, field, child, fk, r[pk])
+            total += len(rs)
+            if len(rs) < batch:
+                break
+            last = rs[-1][pk]
+        logging.info('backfilled %s.%s' % (model.__table__, field))
+    return total
+
+# 只检查最近window秒内有子记录写入的行，计数不一致时修正
+# 其他worker的增量最多interval秒就会写回，所以先写回本worker的增量，再只核对最后一条子记录早于settle秒之前的行：
+# 这些行在所有worker上都已经没有未写回的增量，按count(*)写回不会和之后的写回重复计算
+async def reconcile(window=None, settle=None):
+    if window is None:
+        window = configs.counters.reconcile_window
+    if settle is None:
+        settle = configs.counters.reconcile_settle
+    await counters.flush()
+    now = time.time()
+    fixed = 0
+    for model, field, child, fk in DERIVED:
+        # 子表可能分片，在每个分片上查；同一个父行的子记录在同一个分片上
+        rs = await orm.shard_select(child, 'select `%s`, max(`created_at`) `latest` from `%s` where `created_at`>? group by `%s`' % (fk, child.__table__, fk), [now - window])
+        for r in rs:
+            pk = r[fk]
+            if r['latest'] > now - settle or counters.pending(model, field, pk):
+                # 还有写入，留到下一次核对
+                continue
+            obj = await model.find(pk)
+            if obj is None:
+                continue
+            expected = await child.findNumber(child.__primary_key__, '`%s`=?' % fk, [pk], includeArchived=True)
+            if obj.getValue(field) != expected:
+                logging.warning('counter drift on %s.%s %s: %s != %s' % (model.__table__, field, pk, obj.getValue(field), expected))
+                await recount(model, field, child, fk, pk)
+                drift_total.inc('%s.%s' % (model.__table__, field))
+                fixed += 1
+    return fixed
+
+# 增量只在内存里，关闭时必须写回，否则每次重启或发布都会丢掉最后interval秒的增量；
+# view_count之类不是派生出来的计数，reconcile也补不回来。挂在app的on_shutdown上，在scheduler.stop()之后执行
+async def on_shutdown(app):
+    rows = await counters.flush()
+    if counters.size():
+        logging.error('%s counter rows not written back at shutdown.' % counters.size())
+    else:
+        logging.info('%s counter rows written back at shutdown.' % rows)
+
+# 写回不需要加锁，每个worker写回自己的增量；核对加锁，同一时间只有一个worker做
+def register(scheduler):
+    scheduler.add('counters:flush', counters.flush, interval=configs.counters.interval, jitter=0, lock=False)
+    if configs.counters.reconcile_interval:
+        scheduler.add('counters:reconcile', reconcile, interval=configs.counters.reconcile_interval, lock=True)
+
+async def main(loop, command):
+    await orm.create_pool(loop=loop, **configs.db)
+    if command == 'backfill':
+        logging.info('%s rows backfilled.' % (await backfill()))
+    elif command == 'reconcile':
+        logging.info('%s rows fixed.' % (await reconcile()))
+    else:
+        print('usage: python3 counters.py backfill|reconcile')
+
+if __name__ == '__main__':
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(main(loop, sys.argv[1] if len(sys.argv) > 1 else None))
@@ -0,0 +1,393 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Bulk export/import of model tables.
+
+    python3 dbtool.py export comments comments.ndjson
+    python3 dbtool.py export users users.csv --format csv
+    python3 dbtool.py import comments comments.ndjson --workers 4
+    python3 dbtool.py import comments comments.ndjson --load-data
+    python3 dbtool.py export comments_archive comments_archive.ndjson
+
+Export streams every shard of the table with a server-side cursor in primary key order and writes
+one chunk at a time. Import splits the file into chunks, parses them in a process pool and writes
+each chunk with multi-row inserts per shard (split to stay under max_allowed_packet), or with
+LOAD DATA LOCAL INFILE. The <table>_archive tables of configs.archive.tables are handled the same way.
+Both save a checkpoint (<file>.ckpt: shard, last primary key, file offset) after every chunk;
+running the same command again resumes from it, --restart starts over.
+'''
+
+__author__ = 'Hongqing Wang'
+
+import os, io, sys, csv, json, time, asyncio, logging, argparse, tempfile
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import orm
+from config import configs
+from models import User, Blog, Comment, MaterializedView
+
+# 表名 => model；<表名>_archive和原表的列相同，备份时要一起导出，否则归档的行会丢失
+MODELS = dict((m.__table__, m) for m in (User, Blog, Comment, MaterializedView))
+MODELS.update(('%s_archive' % t, MODELS[t]) for t in configs.archive.tables if t in MODELS)
+
+# MySQL 5.7默认的max_allowed_packet，查询不到服务器设置时使用
+DEFAULT_MAX_PACKET = 4 * 1024 * 1024
+
+# 文件中的列顺序：主键在前，然后是其他属性
+def columns(model):
+    return [model.__primary_key__] + model.__fields__
+
+# CSV里都是字符串，按列类型转换回来；和sqlitepool一样只看类型名的前缀
+def column_kinds(model):
+    kinds = []
+    for c in columns(model):
+        t = model.__mappings__[c].column_type.lower()
+        if t.startswith(('bigint', 'int', 'boolean', 'bool')):
+            kinds.append('int')
+        elif t.startswith(('real', 'float', 'double')):
+            kinds.append('float')
+        else:
+            kinds.append('str')
+    return kinds
+
+_CONVERTERS = dict(int=int, float=float, str=str)
+
+class Checkpoint(object):
+    '''
+    JSON file saved after every chunk; only used to resume the same command on the same file.
+    '''
+
+    def __init__(self, path, key):
+        self.path = path
+        self.key = key
+
+    def load(self):
+        try:
+            with open(self.path, 'r') as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            return None
+        if state.get('key') != self.key:
+            raise ValueError('%s belongs to another command: %s' % (self.path, state.get('key')))
+        return state
+
+    def save(self, **state):
+        state['key'] = self.key
+        tmp = '%s.tmp' % self.path
+        with open(tmp, 'w') as f:
+            json.dump(state, f)
+        os.replace(tmp, self.path)
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+class Progress(object):
+
+    def __init__(self, label, total, rows=0, interval=1):
+        self.label = label
+        self.total = total
+        self.rows = rows
+        self.interval = interval
+        self.start = time.time()
+        self._last = 0
+
+    def add(self, rows, done=None, force=False):
+        self.rows += rows
+        now = time.time()
+        if not force and now - self._last < self.interval:
+            return
+        self._last = now
+        rate = self.rows / max(now - self.start, 1e-6)
+        percent = '' if not self.total else ' (%.1f%%)' % (100.0 * (self.rows if done is None else done) / self.total)
+        print('%s: %s rows%s, %.0f rows/s' % (self.label, self.rows, percent, rate), file=sys.stderr)
+
+def select_sql(model, table):
+    return model.__select__.replace('from `%s`' % model.__table__, 'from `%s`' % table)
+
+async def count_rows(model, table):
+    rs = await orm.shard_select(model, 'select count(*) `_num_` from `%s`' % table, [])
+    return sum(r['_num_'] for r in rs)
+
+def encode_rows(fmt, cols, rows):
+    if fmt == 'csv':
+        buf = io.StringIO()
+        w = csv.writer(buf, lineterminator='\n')
+        for r in rows:
+            w.writerow([r[c] for c in cols])
+        return buf.getvalue().encode('utf-8')
+    return ''.join(json.dumps(r, ensure_ascii=False) + '\n' for r in rows).encode('utf-8')
+
+async def export(model, path, fmt='ndjson', chunk=1000, restart=False, table=None):
+    table = table or model.__table__
+    cols = columns(model)
+    pk = model.__primary_key__
+    select = select_sql(model, table)
+    ckpt = Checkpoint(path + '.ckpt', 'export:%s:%s' % (table, fmt))
+    state = None if restart else ckpt.load()
+    pools = model._pools() or [None]
+    progress = Progress('export %s' % table, await count_rows(model, table), state['rows'] if state else 0)
+    if state:
+        # 截掉最后一次checkpoint之后写了一半的内容
+        f = open(path, 'r+b')
+        f.seek(state['offset'])
+        f.truncate()
+        logging.info('resuming export at shard %s after %s' % (state['shard'], state['last']))
+    else:
+        f = open(path, 'wb')
+        if fmt == 'csv':
+            f.write(encode_rows('csv', range(len(cols)), [cols]))
+    with f:
+        for i, pool in enumerate(pools):
+            last = None
+            if state:
+                if i < state['shard']:
+                    continue
+                if i == state['shard']:
+                    last = state['last']
+            if last is None:
+                sql, args = '%s order by `%s`' % (select, pk), []
+            else:
+                sql, args = '%s where `%s`>? order by `%s`' % (select, pk, pk), [last]
+            async for rows in orm.stream(sql, args, chunk, pool):
+                f.write(encode_rows(fmt, cols, rows))
+                f.flush()
+                # 先把数据落盘再记checkpoint，恢复时从这个位置继续不会丢行
+                os.fsync(f.fileno())
+                progress.add(len(rows))
+                ckpt.save(shard=i, last=rows[-1][pk], offset=f.tell(), rows=progress.rows)
+            ckpt.save(shard=i + 1, last=None, offset=f.tell(), rows=progress.rows)
+    ckpt.remove()
+    progress.add(0, force=True)
+    return progress.rows
+
+# 按行读取文件，每chunk条记录一块，返回(数据, 块结束位置)
+# CSV的字段里可能有换行，引号个数为偶数时一条记录才算结束
+def read_chunks(f, fmt, chunk):
+    lines, record, quotes = [], [], 0
+    while True:
+        line = f.readline()
+        if not line:
+            break
+        if fmt == 'csv':
+            record.append(line)
+            quotes += line.count(b'"')
+            if quotes % 2:
+                continue
+            lines.append(b''.join(record))
+            record, quotes = [], 0
+        elif line.strip():
+            lines.append(line)
+        if len(lines) >= chunk:
+            yield b''.join(lines), f.tell()
+            lines = []
+    if lines:
+        yield b''.join(lines), f.tell()
+
+def _tsv_field(v):
+    return str(v).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+# 在进程池中执行：解析一块数据并按列类型转换
+# tsv_prefix不为None时按分片写成LOAD DATA用的TSV文件，返回{分片序号: 文件路径}，否则返回转换好的行
+def parse_chunk(fmt, header, cols, kinds, data, tsv_prefix=None, key_index=0, shard_count=1):
+    text = data.decode('utf-8')
+    if fmt == 'csv':
+        records = [dict(zip(header, r)) for r in csv.reader(io.StringIO(text))]
+    else:
+        # 不能用splitlines()，它会在JSON字符串里的\u2028之类的字符处断开
+        records = [json.loads(l) for l in text.split('\n') if l.strip()]
+    values = []
+    for r in records:
+        values.append(tuple(_CONVERTERS[k](r[c]) for c, k in zip(cols, kinds)))
+    if not values:
+        return 0, None, None
+    if tsv_prefix is None:
+        return len(values), values[-1][0], values
+    files = dict()
+    for v in values:
+        i = orm.shard_index(v[key_index], shard_count) if shard_count > 1 else 0
+        if i not in files:
+            files[i] = open('%s-%s.tsv' % (tsv_prefix, i), 'w', encoding='utf-8')
+        files[i].write('\t'.join(map(_tsv_field, v)) + '\n')
+    paths = dict()
+    for i, tf in files.items():
+        tf.close()
+        paths[i] = tf.name
+    return len(values), values[-1][0], paths
+
+def _pool_of(pools, index):
+    return None if pools is None else pools[index]
+
+_ESCAPED = (b'\\', b"'", b'"', b'\n', b'\r', b'\x00', b'\x1a')
+
+# 估算一行在insert语句里占的字节数：字符串加上引号和转义用的反斜杠，数字按最长的写法算
+def row_size(values):
+    n = 3
+    for v in values:
+        if isinstance(v, str):
+            b = v.encode('utf-8')
+            n += len(b) + 4 + sum(b.count(c) for c in _ESCAPED)
+        else:
+            n += 26
+    return n
+
+# 把一组行切成若干批，每批拼成的insert语句不超过max_bytes；超过max_bytes的单行自成一批，由服务器报错
+def split_by_size(values, max_bytes, head=0):
+    batch, size = [], head
+    for v in values:
+        n = row_size(v)
+        if batch and size + n > max_bytes:
+            yield batch
+            batch, size = [], head
+        batch.append(v)
+        size += n
+    if batch:
+        yield batch
+
+async def insert_rows(model, cols, values, ignore_existing=False, table=None, max_bytes=DEFAULT_MAX_PACKET):
+    table = table or model.__table__
+    pk = model.__primary_key__
+    if ignore_existing:
+        # 上次中断时这一块可能已经写进去了一部分
+        existing = await orm.shard_select(model, 'select `%s` from `%s` where `%s` in (%s)' % (pk, table, pk, orm.create_args_string(len(values))), [v[0] for v in values])
+        existing = set(r[pk] for r in existing)
+        values = [v for v in values if v[0] not in existing]
+        if not values:
+            return
+    pools = model._pools()
+    groups = dict()
+    if pools is None:
+        groups[0] = values
+    else:
+        key_index = cols.index(model.__shard_key__)
+        for v in values:
+            groups.setdefault(orm.shard_index(v[key_index], len(pools)), []).append(v)
+    head = 'insert into `%s` (%s) values ' % (table, ', '.join('`%s`' % c for c in cols))
+    row = '(%s)' % orm.create_args_string(len(cols))
+
+    async def write(i, vs):
+        # 同一分片的各批依次执行，不同分片之间并发
+        for batch in split_by_size(vs, max_bytes, len(head)):
+            await orm.execute(head + ', '.join([row] * len(batch)), [a for v in batch for a in v], pool=_pool_of(pools, i))
+
+    await asyncio.gather(*[write(i, vs) for i, vs in groups.items()])
+
+async def load_files(model, cols, paths, ignore_existing=False, table=None):
+    pools = model._pools()
+    sql = "load data local infile ? %sinto table `%s` character set utf8 fields terminated by '\\t' escaped by '\\\\' lines terminated by '\\n' (%s)" % (
+        'ignore ' if ignore_existing else '', table or model.__table__, ', '.join('`%s`' % c for c in cols))
+    try:
+        await asyncio.gather(*[orm.execute(sql, [path], pool=_pool_of(pools, i)) for i, path in paths.items()])
+    finally:
+        for path in paths.values():
+            os.remove(path)
+
+async def import_(model, path, fmt='ndjson', chunk=1000, workers=4, load_data=False, restart=False, table=None, max_bytes=DEFAULT_MAX_PACKET):
+    table = table or model.__table__
+    loop = asyncio.get_event_loop()
+    cols = columns(model)
+    kinds = column_kinds(model)
+    ckpt = Checkpoint(path + '.ckpt', 'import:%s:%s' % (table, fmt))
+    state = None if restart else ckpt.load()
+    pools = model._pools()
+    shard_count = 1 if pools is None else len(pools)
+    key_index = cols.index(model.__shard_key__) if model.__shard_key__ else 0
+    progress = Progress('import %s' % table, os.path.getsize(path), state['rows'] if state else 0)
+    tmpdir = tempfile.mkdtemp(prefix='dbtool-') if load_data else None
+    executor = ProcessPoolExecutor(workers)
+    resumed = state is not None
+    pending = deque()
+
+    async def write_next():
+        nonlocal resumed
+        fut, offset = pending.popleft()
+        count, last, payload = await fut
+        if count:
+            if load_data:
+                await load_files(model, cols, payload, resumed, table)
+            else:
+                await insert_rows(model, cols, payload, resumed, table, max_bytes)
+        resumed = False
+        # 按文件顺序写入，checkpoint之前的块都已经写进数据库
+        progress.add(count, done=offset)
+        ckpt.save(offset=offset, last=last, rows=progress.rows)
+
+    try:
+        with open(path, 'rb') as f:
+            header = cols
+            if fmt == 'csv':
+                header = next(csv.reader([f.readline().decode('utf-8')]))
+                missing = set(cols) - set(header)
+                if missing:
+                    raise ValueError('columns missing in %s: %s' % (path, ', '.join(sorted(missing))))
+            if state:
+                f.seek(state['offset'])
+                logging.info('resuming import at offset %s after %s' % (state['offset'], state['last']))
+            for n, (data, offset) in enumerate(read_chunks(f, fmt, chunk)):
+                prefix = os.path.join(tmpdir, 'chunk%s' % n) if load_data else None
+                fut = loop.run_in_executor(executor, parse_chunk, fmt, header, cols, kinds, data, prefix, key_index, shard_count)
+                pending.append((fut, offset))
+                # 解析在进程池中并行，最多领先写入workers * 2块
+                if len(pending) >= workers * 2:
+                    await write_next()
+            while pending:
+                await write_next()
+    finally:
+        for fut, offset in pending:
+            fut.cancel()
+        executor.shutdown(wait=True)
+        if tmpdir is not None:
+            for name in os.listdir(tmpdir):
+                os.remove(os.path.join(tmpdir, name))
+            os.rmdir(tmpdir)
+    ckpt.remove()
+    progress.add(0, done=progress.total, force=True)
+    return progress.rows
+
+# model所在各分片的max_allowed_packet取最小值，留出1KB给协议开销
+async def max_packet(model):
+    sizes = []
+    for pool in model._pools() or [None]:
+        try:
+            rs = await orm.select('select @@max_allowed_packet `size`', [], pool=pool)
+            sizes.append(int(rs[0]['size']))
+        except Exception as e:
+            logging.warning('failed to read max_allowed_packet: %s' % e)
+            sizes.append(DEFAULT_MAX_PACKET)
+    return max(min(sizes) - 1024, 1024)
+
+async def run(loop, options):
+    kw = dict(configs.db)
+    kw['local_infile'] = options.command == 'import' and options.load_data
+    await orm.create_pool(loop=loop, **kw)
+    await orm.create_shard_pools(loop, configs.shards, kw)
+    model = MODELS[options.table]
+    if options.command == 'export':
+        return (await export(model, options.file, options.format, options.chunk, options.restart, options.table))
+    max_bytes = options.max_packet or (await max_packet(model))
+    return (await import_(model, options.file, options.format, options.chunk, options.workers, options.load_data, options.restart, options.table, max_bytes))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Export/import model tables as NDJSON or CSV.')
+    parser.add_argument('command', choices=('export', 'import'))
+    parser.add_argument('table', choices=sorted(MODELS))
+    parser.add_argument('file')
+    parser.add_argument('--format', choices=('ndjson', 'csv'), help='default: from the file extension')
+    parser.add_argument('--chunk', type=int, default=1000, help='rows per chunk')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 4, help='parser processes for import')
+    parser.add_argument('--load-data', action='store_true', help='import with LOAD DATA LOCAL INFILE')
+    parser.add_argument('--max-packet', type=int, help='max bytes per insert statement, default: max_allowed_packet of the server')
+    parser.add_argument('--restart', action='store_true', help='ignore an existing checkpoint')
+    options = parser.parse_args(argv)
+    if options.format is None:
+        options.format = 'csv' if options.file.endswith('.csv') else 'ndjson'
+    # orm每条sql都打印INFO日志，进度改为输出到stderr
+    logging.disable(logging.INFO)
+    loop = asyncio.get_event_loop()
+    rows = loop.run_until_complete(run(loop, options))
+    print('%s %s rows.' % ('exported' if options.command == 'export' else 'imported', rows), file=sys.stderr)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Jinja2 fragment caching:
+
+    {% cache 'index:users', 60, 'users' %}
+        ... expensive block ...
+    {% endcache %}
+
+The arguments are the cache key, the ttl in seconds (None for no expiry) and any
+number of tags. Model writes invalidate the tags '<table>' and '<table>:<id>',
+so a fragment tagged 'users' is dropped as soon as a User is saved, updated or removed.
+A model with __fragment_parent__ also invalidates '<table>:<parent id>': a Comment write
+drops 'comments:<blog_id>', the tag of that blog's comment list.
+'''
+
+__author__ = 'Hongqing Wang'
+
+import time, logging
+from collections import OrderedDict
+
+from jinja2 import nodes
+from jinja2.ext import Extension
+from markupsafe import Markup
+
+import orm, metrics
+from config import configs
+
+fragment_hits = metrics.REGISTRY.counter('fragment_cache_hits_total', 'Template fragment cache hits.')
+fragment_misses = metrics.REGISTRY.counter('fragment_cache_misses_total', 'Template fragment cache misses.')
+
+class FragmentCache(object):
+    '''
+    Shared LRU of rendered fragments with per-entry ttl and tag-based invalidation.
+    '''
+
+    def __init__(self, maxsize=1000):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        # tag => 该tag下所有的key
+        self._tags = dict()
+
+    def get(self, key):
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+        value, expires, tags = entry
+        if expires is not None and expires < time.time():
+            self._remove(key)
+            return None
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key, value, ttl=None, tags=()):
+        self._remove(key)
+        expires = None if ttl is None else time.time() + ttl
+        self._data[key] = (value, expires, tuple(tags))
+        for tag in tags:
+            self._tags.setdefault(tag, set()).add(key)
+        while len(self._data) > self.maxsize:
+            self._remove(next(iter(self._data)))
+
+    def _remove(self, key):
+        entry = self._data.pop(key, None)
+        if entry is None:
+            return
+        for tag in entry[2]:
+            keys = self._tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tags[tag]
+
+    def invalidate_tag(self, tag):
+        keys = self._tags.pop(tag, ())
+        for key in list(keys):
+            self._remove(key)
+        if keys:
+            logging.info('fragment cache: tag %s invalidated %s entries' % (tag, len(keys)))
+
+    def clear(self):
+        self._data.clear()
+        self._tags.clear()
+
+fragment_cache = FragmentCache(configs.fragment_cache.maxsize)
+
+@orm.add_listener
+def _invalidate_fragments(event, model):
+    fragment_cache.invalidate_tag(model.__table__)
+    fragment_cache.invalidate_tag('%s:%s' % (model.__table__, model.getValue(model.__primary_key__)))
+    parent = getattr(model, '__fragment_parent__', None)
+    if parent is not None:
+        fragment_cache.invalidate_tag('%s:%s' % (model.__table__, model.getValue(parent)))
+
+class FragmentCacheExtension(Extension):
+    tags = set(['cache'])
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        args = [parser.parse_expression()]
+        if parser.stream.skip_if('comma'):
+            args.append(parser.parse_expression())
+        else:
+            args.append(nodes.Const(None))
+        tags = []
+        while parser.stream.skip_if('comma'):
+            tags.append(parser.parse_expression())
+        args.append(nodes.List(tags))
+        body = parser.parse_statements(['name:endcache'], drop_needle=True)
+        return nodes.CallBlock(self.call_method('_cache', args), [], [], body).set_lineno(lineno)
+
+    def _cache(self, key, ttl, tags, caller):
+        value = fragment_cache.get(key)
+        if value is not None:
+            fragment_hits.inc()
+            return value
+        fragment_misses.inc()
+        # caller()渲染出的内容已经按模板的autoescape规则处理过，用Markup保存避免命中时被再次转义
+        value = Markup(caller())
+        fragment_cache.set(key, value, ttl, [str(t) for t in tags])
+        return value
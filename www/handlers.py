@@ -5,10 +5,30 @@ __author__ = 'Hongqing Wang'
 
 ' url handlers '
 
-from coroweb import get, post
-from models import User
-from apis import Page
-import logging
+import re, json, asyncio, hashlib, logging
+from urllib import parse
+
+from aiohttp import web
+
+from coroweb import get, post, find_route
+from models import User, Blog, Comment, next_id
+from apis import Page, json_dumps, APIError, APIValueError, APIPermissionError, APIResourceNotFoundError
+from config import configs
+from auth import COOKIE_NAME, hash_password, check_password, set_user_cookie
+import orm, metrics, profiler, advisor, content, analytics, search
+from hub import hub, model_frame
+from counters import counters
+from matview import materialize
+from admission import Shed
+from fragcache import fragment_cache
+
+_RE_EMAIL = re.compile(r'^[a-z0-9\.\-\_]+\@[a-z0-9\-\_]+(\.[a-z0-9\-\_]+){1,4}$')
+_RE_SHA1 = re.compile(r'^[0-9a-f]{40}$')
+
+def check_admin(request):
+    user = getattr(request, '__user__', None)
+    if user is None or not user.admin:
+        raise APIPermissionError()
 
 def get_page_index(page_str):
     p = 1
@@ -20,17 +40,61 @@ def get_page_index(page_str):
         p = 1
     return p
 
+# 首页和/api/users第一页变化很少，由scheduler定时预先计算好，用户表有写入时也会很快刷新
+@materialize('users:all', tables=('users',))
+async def all_users():
+    users = await User.findAll()
+    for u in users:
+        u.passwd = '******'
+    return users
+
+@materialize('users:page1', tables=('users',))
+async def users_first_page():
+    return (await query_users(1))
+
 @get('/')
 async def index(request):
-    users = await User.findAll()
+    users = await all_users.get()
     return {
         '__template__': 'test.html',
         'users': users
     }
 
+@get('/blog/{id}')
+async def get_blog(id):
+    blog = await Blog.find(id)
+    if blog is None:
+        raise APIResourceNotFoundError('blog')
+    # 评论列表的片段缓存命中时直接交给模板，不再查评论和渲染markdown
+    comments_key = 'blog:comments:%s' % id
+    comments_html = fragment_cache.get(comments_key)
+    comments = ()
+    if comments_html is None:
+        # 评论不会比博客早，博客还在热数据窗口里时它的评论也都是热数据，不用查归档
+        comments = await Comment.findAll('blog_id=?', [id], orderBy='created_at desc', includeArchived=not orm.is_hot(Comment, blog.created_at))
+        # 渲染结果按内容哈希缓存，热门文章只需要一次字典查找
+        for c in comments:
+            c.html_content = await content.markdown(c.content)
+    blog.html_content = await content.markdown(blog.content)
+    # 阅读数只在内存里加一，由counters定时批量写回
+    counters.incr(Blog, 'view_count', id)
+    counters.apply(blog)
+    return {
+        '__template__': 'blog.html',
+        'blog': blog,
+        'comments': comments,
+        'comments_key': comments_key,
+        'comments_html': comments_html
+    }
+
 @get('/api/users')
 async def api_get_users(*, page='1'):
     page_index = get_page_index(page)
+    if page_index == 1:
+        return (await users_first_page.get())
+    return (await query_users(page_index))
+
+async def query_users(page_index):
     num = await User.findNumber('id')
     p = Page(num, page_index)
     if num == 0:
@@ -41,10 +105,236 @@ async def api_get_users(*, page='1'):
     return dict(page=p, users=users)
 
 
+# 返回带登录cookie的用户信息
+def user_response(user):
+    r = web.Response()
+    set_user_cookie(r, user)
+    user.passwd = '******'
+    r.content_type = 'application/json'
+    r.body = json_dumps(user).encode('utf-8')
+    return r
+
+# 前端提交的passwd是sha1(email:口令)，服务器端再做加盐的慢哈希，哈希在cpu pool中执行
+@post('/api/users', batch=False)
+async def api_register_user(*, email, name, passwd):
+    if not name or not name.strip():
+        raise APIValueError('name')
+    if not email or not _RE_EMAIL.match(email):
+        raise APIValueError('email')
+    if not passwd or not _RE_SHA1.match(passwd):
+        raise APIValueError('passwd')
+    users = await User.findAll('email=?', [email])
+    if len(users) > 0:
+        raise APIError('register:failed', 'email', 'Email is already in use.')
+    user = User(id=next_id(), name=name.strip(), email=email, passwd=await hash_password(passwd),
+                image='http://www.gravatar.com/avatar/%s?d=mm&s=120' % hashlib.md5(email.encode('utf-8')).hexdigest())
+    await user.save()
+    return user_response(user)
+
+# 用一个固定的哈希值应对不存在的email，使两种失败的耗时一样，避免借此探测哪些email已注册
+_DUMMY_HASH = 'pbkdf2_sha256$%s$AAAAAAAAAAAAAAAAAAAAAA==$AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA=' % configs.password.iterations
+
+@post('/api/authenticate', batch=False)
+async def authenticate(*, email, passwd):
+    if not email:
+        raise APIValueError('email', 'Invalid email.')
+    if not passwd:
+        raise APIValueError('passwd', 'Invalid password.')
+    users = await User.findAll('email=?', [email])
+    if len(users) == 0:
+        await check_password(passwd, _DUMMY_HASH)
+        raise APIValueError('email', 'Email not exist.')
+    user = users[0]
+    if not await check_password(passwd, user.passwd):
+        raise APIValueError('passwd', 'Invalid password.')
+    return user_response(user)
+
+@get('/api/search')
+async def api_search(*, q='', kind='', page='1'):
+    # 按相关度排序的博客和评论，kind为空时两种都搜
+    q = q.strip()
+    if not q:
+        raise APIValueError('q', 'q cannot be empty.')
+    if len(q) > configs.search.max_query_length:
+        raise APIValueError('q', 'q is longer than %s characters.' % configs.search.max_query_length)
+    if kind not in ('', 'blog', 'comment'):
+        raise APIValueError('kind', 'kind must be blog or comment.')
+    return (await search.search(q, kind or None, get_page_index(page)))
+
 @get('/manage/users')
 async def manage_users(*, page='1'):
     # 查看所有用户
     return {
         '__template__': 'manage_users.html',
         'page_index': get_page_index(page)
-    }
\ No newline at end of file
+    }
+
+@get('/metrics')
+async def get_metrics():
+    # Prometheus文本格式
+    resp = web.Response(body=metrics.render().encode('utf-8'))
+    resp.content_type = 'text/plain; version=0.0.4'
+    return resp
+
+@get('/manage/profile')
+async def manage_profile(request, *, seconds='10'):
+    # 对当前worker采样seconds秒，返回可以直接交给flamegraph.pl的collapsed stack
+    check_admin(request)
+    try:
+        seconds = float(seconds)
+    except ValueError:
+        raise APIValueError('seconds', 'seconds must be a number.')
+    if seconds <= 0 or seconds > configs.profiler.max_seconds:
+        raise APIValueError('seconds', 'seconds must be in (0, %s].' % configs.profiler.max_seconds)
+    try:
+        text = await profiler.profile(seconds)
+    except RuntimeError as e:
+        raise APIValueError('seconds', str(e))
+    resp = web.Response(body=text.encode('utf-8'))
+    resp.content_type = 'text/plain;charset=utf-8'
+    return resp
+
+@get('/manage/advisor')
+async def manage_advisor(request):
+    # 对当前worker记录下来的查询形状执行EXPLAIN，列出全表扫描、filesort和建议添加的索引
+    check_admin(request)
+    text = advisor.format_report(await advisor.analyze())
+    resp = web.Response(body=(text or 'no problems found.').encode('utf-8'))
+    resp.content_type = 'text/plain;charset=utf-8'
+    return resp
+
+@get('/manage/analytics', batch=True)
+async def manage_analytics(request, *, table='users', days='30', window='7'):
+    # 最近days天每天新增的行数、window天滑动窗口的和以及每天新增数的百分位数
+    check_admin(request)
+    if table not in analytics.MODELS:
+        raise APIValueError('table', 'table must be one of %s.' % ', '.join(sorted(analytics.MODELS)))
+    try:
+        days, window = int(days), int(window)
+    except ValueError:
+        raise APIValueError('days', 'days and window must be integers.')
+    if days < 1 or days > configs.analytics.max_days:
+        raise APIValueError('days', 'days must be in [1, %s].' % configs.analytics.max_days)
+    if window < 1 or window > days:
+        raise APIValueError('window', 'window must be in [1, days].')
+    return await analytics.histogram(table, days, window)
+
+@get('/signout')
+async def signout(request):
+    referer = request.headers.get('Referer')
+    r = web.HTTPFound(referer or '/')
+    r.set_cookie(COOKIE_NAME, '-deleted-', max_age=0, httponly=True)
+    logging.info('user signed out.')
+    return r
+
+# 把子请求处理函数的返回值转换成{status, body}
+def batch_result(r):
+    if isinstance(r, web.StreamResponse):
+        body = getattr(r, 'text', None)
+        if body is not None and (r.content_type or '').startswith('application/json'):
+            body = json.loads(body)
+        return dict(status=r.status, body=body)
+    if isinstance(r, dict):
+        return dict(status=200, body=r)
+    if isinstance(r, int) and r >= 100 and r < 600:
+        return dict(status=r, body=None)
+    return dict(status=200, body=r)
+
+async def run_sub_request(request, sub):
+    if not isinstance(sub, dict):
+        return dict(status=400, body=dict(error='batch:invalid', data='request', message='Sub-request must be an object.'))
+    method = str(sub.get('method', 'GET')).upper()
+    url = parse.urlsplit(sub.get('path', ''))
+    if url.path == '/api/batch':
+        return dict(status=400, body=dict(error='batch:invalid', data='path', message='Nested batch is not allowed.'))
+    if url.path.startswith('/stream/'):
+        return dict(status=400, body=dict(error='batch:invalid', data='path', message='Event streams are not supported in a batch.'))
+    handler, match_info = find_route(request.app, method, url.path)
+    if handler is None:
+        return dict(status=404, body=None)
+    # 页面路由会渲染模板、增加阅读数，必须在执行之前拒绝
+    if not handler.batch:
+        return dict(status=400, body=dict(error='batch:invalid', data='path', message='Route %s is not supported in a batch.' % handler.route))
+    params = dict()
+    for k, v in parse.parse_qs(url.query, True).items():
+        params[k] = v[0]
+    body = sub.get('body')
+    if isinstance(body, dict):
+        params.update(body)
+    # 每个子请求和单独的请求一样计入所在路由和全局的并发名额
+    controller = request.app.get('__admission__')
+    acquired = ()
+    if controller is not None:
+        try:
+            acquired = await controller.acquire(handler.route, controller.priority(url.path))
+        except Shed:
+            return dict(status=503, body=dict(error='server:busy', data='', message='Server is busy, please try again later.'))
+    try:
+        return batch_result(await handler.invoke(request, params or None, match_info))
+    except web.HTTPException as e:
+        return dict(status=e.status, body=None)
+    finally:
+        if controller is not None:
+            controller.release(acquired)
+
+# 一次HTTP请求里并发执行多个API调用，直接分发给RequestHandler，所有子请求共享一个identity map
+# 请求体：{"requests": [{"method": "GET", "path": "/api/users?page=2"}, {"method": "POST", "path": "...", "body": {...}}]}
+@post('/api/batch', batch=False)
+async def api_batch(request, *, requests):
+    if not isinstance(requests, list) or not requests:
+        raise APIValueError('requests', 'requests must be a non-empty list.')
+    if len(requests) > configs.batch.max_requests:
+        raise APIValueError('requests', 'at most %s requests in one batch.' % configs.batch.max_requests)
+    token = orm.begin_identity_scope()
+    try:
+        results = await asyncio.gather(*[run_sub_request(request, sub) for sub in requests])
+    finally:
+        orm.end_identity_scope(token)
+    return dict(responses=results)
+
+# Server-Sent Events：先订阅再补发断线期间错过的行，之后转发hub推送的消息，空闲时定期发注释行保活
+async def event_stream(request, topic, replay=None):
+    sub = hub.subscribe(topic)
+    try:
+        resp = web.StreamResponse(headers={
+            'Content-Type': 'text/event-stream',
+            'Cache-Control': 'no-cache',
+            'X-Accel-Buffering': 'no'
+        })
+        await resp.prepare(request)
+        await resp.write(b'retry: %d\n\n' % (configs.hub.retry * 1000))
+        last_id = request.headers.get('Last-Event-ID')
+        if last_id and replay is not None:
+            for frame in (await replay(last_id)):
+                await resp.write(frame)
+        while True:
+            try:
+                frame = await asyncio.wait_for(sub.get(), configs.hub.heartbeat)
+            except asyncio.TimeoutError:
+                await resp.write(b': ping\n\n')
+                continue
+            if frame is None:
+                # 缓冲区满被hub丢弃，断开后客户端带着Last-Event-ID重连
+                break
+            await resp.write(frame)
+    except ConnectionResetError:
+        logging.info('event stream %s closed by client.' % topic)
+    finally:
+        hub.unsubscribe(sub)
+    return resp
+
+# 长连接不设截止时间，/stream/路径也不经过准入控制
+@get('/stream/blogs/{id}/comments', timeout=0)
+async def stream_comments(id, request):
+    blog = await Blog.find(id)
+    if blog is None:
+        raise APIResourceNotFoundError('blog')
+    # id按时间递增，断线重连时补发Last-Event-ID之后的评论
+    async def replay(last_id):
+        comments = await Comment.findAll('blog_id=? and id>?', [id, last_id], orderBy='id', limit=configs.hub.buffer_size)
+        return [model_frame('comment', c) for c in comments]
+    return (await event_stream(request, 'blog:%s' % id, replay))
+
+@get('/stream/blogs', timeout=0)
+async def stream_blogs(request):
+    return (await event_stream(request, 'blogs'))
@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+In-process pub/sub hub used to push new comments and blogs to Server-Sent Events clients.
+
+Model.save of a Comment publishes to the topic 'blog:<blog_id>', of a Blog to 'blogs'.
+Each event is serialized once and put into every subscriber's bounded buffer; a subscriber
+whose buffer is full is a slow consumer and gets dropped, it reconnects with Last-Event-ID.
+
+Saves only reach the hub of the worker that made them, so with several workers each one also
+polls MySQL every configs.hub.poll_interval seconds for rows created in the last poll_lookback
+seconds and publishes those it has not published yet. The overlap covers rows committed late
+and small clock differences between hosts; ids already published are remembered for a while.
+'''
+
+__author__ = 'Hongqing Wang'
+
+import time, asyncio, logging
+from collections import OrderedDict
+
+import orm, metrics
+from config import configs
+from apis import json_dumps
+from models import Blog, Comment
+
+subscribers_gauge = metrics.REGISTRY.gauge('hub_subscribers', 'Connected event stream subscribers.')
+published_total = metrics.REGISTRY.counter('hub_events_published_total', 'Events published by topic kind.', ('kind',))
+dropped_total = metrics.REGISTRY.counter('hub_slow_consumers_dropped_total', 'Subscribers dropped because their buffer was full.')
+
+class Subscriber(object):
+
+    def __init__(self, topic, buffer_size):
+        self.topic = topic
+        self.queue = asyncio.Queue(maxsize=buffer_size)
+        self.dropped = False
+
+    def offer(self, message):
+        try:
+            self.queue.put_nowait(message)
+            return True
+        except asyncio.QueueFull:
+            return False
+
+    # 返回下一条消息，被判定为慢消费者后返回None
+    async def get(self):
+        message = await self.queue.get()
+        return None if self.dropped else message
+
+    def drop(self):
+        self.dropped = True
+        # 清空缓冲区后放入None，唤醒正在等待的get()
+        while not self.queue.empty():
+            self.queue.get_nowait()
+        self.queue.put_nowait(None)
+
+class Hub(object):
+
+    def __init__(self, buffer_size=100, remember=60):
+        self.buffer_size = buffer_size
+        self.topics = dict()
+        self.count = 0
+        # 最近发布过的行id => created_at，本地保存和轮询到的同一行只推送一次
+        self.remember = remember
+        self._published = OrderedDict()
+
+    def subscribe(self, topic):
+        sub = Subscriber(topic, self.buffer_size)
+        self.topics.setdefault(topic, set()).add(sub)
+        self.count += 1
+        subscribers_gauge.set(value=self.count)
+        return sub
+
+    def unsubscribe(self, sub):
+        subs = self.topics.get(sub.topic)
+        if subs is None or sub not in subs:
+            return
+        subs.discard(sub)
+        if not subs:
+            del self.topics[sub.topic]
+        self.count -= 1
+        subscribers_gauge.set(value=self.count)
+
+    # message是已经编码好的SSE帧，所有订阅者共享同一个bytes对象
+    def publish(self, topic, message):
+        subs = self.topics.get(topic)
+        if not subs:
+            return 0
+        for sub in list(subs):
+            if not sub.offer(message):
+                logging.info('hub: dropping slow consumer on %s' % topic)
+                dropped_total.inc()
+                self.unsubscribe(sub)
+                sub.drop()
+        return len(subs)
+
+    # 第一次见到这一行时返回True，同时清掉早于remember秒之前的记录
+    def first_seen(self, id, created_at):
+        cutoff = time.time() - self.remember
+        while self._published:
+            k, t = next(iter(self._published.items()))
+            if t >= cutoff:
+                break
+            self._published.popitem(last=False)
+        if id in self._published:
+            return False
+        self._published[id] = created_at
+        return True
+
+    def has_subscribers(self, prefix):
+        for topic in self.topics:
+            if topic.startswith(prefix):
+                return True
+        return False
+
+def sse_frame(event, data, id=None):
+    lines = []
+    if id is not None:
+        lines.append('id: %s' % id)
+    lines.append('event: %s' % event)
+    for line in data.split('\n'):
+        lines.append('data: %s' % line)
+    return ('\n'.join(lines) + '\n\n').encode('utf-8')
+
+def model_frame(event, model):
+    return sse_frame(event, json_dumps(model), model.getValue('id'))
+
+hub = Hub(configs.hub.buffer_size, max(60, configs.hub.poll_lookback * 2))
+
+def publish_comment(comment):
+    if hub.first_seen(comment.id, comment.created_at):
+        published_total.inc('comment')
+        hub.publish('blog:%s' % comment.blog_id, model_frame('comment', comment))
+
+def publish_blog(blog):
+    if hub.first_seen(blog.id, blog.created_at):
+        # 列表页只需要摘要，不推送正文
+        published_total.inc('blog')
+        summary = dict((k, blog.getValue(k)) for k in ('id', 'user_id', 'user_name', 'user_image', 'name', 'summary', 'created_at'))
+        hub.publish('blogs', sse_frame('blog', json_dumps(summary), blog.id))
+
+@orm.add_listener
+def _publish_new_rows(event, model):
+    if event != 'save':
+        return
+    if isinstance(model, Comment):
+        publish_comment(model)
+    elif isinstance(model, Blog):
+        publish_blog(model)
+
+class Poller(object):
+    '''
+    Publishes rows saved by other workers, found by polling created_at with an overlapping window.
+    '''
+
+    def __init__(self, lookback=5, limit=500):
+        self.lookback = lookback
+        self.limit = limit
+        self.since = time.time()
+
+    async def poll(self):
+        now = time.time()
+        since, self.since = self.since - self.lookback, now
+        # 没有订阅者就不查
+        if hub.has_subscribers('blogs'):
+            for blog in (await self._new_rows(Blog, since)):
+                publish_blog(blog)
+        if hub.has_subscribers('blog:'):
+            for comment in (await self._new_rows(Comment, since)):
+                publish_comment(comment)
+
+    async def _new_rows(self, model, since):
+        rows = await model.findAll('created_at>?', [since], orderBy='created_at', limit=self.limit)
+        if len(rows) >= self.limit:
+            logging.warning('hub: more than %s new %s in %.1fs, some were not pushed' % (self.limit, model.__table__, time.time() - since))
+        return rows
+
+def register(scheduler):
+    o = configs.hub
+    if o.poll_interval:
+        poller = Poller(o.poll_lookback, o.poll_limit)
+        # 每个worker都要轮询自己的订阅者，不加锁
+        scheduler.add('hub:poll', poller.poll, interval=o.poll_interval, lock=False)
@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Pluggable primary key generators.
+
+snowflake: 64-bit, time-ordered, monotonic id:
+    41 bits milliseconds since EPOCH | 10 bits worker id | 12 bits per-process sequence
+stored either as bigint or as a 13-char Crockford base32 string (char(13)), both sort by creation time.
+legacy: the original 50-char '%015d%s000' format (timestamp + uuid4 hex).
+
+Unless configs.id.worker_id is set, each process claims a free worker id at start up with
+claim_worker_id(), which holds the MySQL named lock 'idgen:worker:<n>' for the life of the process;
+generating an id before that raises RuntimeError instead of risking duplicates across workers.
+'''
+
+__author__ = 'Hongqing Wang'
+
+import time, uuid, threading, logging
+
+import orm
+from orm import StringField, IntegerField
+
+# 2016-01-01 00:00:00 UTC，41位毫秒数可以用到2085年
+EPOCH = 1451606400000
+
+WORKER_BITS = 10
+SEQUENCE_BITS = 12
+MAX_WORKER = (1 << WORKER_BITS) - 1
+MAX_SEQUENCE = (1 << SEQUENCE_BITS) - 1
+
+# Crockford base32字母表是按ASCII递增的，所以定长编码后字符串顺序和整数顺序一致
+_B32 = '0123456789ABCDEFGHJKMNPQRSTVWXYZ'
+_B32_INDEX = dict((c, i) for i, c in enumerate(_B32))
+B32_LENGTH = 13
+
+def b32encode(n):
+    L = []
+    for i in range(B32_LENGTH):
+        L.append(_B32[n & 31])
+        n >>= 5
+    return ''.join(reversed(L))
+
+def b32decode(s):
+    n = 0
+    for c in s.upper():
+        n = (n << 5) | _B32_INDEX[c]
+    return n
+
+class LegacyIdGenerator(object):
+    '''
+    The original id: 15-digit ms timestamp + uuid4 hex + '000', stored as varchar(50).
+    '''
+
+    def next_id(self):
+        return '%015d%s000' % (int(time.time() * 1000), uuid.uuid4().hex)
+
+    def from_timestamp(self, t, seq=0):
+        return '%015d%s000' % (int(t * 1000), uuid.uuid4().hex)
+
+    def field(self, **kw):
+        return StringField(ddl='varchar(50)', **kw)
+
+class SnowflakeIdGenerator(object):
+    '''
+    Time-ordered 64-bit id with a per-process sequence and a worker id.
+    '''
+
+    def __init__(self, worker_id=None, storage='base32'):
+        if worker_id is not None and (worker_id < 0 or worker_id > MAX_WORKER):
+            raise ValueError('worker_id must be in 0..%s' % MAX_WORKER)
+        if storage not in ('base32', 'bigint'):
+            raise ValueError('Invalid id storage: %s' % storage)
+        self.worker_id = worker_id
+        self.storage = storage
+        self._last_ms = 0
+        self._sequence = 0
+        # next_id()也可能在executor线程里被调用，这里的锁只保护几条整数运算
+        self._lock = threading.Lock()
+
+    def next_int(self):
+        if self.worker_id is None:
+            raise RuntimeError('No worker id: call idgen.claim_worker_id() at start up or set configs.id.worker_id.')
+        with self._lock:
+            ms = int(time.time() * 1000) - EPOCH
+            if ms <= self._last_ms:
+                # 时钟回拨或同一毫秒内：沿用上一个毫秒继续递增序号，保证单调
+                ms = self._last_ms
+                self._sequence = self._sequence + 1
+                if self._sequence > MAX_SEQUENCE:
+                    # 序号用完了就借用下一毫秒，不在事件循环里sleep等待
+                    ms = ms + 1
+                    self._sequence = 0
+            else:
+                self._sequence = 0
+            self._last_ms = ms
+            return (ms << (WORKER_BITS + SEQUENCE_BITS)) | (self.worker_id << SEQUENCE_BITS) | self._sequence
+
+    def encode(self, n):
+        return n if self.storage == 'bigint' else b32encode(n)
+
+    def decode(self, value):
+        return int(value) if self.storage == 'bigint' else b32decode(value)
+
+    def next_id(self):
+        return self.encode(self.next_int())
+
+    # 用历史数据的created_at生成id，供migrate_ids.py迁移旧数据使用，seq用来区分同一毫秒内的多行
+    # 同一毫秒超过4096行时溢出的部分进位到后面的毫秒，调用方要保证后面的行接着这个序号往下排
+    def from_timestamp(self, t, seq=0):
+        ms = max(int(t * 1000) - EPOCH, 0) + (seq >> SEQUENCE_BITS)
+        return self.encode((ms << (WORKER_BITS + SEQUENCE_BITS)) | ((self.worker_id or 0) << SEQUENCE_BITS) | (seq & MAX_SEQUENCE))
+
+    # 从id中取回生成时间（秒）
+    def timestamp(self, value):
+        return ((self.decode(value) >> (WORKER_BITS + SEQUENCE_BITS)) + EPOCH) / 1000.0
+
+    def field(self, **kw):
+        if self.storage == 'bigint':
+            return IntegerField(**kw)
+        return StringField(ddl='char(%s)' % B32_LENGTH, **kw)
+
+def create_generator(name='snowflake', **kw):
+    if name == 'legacy':
+        return LegacyIdGenerator()
+    if name == 'snowflake':
+        return SnowflakeIdGenerator(worker_id=kw.get('worker_id'), storage=kw.get('storage', 'base32'))
+    raise ValueError('Unknown id generator: %s' % name)
+
+_generator = None
+
+def get_generator():
+    global _generator
+    if _generator is None:
+        from config import configs
+        options = dict(configs.get('id', {}))
+        _generator = create_generator(options.pop('generator', 'snowflake'), **options)
+        logging.info('id generator: %s' % _generator.__class__.__name__)
+    return _generator
+
+def set_generator(generator):
+    global _generator
+    _generator = generator
+
+def next_id():
+    return get_generator().next_id()
+
+# 持有worker id命名锁的对象，进程退出、连接断开时MySQL自动释放
+_worker_lock = None
+
+# 依次尝试idgen:worker:0..1023，拿到的第一个就是本进程的worker id；配置里写了worker_id或不是snowflake时什么也不做
+async def claim_worker_id(generator=None):
+    global _worker_lock
+    generator = generator or get_generator()
+    if not isinstance(generator, SnowflakeIdGenerator) or generator.worker_id is not None:
+        return getattr(generator, 'worker_id', None)
+    for n in range(MAX_WORKER + 1):
+        lock = orm.advisory_lock('idgen:worker:%s' % n)
+        if await lock.__aenter__():
+            _worker_lock = lock
+            generator.worker_id = n
+            logging.info('claimed id worker %s' % n)
+            return n
+    raise RuntimeError('All %s id worker ids are in use.' % (MAX_WORKER + 1))
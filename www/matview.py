@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Materialized query results shared by all workers through the `materialized_views` table.
+
+    @materialize('users:all', tables=('users',))
+    async def all_users():
+        return await User.findAll()
+
+    users = await all_users.get()
+
+A scheduler job recomputes the view every configs.views.interval seconds (and soon after a write
+to one of `tables`) under an advisory lock, and stores it as one JSON row. Workers serve the view
+from memory and reload the row at most every configs.views.ttl seconds, so a cold worker reads
+one row by primary key instead of running the query itself.
+'''
+
+__author__ = 'Hongqing Wang'
+
+import json, time, asyncio, logging
+
+import orm
+from config import configs
+from apis import json_dumps
+from models import MaterializedView
+from scheduler import scheduler
+
+def _dumps(value):
+    # 和response_factory输出JSON的方式一致：Page之类的对象按__dict__保存，超过2^53的整数存成字符串
+    return json_dumps(value)
+
+class View(object):
+
+    def __init__(self, name, compute, tables=(), ttl=5):
+        self.name = name
+        self.compute = compute
+        self.tables = tables
+        self.ttl = ttl
+        self._value = None
+        self._loaded = 0
+        self._pending = None
+
+    async def refresh(self):
+        data = _dumps(await self.compute())
+        await orm.execute('replace into `%s` (`name`, `value`, `updated_at`) values (?, ?, ?)' % MaterializedView.__table__, [self.name, data, time.time()])
+        self._set(data)
+
+    def _set(self, data):
+        self._value = json.loads(data)
+        self._loaded = time.time()
+
+    async def _load(self):
+        row = await MaterializedView.find(self.name)
+        if row is None:
+            # 还从来没有计算过（如新建的库），直接计算一次
+            logging.info('materialized view %s missing, computing.' % self.name)
+            await scheduler.run(self.name)
+            if self._value is None:
+                # 锁在别的worker手里，先自己算出结果用着
+                self._set(_dumps(await self.compute()))
+        else:
+            self._set(row.value)
+
+    async def get(self):
+        if self._value is not None and time.time() - self._loaded < self.ttl:
+            return self._value
+        if self._pending is None:
+            self._pending = asyncio.ensure_future(self._load())
+            self._pending.add_done_callback(lambda f: setattr(self, '_pending', None))
+        try:
+            await asyncio.shield(self._pending)
+        except Exception as e:
+            # 数据库暂时不可用时继续使用旧的结果
+            if self._value is None:
+                raise
+            logging.warning('failed to reload materialized view %s: %s' % (self.name, e))
+        return self._value
+
+views = dict()
+
+def materialize(name, tables=(), interval=None, ttl=None):
+    def decorator(compute):
+        view = views[name] = View(name, compute, tables, configs.views.ttl if ttl is None else ttl)
+        scheduler.add(name, view.refresh, interval=interval or configs.views.interval, warm=True)
+        return view
+    return decorator
+
+@orm.add_listener
+def _refresh_views(event, model):
+    for view in views.values():
+        if model.__table__ in view.tables:
+            scheduler.trigger(view.name)
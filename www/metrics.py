@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+In-process metrics: counters, gauges and histograms, rendered in Prometheus text format.
+
+All updates happen on the event loop thread, so there are no locks: an observation
+is a bisect plus a few integer additions.
+'''
+
+__author__ = 'Hongqing Wang'
+
+import asyncio, time, bisect, logging
+
+from aiohttp import web
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+def _labels(names, values, extra=None):
+    pairs = list(zip(names, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (k, _escape(v)) for k, v in pairs)
+
+def _number(v):
+    if v == float('inf'):
+        return '+Inf'
+    return repr(float(v)) if isinstance(v, float) else str(v)
+
+class Histogram(object):
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        # 最后一个位置对应+Inf
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+class Metric(object):
+    '''
+    A named metric family, children are keyed by a tuple of label values.
+    '''
+
+    def __init__(self, name, help, kind, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.kind = kind
+        self.labelnames = tuple(labelnames)
+        self.buckets = buckets
+        self.children = dict()
+
+    def inc(self, *labels, value=1):
+        self.children[labels] = self.children.get(labels, 0) + value
+
+    def dec(self, *labels, value=1):
+        self.children[labels] = self.children.get(labels, 0) - value
+
+    def set(self, *labels, value):
+        self.children[labels] = value
+
+    def observe(self, *labels, value):
+        h = self.children.get(labels)
+        if h is None:
+            h = self.children[labels] = Histogram(self.buckets)
+        h.observe(value)
+
+    def render(self):
+        L = ['# HELP %s %s' % (self.name, self.help), '# TYPE %s %s' % (self.name, self.kind)]
+        for labels, child in sorted(self.children.items(), key=lambda kv: kv[0]):
+            if self.kind != 'histogram':
+                L.append('%s%s %s' % (self.name, _labels(self.labelnames, labels), _number(child)))
+                continue
+            cumulative = 0
+            for bound, n in zip(self.buckets + (float('inf'),), child.counts):
+                cumulative += n
+                L.append('%s_bucket%s %s' % (self.name, _labels(self.labelnames, labels, ('le', _number(bound))), cumulative))
+            L.append('%s_sum%s %s' % (self.name, _labels(self.labelnames, labels), _number(child.sum)))
+            L.append('%s_count%s %s' % (self.name, _labels(self.labelnames, labels), child.count))
+        return '\n'.join(L)
+
+class Registry(object):
+
+    def __init__(self):
+        self.metrics = dict()
+
+    def _get(self, name, help, kind, labelnames, **kw):
+        m = self.metrics.get(name)
+        if m is None:
+            m = self.metrics[name] = Metric(name, help, kind, labelnames, **kw)
+        elif m.kind != kind:
+            raise ValueError('Metric %s already registered as %s' % (name, m.kind))
+        return m
+
+    def counter(self, name, help, labelnames=()):
+        return self._get(name, help, 'counter', labelnames)
+
+    def gauge(self, name, help, labelnames=()):
+        return self._get(name, help, 'gauge', labelnames)
+
+    def histogram(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._get(name, help, 'histogram', labelnames, buckets=buckets)
+
+    def render(self):
+        return '\n'.join(m.render() for m in self.metrics.values()) + '\n'
+
+REGISTRY = Registry()
+
+http_requests = REGISTRY.counter('http_requests_total', 'HTTP requests by route template, method and status.', ('route', 'method', 'status'))
+http_latency = REGISTRY.histogram('http_request_duration_seconds', 'HTTP request latency by route template.', ('route', 'method'))
+http_in_flight = REGISTRY.gauge('http_requests_in_flight', 'HTTP requests currently being handled.', ('route',))
+sql_latency = REGISTRY.histogram('sql_query_duration_seconds', 'SQL latency by statement template.', ('sql',))
+sql_errors = REGISTRY.counter('sql_query_errors_total', 'Failed SQL statements by statement template.', ('sql',))
+loop_lag = REGISTRY.gauge('event_loop_lag_seconds', 'How late the last event loop heartbeat fired.')
+loop_lag_histogram = REGISTRY.histogram('event_loop_lag_distribution_seconds', 'Distribution of event loop heartbeat delays.')
+
+# 取得路由模板（如/blog/{id}）而不是实际路径，避免每个id都生成一组指标
+def route_template(request):
+    route = getattr(request.match_info, 'route', None)
+    resource = getattr(route, 'resource', None)
+    if resource is None:
+        return '<unmatched>'
+    info = resource.get_info()
+    return info.get('formatter') or info.get('path') or info.get('prefix') or '<unknown>'
+
+async def metrics_factory(app, handler):
+    async def metrics(request):
+        route = route_template(request)
+        http_in_flight.inc(route)
+        start = time.time()
+        status = 500
+        try:
+            r = await handler(request)
+            status = getattr(r, 'status', 200)
+            return r
+        except web.HTTPException as e:
+            status = e.status
+            raise
+        finally:
+            http_in_flight.dec(route)
+            http_latency.observe(route, request.method, value=time.time() - start)
+            http_requests.inc(route, request.method, str(status))
+    return metrics
+
+def observe_sql(sql, elapsed, error=False):
+    sql_latency.observe(sql, value=elapsed)
+    if error:
+        sql_errors.inc(sql)
+
+# 每隔interval秒醒来一次，醒来晚了多少就是事件循环被阻塞了多久
+async def monitor_loop(loop, interval=0.5):
+    while True:
+        start = loop.time()
+        await asyncio.sleep(interval)
+        lag = max(loop.time() - start - interval, 0.0)
+        loop_lag.set(value=lag)
+        loop_lag_histogram.observe(value=lag)
+        if lag > 0.1:
+            logging.warning('event loop lag: %.3fs' % lag)
+
+def render():
+    return REGISTRY.render()
@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Migrate existing primary keys to the configured id generator.
+
+    python3 migrate_ids.py          # rewrite ids, then print the ALTER TABLE statements
+    python3 migrate_ids.py --dry-run
+
+New ids are derived from created_at so the new keys keep the creation order.
+Every shard and archive table is rewritten; a row whose shard key changes (a blog's id, a
+comment's blog_id) is moved to the shard of its new key.
+Run it with the application stopped, the statements are not wrapped in one transaction.
+'''
+
+__author__ = 'Hongqing Wang'
+
+import sys, asyncio, logging
+
+import orm, idgen, archive
+from config import configs
+from models import User, Blog, Comment
+
+# 引用关系：(表, 列) => 被引用的表，主键改变后这些列要跟着改
+REFERENCES = [
+    ('blogs', 'user_id', 'users'),
+    ('comments', 'user_id', 'users'),
+    ('comments', 'blog_id', 'blogs'),
+]
+
+# 表所在的(表名, pool)：分片的表在每个分片上都有，按表归档时还有归档表
+def sources(model):
+    tables = [model.__table__]
+    archived = orm.archive_table(model)
+    if archived is not None:
+        tables.append(archived)
+    return [(t, p) for t in tables for p in (model._pools() or [None])]
+
+# 为一张表的所有行生成新id，返回{旧id: 新id}
+# 按created_at排序后逐行分配(毫秒, 序号)，同一毫秒的行序号递增，超过4096行时进位到后面的毫秒，
+# 之后的行从进位后的位置接着排，所以不会有重复的id
+async def build_mapping(model, generator):
+    pk = model.__primary_key__
+    rs = []
+    for table, pool in sources(model):
+        rs.extend(await orm.select('select `%s`, `created_at` from `%s`' % (pk, table), [], pool=pool))
+    rs.sort(key=lambda r: (r['created_at'], r[pk]))
+    mapping = dict()
+    last = -1
+    for r in rs:
+        start = max(int(r['created_at'] * 1000), idgen.EPOCH) << idgen.SEQUENCE_BITS
+        slot = max(start, last + 1)
+        last = slot
+        mapping[r[pk]] = generator.from_timestamp(r['created_at'], slot - start)
+    return mapping
+
+# 改写一张表的主键和引用它表的列，返回被移到其他分片的行数
+# 分片键的值变了以后行可能属于另一个分片：整行插入新的分片，再从原来的分片删除
+async def rewrite(model, mappings, batch=500):
+    pk = model.__primary_key__
+    columns = [(pk, mappings[model.__table__])] + [(c, mappings[target]) for t, c, target in REFERENCES if t == model.__table__]
+    moved = 0
+    for table, pool in sources(model):
+        ids = [r[pk] for r in (await orm.select('select `%s` from `%s`' % (pk, table), [], pool=pool))]
+        for i in range(0, len(ids), batch):
+            chunk = ids[i:i + batch]
+            rs = await orm.select('select * from `%s` where `%s` in (%s)' % (table, pk, orm.create_args_string(len(chunk))), chunk, pool=pool)
+            for r in rs:
+                row = dict(r)
+                for c, mapping in columns:
+                    if r[c] in mapping:
+                        # 新id先以字符串写进原来的varchar(50)列，bigint的情况下稍后ALTER会把数字字符串转换成整数
+                        row[c] = str(mapping[r[c]])
+                dest = pool if pool is None else model._pool_for(row[model.__shard_key__])
+                if dest is pool:
+                    sets = ', '.join('`%s`=?' % c for c, mapping in columns)
+                    await orm.execute('update `%s` set %s where `%s`=?' % (table, sets, pk), [row[c] for c, mapping in columns] + [r[pk]], pool=pool)
+                else:
+                    names = list(row)
+                    await orm.execute('insert into `%s` (%s) values (%s)' % (table, ', '.join('`%s`' % n for n in names), orm.create_args_string(len(names))),
+                                      [row[n] for n in names], pool=dest)
+                    await orm.execute('delete from `%s` where `%s`=?' % (table, pk), [r[pk]], pool=pool)
+                    moved += 1
+    return moved
+
+MODELS = (User, Blog, Comment)
+
+async def run(generator, dry_run=False):
+    mappings = dict()
+    for m in MODELS:
+        mappings[m.__table__] = await build_mapping(m, generator)
+        logging.info('%s: %s ids to migrate' % (m.__table__, len(mappings[m.__table__])))
+    if not dry_run:
+        for m in MODELS:
+            moved = await rewrite(m, mappings)
+            logging.info('%s: ids rewritten, %s rows moved to another shard' % (m.__table__, moved))
+    return mappings
+
+async def migrate(loop, dry_run=False):
+    await orm.create_pool(loop=loop, **configs.db)
+    await orm.create_shard_pools(loop, configs.shards, configs.db)
+    archive.configure()
+    generator = idgen.get_generator()
+    await idgen.claim_worker_id(generator)
+    await run(generator, dry_run)
+    # 最后把列类型收缩到新格式，交给DBA在低峰期执行；分片的表和归档表在每个库上都要执行
+    print('-- run after the data migration:')
+    for m in MODELS:
+        columns = [m.__primary_key__] + [c for t, c, target in REFERENCES if t == m.__table__]
+        for table in sorted(set(t for t, p in sources(m))):
+            for c in columns:
+                print('alter table `%s` modify `%s` %s not null;' % (table, c, m.__mappings__[c].column_type))
+
+if __name__ == '__main__':
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(migrate(loop, dry_run='--dry-run' in sys.argv))
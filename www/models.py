@@ -7,46 +7,71 @@ Models for user, blog, comment.
 
 __author__ = 'Hongqing Wang'
 
-import time, uuid
+import time
 
-from orm import Model, StringField, BooleanField, FloatField, TextField
+from orm import Model, StringField, BooleanField, FloatField, TextField, CounterField
+import idgen
 
-# 由时间和uuid生成一个唯一id号
-# %015d表示生成一个15字节的字符串，time.time()生成的时间单位为秒，时间起点是1970年1月1日0点
-# uuid.uuid4().hex生成一个32字节的随机数字符串
+# 生成一个唯一id号，具体格式由配置中的id生成器决定，见idgen.py
+# 默认是按时间递增的snowflake id，以13位base32字符串保存，比原来50位的时间戳+uuid紧凑得多
 def next_id():
-    return '%015d%s000' % (int(time.time() * 1000), uuid.uuid4().hex)
+    return idgen.next_id()
+
+# 主键列，列类型跟随id生成器（char(13)、bigint或旧的varchar(50)）
+def id_field():
+    return idgen.get_generator().field(primary_key=True, default=next_id)
+
+# 引用其他表主键的列，类型必须和主键一致
+def ref_field(**kw):
+    return idgen.get_generator().field(**kw)
 
 class User(Model):
     __table__ = 'users'
+    # 配置了分片时按id分布；email的唯一索引只在单个分片内有效
+    __shard_key__ = 'id'
 
-    id = StringField(primary_key=True, default=next_id, ddl='varchar(50)')
-    email = StringField(ddl='varchar(50)')
-    passwd = StringField(ddl='varchar(50)')
+    id = id_field()
+    email = StringField(ddl='varchar(50)', index='unique')
+    passwd = StringField(ddl='varchar(100)')
     admin = BooleanField()
     name = StringField(ddl='varchar(50)')
     image = StringField(ddl='varchar(500)')
-    created_at = FloatField(default=time.time)
+    created_at = FloatField(default=time.time, index=True)
 
 class Blog(Model):
     __table__ = 'blogs'
 
-    id = StringField(primary_key=True, default=next_id, ddl='varchar(50)')
-    user_id = StringField(ddl='varchar(50)')
+    id = id_field()
+    user_id = ref_field(index=True)
     user_name = StringField(ddl='varchar(50)')
     user_image = StringField(ddl='varchar(500)')
     name = StringField(ddl='varchar(50)')
     summary = StringField(ddl='varchar(200)')
-    content = TextField()
-    created_at = FloatField(default=time.time)
+    content = TextField(ddl='mediumtext')
+    created_at = FloatField(default=time.time, index=True)
+    # 评论数和阅读数由counters模块在内存中累加后批量写回
+    comment_count = CounterField()
+    view_count = CounterField()
 
 class Comment(Model):
     __table__ = 'comments'
+    # 同一篇博客的评论在同一个分片上，按博客查评论只需要查一个分片
+    __shard_key__ = 'blog_id'
+    # 评论变化时还要让'comments:<blog_id>'标签下的片段缓存失效，见fragcache.py
+    __fragment_parent__ = 'blog_id'
 
-    id = StringField(primary_key=True, default=next_id, ddl='varchar(50)')
-    blog_id = StringField(ddl='varchar(50)')
-    user_id = StringField(ddl='varchar(50)')
+    id = id_field()
+    blog_id = ref_field(index=True)
+    user_id = ref_field()
     user_name = StringField(ddl='varchar(50)')
     user_image = StringField(ddl='varchar(500)')
-    content = TextField()
-    created_at = FloatField(default=time.time)
\ No newline at end of file
+    content = TextField(ddl='mediumtext')
+    created_at = FloatField(default=time.time, index=True)
+
+# 预先计算好的查询结果，由matview模块按名字整行替换，value为JSON
+class MaterializedView(Model):
+    __table__ = 'materialized_views'
+
+    name = StringField(primary_key=True, ddl='varchar(100)')
+    value = TextField(ddl='mediumtext')
+    updated_at = FloatField(default=time.time)
@@ -3,21 +3,33 @@
 
 __author__ = 'Hongqing Wang'
 
-import asyncio, logging
+import asyncio, logging, re, time, zlib, contextvars
 
 import aiomysql
 
+import metrics
+
 import logging
 logging.basicConfig(level=logging.INFO)
 # 编写log函数：用于打印sql语句
 def log(sql, args=()):
     logging.info('SQL: %s' % sql)
 
+__pool = None
+# 创建pool时的参数，超时后KILL QUERY需要另开一条连接；id(pool) => 参数
+__pool_kws = dict()
+# 水平分片：分片名 => pool，表名 => 该表分布到的分片名列表
+__shards = dict()
+__shard_tables = dict()
+
 # 编写create_pool() coroutine：用于创建连接池中到各种参数
 async def create_pool(loop, **kw):
     logging.info('create database connection pool...')
     global __pool
-    __pool = await aiomysql.create_pool(
+    __pool = await _create_pool(loop, kw)
+
+async def _create_pool(loop, kw):
+    pool = await aiomysql.create_pool(
         host=kw.get('host', 'localhost'),
         port=kw.get('port', 3306),
         user=kw['user'],
@@ -27,22 +39,197 @@ async def create_pool(loop, **kw):
         autocommit=kw.get('autocommit', True),
         maxsize=kw.get('maxsize', 10),
         minsize=kw.get('minsize', 1),
+        # dbtool.py用LOAD DATA LOCAL INFILE导入时需要打开
+        local_infile=kw.get('local_infile', False),
         loop=loop
     )
     # aiomysqld的create_pool()方法，a coroutine that creates a pool of connections to MySQL database，返回一个pool实例
     # 详见http://aiomysql.readthedocs.io/en/latest/pool.html?highlight=create_pool#create_pool
+    __pool_kws[id(pool)] = dict(kw)
+    return pool
+
+# 直接使用一个已经创建好的pool，只要实现了aiomysql pool的get()/cursor()接口即可，如benchmark用的sqlitepool
+def set_pool(pool):
+    global __pool
+    __pool = pool
+
+def get_pool():
+    return __pool
+
+# 按配置中的shards为每个分片库创建pool，连接参数没有写的项取defaults（即configs.db）里的
+async def create_shard_pools(loop, shards, defaults):
+    for name, options in shards.get('databases', {}).items():
+        kw = dict(defaults)
+        kw.update(options)
+        logging.info('create connection pool for shard %s...' % name)
+        set_shard_pool(name, await _create_pool(loop, kw))
+    set_shard_tables(shards.get('tables', {}))
+
+def set_shard_pool(name, pool):
+    __shards[name] = pool
+
+def set_shard_tables(tables):
+    __shard_tables.clear()
+    for table, names in tables.items():
+        __shard_tables[table] = list(names)
+
+# 返回表所在的各个分片的pool，没有分片的表返回None
+def get_shard_pools(table):
+    names = __shard_tables.get(table)
+    if not names:
+        return None
+    return [__shards[n] for n in names]
+
+# 分片键的值 => 分片序号，用crc32而不是hash()，保证每个进程算出来的都一样
+def shard_index(value, count):
+    return zlib.crc32(str(value).encode('utf-8')) % count
+
+# 请求的截止时间（loop.time()的绝对值），由coroweb.RequestHandler按路由的timeout设置
+# contextvar会随着请求所在的task传递，所以同一个请求里发出的每条sql都能拿到剩余的时间预算
+_deadline = contextvars.ContextVar('deadline', default=None)
+
+class DeadlineExceeded(Exception):
+    pass
+
+# 已经有更早的截止时间时（如/api/batch中的子请求）保留更早的那个
+def set_deadline(timeout):
+    deadline = asyncio.get_event_loop().time() + timeout
+    current = _deadline.get()
+    if current is not None and current < deadline:
+        deadline = current
+    return _deadline.set(deadline)
+
+def reset_deadline(token):
+    _deadline.reset(token)
+
+# 返回剩余的秒数，没有设置截止时间时返回None
+def remaining_time():
+    deadline = _deadline.get()
+    if deadline is None:
+        return None
+    return deadline - asyncio.get_event_loop().time()
+
+def _check_budget():
+    budget = remaining_time()
+    if budget is not None and budget <= 0:
+        raise DeadlineExceeded('request deadline exceeded')
+    return budget
+
+class _Connection(object):
+    '''
+    async with _Connection(pool) as conn: like pool.get(), but waiting for a free connection is bounded by the deadline.
+    pool=None means the default pool.
+    '''
+
+    def __init__(self, pool=None):
+        self._pool = pool
+
+    async def __aenter__(self):
+        budget = _check_budget()
+        if budget is None:
+            self._conn = await _acquire(self._pool)
+        else:
+            try:
+                self._conn = await asyncio.wait_for(_acquire(self._pool), budget)
+            except asyncio.TimeoutError:
+                raise DeadlineExceeded('request deadline exceeded while waiting for a connection')
+        return self._conn
+
+    async def __aexit__(self, exc_type, exc, tb):
+        _release(self._conn, self._pool)
+
+# 类定义里的__pool会被改名为_Connection__pool，所以通过模块级函数访问
+async def _acquire(pool=None):
+    return await (__pool if pool is None else pool).acquire()
+
+def _release(conn, pool=None):
+    (__pool if pool is None else pool).release(conn)
+
+def _get_pool_kw(pool=None):
+    return __pool_kws.get(id(__pool if pool is None else pool))
+
+# KILL QUERY用的连接的连接超时（秒），数据库连不上时不能让请求一直挂着
+KILL_CONNECT_TIMEOUT = 2
+
+# 在另一条独立的连接上执行KILL QUERY，不占用pool里的连接，pool满的时候也能执行
+async def _kill_query(conn, kw):
+    thread_id = getattr(conn, 'thread_id', None)
+    if thread_id is None or kw is None:
+        return False
+    try:
+        killer = await aiomysql.connect(host=kw.get('host', 'localhost'), port=kw.get('port', 3306), user=kw['user'],
+                                        password=kw['password'], db=kw['db'], charset=kw.get('charset', 'utf8'),
+                                        connect_timeout=KILL_CONNECT_TIMEOUT)
+        try:
+            async with killer.cursor() as cur:
+                await cur.execute('KILL QUERY %s' % int(thread_id()))
+        finally:
+            killer.close()
+        return True
+    except Exception as e:
+        logging.warning('failed to kill query on connection %s: %s' % (thread_id(), e))
+        return False
+
+# 按剩余时间预算执行cur.execute()，超时后在服务器端中断查询
+async def _execute_with_deadline(conn, cur, sql, args, pool=None):
+    budget = _check_budget()
+    if budget is None:
+        return await cur.execute(sql, args)
+    task = asyncio.ensure_future(cur.execute(sql, args))
+    try:
+        done, pending = await asyncio.wait([task], timeout=budget)
+    except asyncio.CancelledError:
+        # 外层被取消时查询还在这条连接上跑，不能把它还给pool
+        task.cancel()
+        conn.close()
+        raise
+    if task in done:
+        return task.result()
+    logging.warning('SQL deadline exceeded, killing query: %s' % sql)
+    if await _kill_query(conn, _get_pool_kw(pool)):
+        # 被KILL QUERY中断的查询会以1317错误返回，读完这个错误后连接仍然可以正常放回pool
+        done, pending = await asyncio.wait([task], timeout=1)
+    if task in done:
+        if not task.cancelled():
+            task.exception()
+    else:
+        # 无法中断（或中断后迟迟没有返回）：取消并关闭这条连接，release时pool会丢弃已关闭的连接
+        task.cancel()
+        conn.close()
+    raise DeadlineExceeded('request deadline exceeded')
+
+# 请求范围内的identity map：同一个请求（包括/api/batch的所有子请求）里按主键查到的对象只查一次数据库
+_identity_map = contextvars.ContextVar('identity_map', default=None)
+
+def begin_identity_scope():
+    return _identity_map.set(dict())
+
+def end_identity_scope(token):
+    _identity_map.reset(token)
 
 # 编写select() coroutine：用于提取出指定数据库中的指定行数据或者全部行数据
-async def select(sql, args, size=None):
+# pool为None时使用默认的pool，分片的表由Model传入所在分片的pool
+async def select(sql, args, size=None, pool=None):
     log(sql, args)
-    global __pool
-    async with __pool.get() as conn:
+    start = time.time()
+    error = True
+    try:
+        rs = await _select(sql, args, size, pool)
+        error = False
+        return rs
+    finally:
+        # 按sql模板记录耗时，findAll中直接写在where里的字面量会先被归一化
+        metrics.observe_sql(normalize_sql(sql), time.time() - start, error)
+
+async def _select(sql, args, size=None, pool=None):
+    async with _Connection(pool) as conn:
         # 没有找到pool.get()方法，怀疑是acquire（）方法，本身即为一个coroutine，用于创建返回一个Connection实例
         # 详见http://aiomysql.readthedocs.io/en/latest/pool.html#Pool
         # async with是python3.5新加入到语法，可参考http://my.oschina.net/cppblog/blog/469926
+        # _Connection()相当于pool.get()，只是等待空闲连接的时间受请求截止时间的限制
         async with conn.cursor(aiomysql.DictCursor) as cur:
             # 创建一个dict类型的cursor，可参考http://aiomysql.readthedocs.io/en/latest/cursors.html?highlight=dic#DictCursor
-            await cur.execute(sql.replace('?', '%s'), args or ())
+            await _execute_with_deadline(conn, cur, sql.replace('?', '%s'), args or (), pool)
             # execute(query,args=None)方法用于执行sql语句，sql语句中到占位符是？，MySQL的占位符是%s，sql.replace()用于将？替换为%s
             # 详见http://aiomysql.readthedocs.io/en/latest/cursors.html?highlight=dic#Cursor.execute
             if size:
@@ -58,17 +245,42 @@ async def select(sql, args, size=None):
         logging.info('rows returned: %s' % len(rs))
         return rs
 
+# 用服务器端游标（SSDictCursor）逐批读取大结果集，不会一次把所有行读进内存：
+#     async for rows in stream('select ...', args, 1000):
+#         ...
+# 游标没有读完之前连接一直被占用，不受请求截止时间限制，只用于dbtool.py这样的离线任务
+async def stream(sql, args, size=1000, pool=None):
+    log(sql, args)
+    async with _Connection(pool) as conn:
+        async with conn.cursor(aiomysql.SSDictCursor) as cur:
+            await cur.execute(sql.replace('?', '%s'), args or ())
+            while True:
+                rs = await cur.fetchmany(size)
+                if not rs:
+                    break
+                yield rs
+
 # 编写execute() coroutine：用于执行insert，update，delete语句（以sql语句写入），返回一个整数表示影响的行数
-async def execute(sql, args, autocommit=True):
+async def execute(sql, args, autocommit=True, pool=None):
     log(sql)
-    async with __pool.get() as conn:
+    start = time.time()
+    error = True
+    try:
+        affected = await _execute(sql, args, autocommit, pool)
+        error = False
+        return affected
+    finally:
+        metrics.observe_sql(normalize_sql(sql), time.time() - start, error)
+
+async def _execute(sql, args, autocommit=True, pool=None):
+    async with _Connection(pool) as conn:
         if not autocommit:
             # 如果不是自动提交，则采用手动提交，手动提交采用conn.begin()与conn.commit()/conn.rollback()配合使用
             # 详见http://aiomysql.readthedocs.io/en/latest/sa.html?highlight=conn.begin#aiomysql.sa.SAConnection.begin
             await conn.begin()
         try:
             async with conn.cursor(aiomysql.DictCursor) as cur:
-                await cur.execute(sql.replace('?', '%s'), args)
+                await _execute_with_deadline(conn, cur, sql.replace('?', '%s'), args, pool)
                 affected = cur.rowcount
                 # cur.rowcount用于获得影响的行数
             if not autocommit:
@@ -80,6 +292,107 @@ async def execute(sql, args, autocommit=True):
             raise e
         return affected
 
+# 在同一条连接上执行多条语句，全部成功才提交，出错时回滚：
+#     async with transaction() as tx:
+#         rs = await tx.select('select `id` from `comments` where ... for update', args)
+#         await tx.execute('delete from `comments` where ...', args)
+class transaction(object):
+
+    def __init__(self, pool=None):
+        self._pool = pool
+        self._conn = None
+
+    async def __aenter__(self):
+        self._ctx = _Connection(self._pool)
+        self._conn = await self._ctx.__aenter__()
+        try:
+            await self._conn.begin()
+        except BaseException:
+            await self._ctx.__aexit__(None, None, None)
+            raise
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        try:
+            if exc_type is None:
+                await self._conn.commit()
+            else:
+                try:
+                    await self._conn.rollback()
+                except Exception as e:
+                    # 连接已经因为超时被关闭，服务器端会自动回滚
+                    logging.warning('rollback failed: %s' % e)
+        finally:
+            await self._ctx.__aexit__(exc_type, exc, tb)
+
+    async def _run(self, sql, args, fetch, size=None):
+        start = time.time()
+        error = True
+        try:
+            async with self._conn.cursor(aiomysql.DictCursor) as cur:
+                await _execute_with_deadline(self._conn, cur, sql.replace('?', '%s'), args or (), self._pool)
+                if not fetch:
+                    r = cur.rowcount
+                elif size:
+                    r = await cur.fetchmany(size)
+                else:
+                    r = await cur.fetchall()
+            error = False
+            return r
+        finally:
+            metrics.observe_sql(normalize_sql(sql), time.time() - start, error)
+
+    async def select(self, sql, args, size=None):
+        log(sql, args)
+        return (await self._run(sql, args, True, size))
+
+    async def execute(self, sql, args):
+        log(sql)
+        return (await self._run(sql, args, False))
+
+# MySQL的GET_LOCK()命名锁，用于多个worker之间的互斥：
+#     async with advisory_lock('job:users', timeout=0) as acquired:
+#         if acquired: ...
+# 锁属于持有它的连接，所以加锁期间这条连接一直不还给pool；不支持命名锁的pool（如sqlitepool）直接视为拿到了锁
+class advisory_lock(object):
+
+    def __init__(self, name, timeout=0):
+        db = (_get_pool_kw() or {}).get('db')
+        # GET_LOCK是整个MySQL服务器范围的，加上库名避免和同一台服务器上的其他库冲突
+        self.name = '%s.%s' % (db, name) if db else name
+        self.timeout = timeout
+        self.acquired = False
+        self._conn = None
+
+    async def __aenter__(self):
+        if not getattr(get_pool(), 'advisory_locks', True):
+            self.acquired = True
+            return True
+        conn = await _acquire()
+        try:
+            async with conn.cursor() as cur:
+                await cur.execute('select GET_LOCK(%s, %s)', (self.name, self.timeout))
+                r = await cur.fetchone()
+        except BaseException:
+            _release(conn)
+            raise
+        self.acquired = r is not None and r[0] == 1
+        if self.acquired:
+            self._conn = conn
+        else:
+            _release(conn)
+        return self.acquired
+
+    async def __aexit__(self, exc_type, exc, tb):
+        conn, self._conn = self._conn, None
+        if conn is None:
+            return
+        try:
+            async with conn.cursor() as cur:
+                await cur.execute('select RELEASE_LOCK(%s)', (self.name,))
+        finally:
+            _release(conn)
+
 # 生成一个由num个"?"组成的字符串，如"?, ?, ?, ?"
 def create_args_string(num):
     L = []
@@ -87,15 +400,145 @@ def create_args_string(num):
         L.append('?')
     return ', '.join(L)
 
+# 把where/order by中的字面量统一替换为?，得到一条sql语句的"形状"，如"`email`='a@b.com'"变为"`email`=?"
+# 这样同一类查询无论参数是什么都会被归并到一起统计
+_RE_STRING = re.compile(r"'(?:[^'\\]|\\.)*'|\"(?:[^\"\\]|\\.)*\"")
+_RE_NUMBER = re.compile(r'(?<![\w`.])-?\d+(?:\.\d+)?\b')
+_RE_IN_LIST = re.compile(r'\(\s*\?(?:\s*,\s*\?)*\s*\)')
+_RE_SPACES = re.compile(r'\s+')
+
+def normalize_sql(sql):
+    if not sql:
+        return ''
+    s = _RE_STRING.sub('?', sql)
+    s = _RE_NUMBER.sub('?', s)
+    s = _RE_IN_LIST.sub('(?)', s)
+    return _RE_SPACES.sub(' ', s).strip()
+
+# 运行时记录findAll/findNumber见过的查询形状，key为(表名, where形状, order by形状)
+# value中保存出现次数，以及第一次出现时的完整sql和参数，供advisor模块执行EXPLAIN时使用
+_query_shapes = dict()
+
+def record_shape(table, sql, args, where=None, orderBy=None):
+    key = (table, normalize_sql(where), normalize_sql(orderBy))
+    shape = _query_shapes.get(key)
+    if shape is None:
+        _query_shapes[key] = dict(table=table, where=key[1], orderBy=key[2], sql=sql, args=list(args or ()), count=1)
+    else:
+        shape['count'] = shape['count'] + 1
+
+def get_query_shapes():
+    return list(_query_shapes.values())
+
+def reset_query_shapes():
+    _query_shapes.clear()
+
+# where以"分片键=?"开头（且没有or）时，第一个参数就是分片键的值，只需要查一个分片
+_RE_SHARD_EQ = re.compile(r'^\s*`?(\w+)`?\s*=\s*\?')
+_RE_OR = re.compile(r'\bor\b', re.IGNORECASE)
+
+def _where_shard_value(key, where, args):
+    if not where or not args:
+        return None
+    m = _RE_SHARD_EQ.match(where)
+    if m is None or m.group(1) != key or _RE_OR.search(where):
+        return None
+    return args[0]
+
+# 把"`created_at` desc, id"解析成[('created_at', True), ('id', False)]
+_RE_ORDER_TERM = re.compile(r'^\s*`?(\w+)`?(?:\s+(asc|desc))?\s*$', re.IGNORECASE)
+
+def _parse_order_by(orderBy):
+    keys = []
+    for term in orderBy.split(','):
+        m = _RE_ORDER_TERM.match(term)
+        if m is None:
+            raise ValueError('Cannot merge order by across shards: %s' % orderBy)
+        keys.append((m.group(1), (m.group(2) or '').lower() == 'desc'))
+    return keys
+
+# 合并各个分片已经排好序的结果，从最后一个排序键开始做稳定排序
+# timsort能识别出每个分片的结果是一段有序的run，效果上就是一次k路归并
+def _merge_rows(results, orderBy):
+    rows = [r for rs in results for r in rs]
+    if orderBy:
+        for col, desc in reversed(_parse_order_by(orderBy)):
+            rows.sort(key=lambda r: r[col], reverse=desc)
+    return rows
+
+# 在model所在的每个分片上并发执行同一条select，返回所有分片结果拼起来的list；没有分片的model只查默认的pool
+async def shard_select(model, sql, args, size=None):
+    pools = model._pools()
+    if pools is None:
+        return (await select(sql, args, size))
+    results = await asyncio.gather(*[select(sql, list(args or ()), size, p) for p in pools])
+    return [r for rs in results for r in rs]
+
+# 按时间归档：表名 => (时间列, 热数据保留的秒数, mode)，由archive.configure()按配置设置
+# mode为'table'时旧数据被移到<表名>_archive，findAll默认只查原表；
+# mode为'partition'时旧数据留在按分区列（由时间列生成的整数列）分区的原表里，
+# findAll默认加上"分区列>=?"让MySQL只扫描热分区
+# 两种方式下查询都可以用includeArchived=True要求包括旧数据
+_archives = dict()
+
+def set_archive(table, column, max_age, mode='table', partition_column=None):
+    if mode not in ('table', 'partition'):
+        raise ValueError('Invalid archive mode: %s' % mode)
+    if mode == 'partition' and not partition_column:
+        raise ValueError('Partition mode needs a partition column: %s' % table)
+    _archives[table] = (column, max_age, mode, partition_column)
+
+def clear_archives():
+    _archives.clear()
+
+def archive_table(model):
+    archive = _archives.get(model.__table__)
+    if archive is None or archive[2] != 'table':
+        return None
+    return '%s_archive' % model.__table__
+
+# 热数据的起始时间，没有归档的表返回None
+def hot_cutoff(model):
+    archive = _archives.get(model.__table__)
+    if archive is None:
+        return None
+    return time.time() - archive[1]
+
+# t时刻之后的数据是否都还在热数据里，例如比热数据窗口新的博客，它的评论也一定都是热数据
+def is_hot(model, t):
+    cutoff = hot_cutoff(model)
+    return cutoff is None or t >= cutoff
+
+# 模型写操作的监听函数，签名为fn(event, model)，event为'save'、'update'或'remove'
+# 缓存失效、消息推送等都通过这里挂到Model上，监听函数应当很快返回，耗时的工作自己create_task
+_listeners = []
+
+def add_listener(fn):
+    _listeners.append(fn)
+    return fn
+
+def remove_listener(fn):
+    if fn in _listeners:
+        _listeners.remove(fn)
+
+def fire(event, model):
+    for fn in list(_listeners):
+        try:
+            fn(event, model)
+        except Exception as e:
+            logging.exception('model listener %s failed on %s: %s' % (getattr(fn, '__name__', fn), event, e))
+
 # 定义Field类
 class Field(object):
 
-    def __init__(self, name, column_type, primary_key, default):
+    def __init__(self, name, column_type, primary_key, default, index=False):
         # __init__()方法，初始化name, column_type, primary_key, default属性
+        # index为True时为该列建立普通索引，为'unique'时建立唯一索引
         self.name = name
         self.column_type = column_type
         self.primary_key = primary_key
         self.default = default
+        self.index = index
 
     def __str__(self):
         # __str__()方法，返回<类名, 列类型：名字>
@@ -103,28 +546,49 @@ class Field(object):
 
 class StringField(Field):
 
-    def __init__(self, name=None, primary_key=False, default=None, ddl='varchar(100)'):
-        super().__init__(name, ddl, primary_key, default)
+    def __init__(self, name=None, primary_key=False, default=None, ddl='varchar(100)', index=False):
+        super().__init__(name, ddl, primary_key, default, index)
 
 class BooleanField(Field):
 
-    def __init__(self, name=None, default=False):
-        super().__init__(name, 'boolean', False, default)
+    def __init__(self, name=None, default=False, index=False):
+        super().__init__(name, 'boolean', False, default, index)
 
 class IntegerField(Field):
 
-    def __init__(self, name=None, primary_key=False, default=0):
-        super().__init__(name, 'bigint', primary_key, default)
+    def __init__(self, name=None, primary_key=False, default=0, index=False):
+        super().__init__(name, 'bigint', primary_key, default, index)
 
 class FloatField(Field):
 
-    def __init__(self, name=None, primary_key=False, default=0.0):
-        super().__init__(name, 'real', primary_key, default)
+    def __init__(self, name=None, primary_key=False, default=0.0, index=False):
+        super().__init__(name, 'real', primary_key, default, index)
+
+# 计数列：只通过counters模块的批量UPDATE ... SET n = n + ?累加，Model.update()不会写回它，避免用旧值覆盖
+class CounterField(Field):
+
+    def __init__(self, name=None, default=0):
+        super().__init__(name, 'bigint', False, default)
 
 class TextField(Field):
 
-    def __init__(self, name=None, default=None):
-        super().__init__(name, 'text', False, default)
+    def __init__(self, name=None, default=None, ddl='text'):
+        super().__init__(name, ddl, False, default)
+
+# 根据mappings生成建表语句，声明了index的列会生成对应的key
+def create_table_ddl(tableName, mappings, primaryKey):
+    lines = []
+    for k, v in mappings.items():
+        lines.append('    `%s` %s not null' % (k, v.column_type))
+    for k, v in mappings.items():
+        if v.primary_key or not v.index:
+            continue
+        if v.index == 'unique':
+            lines.append('    unique key `idx_%s` (`%s`)' % (k, k))
+        else:
+            lines.append('    key `idx_%s` (`%s`)' % (k, k))
+    lines.append('    primary key (`%s`)' % primaryKey)
+    return 'create table `%s` (\n%s\n) engine=innodb default charset=utf8;' % (tableName, ',\n'.join(lines))
 
 class ModelMetaclass(type):
 
@@ -161,6 +625,10 @@ class ModelMetaclass(type):
                     fields.append(k)
         if not primaryKey:
             raise StandardError('Primary key not found.')
+        # 分片键：决定一行数据存在哪个分片上，必须是模型的一个属性
+        shardKey = attrs.get('__shard_key__', None)
+        if shardKey is not None and shardKey not in mappings:
+            raise ValueError('Shard key not found: %s' % shardKey)
         for k in mappings.keys():
             attrs.pop(k)
         escaped_fields = list(map(lambda f: '`%s`' % f, fields))
@@ -169,12 +637,17 @@ class ModelMetaclass(type):
         attrs['__mappings__'] = mappings # 保存属性和列的映射关系
         attrs['__table__'] = tableName
         attrs['__primary_key__'] = primaryKey # 主键属性名
+        attrs['__shard_key__'] = shardKey
         attrs['__fields__'] = fields # 除主键外的属性名
+        attrs['__counters__'] = [k for k in fields if isinstance(mappings[k], CounterField)]
+        attrs['__update_fields__'] = [k for k in fields if k not in attrs['__counters__']] # update时写回的属性名
         # 以下四句均为sql语句，'?'表示占位符，用于动态赋值
         attrs['__select__'] = 'select `%s`, %s from `%s`' % (primaryKey, ', '.join(escaped_fields), tableName)
         attrs['__insert__'] = 'insert into `%s` (%s, `%s`) values (%s)' % (tableName, ', '.join(escaped_fields), primaryKey, create_args_string(len(escaped_fields) + 1))
-        attrs['__update__'] = 'update `%s` set %s where `%s`=?' % (tableName, ', '.join(map(lambda f: '`%s`=?' % f, fields)), primaryKey)
+        attrs['__update__'] = 'update `%s` set %s where `%s`=?' % (tableName, ', '.join(map(lambda f: '`%s`=?' % f, attrs['__update_fields__'])), primaryKey)
         attrs['__delete__'] = 'delete from `%s` where `%s`=?' % (tableName, primaryKey)
+        attrs['__indexes__'] = [k for k, v in mappings.items() if v.index and not v.primary_key]
+        attrs['__ddl__'] = create_table_ddl(tableName, mappings, primaryKey)
         return type.__new__(cls, name, bases, attrs)
 
 # Model类这里作为基类使用，负责定义各种方法将继承到子类
@@ -219,86 +692,226 @@ class Model(dict, metaclass=ModelMetaclass):
 
     # 由@classmethod修饰的方法为类方法，可以对类属性进行操作，可以继承到子类，当子类使用类方法时clc值将是子类
 
+    # 分片的表返回各分片的pool，没有配置分片时返回None，使用默认的pool
+    @classmethod
+    def _pools(cls):
+        if cls.__shard_key__ is None:
+            return None
+        return get_shard_pools(cls.__table__)
+
+    # 分片键的值所在分片的pool
+    @classmethod
+    def _pool_for(cls, value):
+        pools = cls._pools()
+        if pools is None:
+            return None
+        return pools[shard_index(value, len(pools))]
+
     # findAll()类方法，在数据库中寻找满足where判断的那一行数据，注意这里where参数要以''字符串形式传入
     # sql语句最终形式类似于：select * from 'table_name' where 'id=1' order by 'id' limit ?
     # 利用args变量传入sql语句中？部分的参数
+    # 分片的表：给出shardKey=值，或者where以"分片键=?"开头时只查一个分片，否则并发查询所有分片，在内存中归并排序并截取limit
+    # 归档的表：默认只查热数据，includeArchived=True时把归档表也一起查询、合并
     @classmethod
     async def findAll(cls, where=None, args=None, **kw):
         ' find objects by where clause. '
         #
+        if args is None:
+            args = []
+        orderBy = kw.get('orderBy', None)
+        limit = kw.get('limit', None)
+        if limit is not None and not isinstance(limit, int) and not (isinstance(limit, tuple) and len(limit) == 2):
+            raise ValueError('Invalid limit value: %s' % str(limit))
+        pools = cls._target_pools(where, args, kw.get('shardKey'))
+        where, args = cls._prune(where, args, kw.get('includeArchived', False))
         sql = [cls.__select__]
         if where:
             sql.append('where')
             sql.append(where)
-        if args is None:
-            args = []
-        orderBy = kw.get('orderBy', None)
         if orderBy:
             sql.append('order by')
             sql.append(orderBy)
-        limit = kw.get('limit', None)
+        record_shape(cls.__table__, ' '.join(sql), args, where, orderBy)
+        targets = [(sql, p) for p in pools]
+        table = archive_table(cls) if kw.get('includeArchived', False) else None
+        if table is not None:
+            archived = [cls.__select__.replace('from `%s`' % cls.__table__, 'from `%s`' % table)] + sql[1:]
+            targets.extend([(archived, p) for p in pools])
+        if len(targets) > 1:
+            return (await cls._scatter(targets, args, orderBy, limit))
         if limit is not None:
             sql.append('limit')
             if isinstance(limit, int):
                 sql.append('?')
                 args.append(limit)
-            elif isinstance(limit, tuple) and len(limit) == 2:
+            else:
                 sql.append('?, ?')
                 args.extend(limit)
-            else:
-                raise ValueError('Invalid limit value: %s' % str(limit))
-        rs = await select(' '.join(sql), args)
+        rs = await select(' '.join(sql), args, pool=pools[0])
         return [cls(**r) for r in rs]
         # 无法理解这里为什么要这么写，直接写return rs不就行了？
         # cls（**r）for r in rs是一个generator object，所以和协程相关吗？
 
+    # 要查询的pool列表：不分片的表只有默认的pool（None），分片的表能确定分片键时只有那一个分片，否则是所有分片
+    @classmethod
+    def _target_pools(cls, where, args, shardKey=None):
+        pools = cls._pools()
+        if pools is None:
+            return [None]
+        if shardKey is None:
+            shardKey = _where_shard_value(cls.__shard_key__, where, args)
+        if shardKey is None:
+            return pools
+        return [pools[shard_index(shardKey, len(pools))]]
+
+    # 按分区归档的表，没有要求旧数据时加上时间条件，MySQL据此裁剪到热分区
+    @classmethod
+    def _prune(cls, where, args, includeArchived=False):
+        archive = _archives.get(cls.__table__)
+        if archive is None or archive[2] != 'partition' or includeArchived:
+            return where, args
+        condition = '`%s`>=?' % archive[3]
+        args = list(args or ()) + [int(time.time() - archive[1])]
+        return ('(%s) and %s' % (where, condition) if where else condition), args
+
+    # 在每个(sql, pool)上都取前offset+limit行，合并排序后再截取
+    @classmethod
+    async def _scatter(cls, targets, args, orderBy, limit):
+        if limit is None:
+            start, end = 0, None
+        elif isinstance(limit, int):
+            start, end = 0, limit
+        else:
+            start, end = limit[0], limit[0] + limit[1]
+        tail, targs = [], list(args)
+        if end is not None:
+            tail, targs = ['limit', '?'], targs + [end]
+        results = await asyncio.gather(*[select(' '.join(sql + tail), list(targs), pool=p) for sql, p in targets])
+        rows = _merge_rows(results, orderBy)
+        return [cls(**r) for r in rows[start:end]]
+
     # 查找数据库中满足where判断的selectField列，输出该列的元素数目
+    # 分片的表和findAll一样选择分片，没有分片键时把各分片的计数加起来；includeArchived=True时加上归档表中的计数
     @classmethod
-    async def findNumber(cls, selectField, where=None, args=None):
+    async def findNumber(cls, selectField, where=None, args=None, shardKey=None, includeArchived=False):
         ' find number by select and where. '
-        sql = ['select count(%s) _num_ from `%s`' % (selectField, cls.__table__)]
-        # 这里把列名重命名了，相当于select id as _num_，方便后面return
-        if where:
-            sql.append('where')
-            sql.append(where)
-        rs = await select(' '.join(sql), args, 1)
-        if len(rs) == 0:
-            return None
-        return rs[0]['_num_']
+        pools = cls._target_pools(where, args, shardKey)
+        where, args = cls._prune(where, args, includeArchived)
+        tables = [cls.__table__]
+        if includeArchived and archive_table(cls) is not None:
+            tables.append(archive_table(cls))
+        sqls = []
+        for table in tables:
+            sql = ['select count(%s) _num_ from `%s`' % (selectField, table)]
+            # 这里把列名重命名了，相当于select id as _num_，方便后面return
+            if where:
+                sql.append('where')
+                sql.append(where)
+            sqls.append(' '.join(sql))
+        record_shape(cls.__table__, sqls[0], args, where)
+        if len(sqls) == 1 and len(pools) == 1:
+            rs = await select(sqls[0], args, 1, pools[0])
+            if len(rs) == 0:
+                return None
+            return rs[0]['_num_']
+        results = await asyncio.gather(*[select(sql, args, 1, p) for sql in sqls for p in pools])
+        return sum(rs[0]['_num_'] for rs in results if rs)
 
     # 通过主键（这里是id）来查找数据库中其他内容
     @classmethod
     async def find(cls, pk):
         ' find object by primary key. '
-        rs = await select('%s where `%s`=?' % (cls.__select__, cls.__primary_key__), [pk], 1)
+        identities = _identity_map.get()
+        if identities is None:
+            return (await cls._find(pk))
+        # 保存的是future，并发的子请求查同一个主键时也只查一次
+        key = (cls.__table__, pk)
+        fut = identities.get(key)
+        if fut is None:
+            fut = identities[key] = asyncio.ensure_future(cls._find(pk))
+        try:
+            return (await asyncio.shield(fut))
+        except Exception:
+            identities.pop(key, None)
+            raise
+
+    # 分片键就是主键时直接找到分片，否则要到每个分片上去找
+    # 按主键查找的代价很小，热数据里没有时再到归档表里找，归档之后旧的链接仍然有效
+    @classmethod
+    async def _find(cls, pk):
+        sql = '%s where `%s`=?' % (cls.__select__, cls.__primary_key__)
+        rs = await cls._find_in(sql, pk)
+        table = archive_table(cls)
+        if len(rs) == 0 and table is not None:
+            rs = await cls._find_in(sql.replace('from `%s`' % cls.__table__, 'from `%s`' % table), pk)
         if len(rs) == 0:
             return None
         return cls(**rs[0])
 
+    @classmethod
+    async def _find_in(cls, sql, pk):
+        pools = cls._pools()
+        if pools is None or cls.__shard_key__ == cls.__primary_key__:
+            return (await select(sql, [pk], 1, cls._pool_for(pk)))
+        return (await shard_select(cls, sql, [pk], 1))
+
+    # 这一行所在分片的pool
+    def _pool(self):
+        if self.__shard_key__ is None:
+            return None
+        return self._pool_for(self.getValue(self.__shard_key__))
+
+    # 写操作之后同步identity map，保证同一个请求里后续的find()拿到的是新值
+    def _sync_identity(self, removed=False):
+        identities = _identity_map.get()
+        if identities is None:
+            return
+        key = (self.__table__, self.getValue(self.__primary_key__))
+        if removed:
+            identities.pop(key, None)
+        else:
+            fut = asyncio.get_event_loop().create_future()
+            fut.set_result(self)
+            identities[key] = fut
+
     # 将实例的信息保存到数据库
     async def save(self):
         # 以下两句是把实例的属性值按照__fields__和__primary_key__里的key顺序排列成一个list
         args = list(map(self.getValueOrDefault, self.__fields__))
         args.append(self.getValueOrDefault(self.__primary_key__))
         # 把实例属性insert到数据库
-        rows = await execute(self.__insert__, args)
+        rows = await execute(self.__insert__, args, pool=self._pool())
         if rows != 1:
             logging.warn('failed to insert record: affected rows: %s' % rows)
         else:
             logging.info('save operation is successful')
+            self._sync_identity()
+            fire('save', self)
 
     # 修改数据库数据，通过主键（即id）判断要修改的行
     # 修改时需要给出主键，注意主键是字符串
     async def update(self):
-        args = list(map(self.getValue, self.__fields__))
+        args = list(map(self.getValue, self.__update_fields__))
         args.append(self.getValue(self.__primary_key__))
-        rows = await execute(self.__update__, args)
+        rows = await execute(self.__update__, args, pool=self._pool())
+        table = archive_table(self)
+        if rows == 0 and table is not None:
+            # 已经被归档的行
+            rows = await execute(self.__update__.replace('update `%s`' % self.__table__, 'update `%s`' % table, 1), args, pool=self._pool())
         if rows != 1:
             logging.warn('failed to update by primary key: affected rows: %s' % rows)
+        # 值没有变化时MySQL返回的affected rows为0，但缓存等仍然应当按更新处理
+        self._sync_identity()
+        fire('update', self)
 
     # 通过主键查找并删除数据库内所有的其他信息
     async def remove(self):
         args = [self.getValue(self.__primary_key__)]
-        rows = await execute(self.__delete__, args)
+        rows = await execute(self.__delete__, args, pool=self._pool())
+        table = archive_table(self)
+        if rows == 0 and table is not None:
+            rows = await execute(self.__delete__.replace('from `%s`' % self.__table__, 'from `%s`' % table, 1), args, pool=self._pool())
         if rows != 1:
-            logging.warn('failed to remove by primary key: affected rows: %s' % rows)
\ No newline at end of file
+            logging.warn('failed to remove by primary key: affected rows: %s' % rows)
+        self._sync_identity(removed=True)
+        fire('remove', self)
\ No newline at end of file
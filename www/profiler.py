@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Sampling profiler and event loop blocking watchdog.
+
+The profiler runs in a helper thread and periodically samples the stack of the
+event loop thread, the result is in collapsed-stack format ("a;b;c 42" per line)
+which flamegraph.pl / speedscope can read directly.
+'''
+
+__author__ = 'Hongqing Wang'
+
+import asyncio, sys, os, time, threading, traceback, logging
+
+def _frame_name(frame):
+    code = frame.f_code
+    return '%s (%s:%s)' % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno)
+
+# 把一个frame展开成"最外层;...;最内层"形式的一行
+def collapse(frame):
+    L = []
+    while frame is not None:
+        L.append(_frame_name(frame))
+        frame = frame.f_back
+    return ';'.join(reversed(L))
+
+class SamplingProfiler(object):
+    '''
+    Sample the stack of one thread every interval seconds for duration seconds.
+    '''
+
+    def __init__(self, thread_id, interval=0.005):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.samples = dict()
+
+    def run(self, duration):
+        end = time.time() + duration
+        while time.time() < end:
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is not None:
+                stack = collapse(frame)
+                self.samples[stack] = self.samples.get(stack, 0) + 1
+            # 这里在profiler自己的线程里sleep，不影响事件循环
+            time.sleep(self.interval)
+        return self.samples
+
+    def collapsed(self):
+        return '\n'.join('%s %s' % (stack, n) for stack, n in sorted(self.samples.items(), key=lambda kv: -kv[1])) + '\n'
+
+_profiling = False
+
+# 在线上worker中对事件循环线程采样seconds秒，返回collapsed-stack文本
+async def profile(seconds, interval=0.005):
+    global _profiling
+    if _profiling:
+        raise RuntimeError('a profile is already running')
+    _profiling = True
+    try:
+        loop = asyncio.get_event_loop()
+        profiler = SamplingProfiler(threading.get_ident(), interval)
+        await loop.run_in_executor(None, profiler.run, seconds)
+        return profiler.collapsed()
+    finally:
+        _profiling = False
+
+class BlockingWatchdog(object):
+    '''
+    Log the event loop thread's stack whenever a callback blocks the loop longer than threshold seconds.
+    The block is timed from the last heartbeat, which runs every threshold/10 seconds, so the callback
+    started between `interval` seconds after it and the heartbeat itself: the report gives that range.
+    '''
+
+    def __init__(self, loop, threshold=0.2):
+        self.loop = loop
+        self.threshold = threshold
+        # 心跳间隔决定了测量误差：阻塞开始的时间只能确定在上一次心跳之后interval秒以内
+        self.interval = threshold / 10
+        self._beat = time.monotonic()
+        self._thread_id = None
+        self._reported = None
+
+    # 心跳协程：只要事件循环没被阻塞，_beat就会被不断刷新
+    async def _heartbeat(self):
+        self._thread_id = threading.get_ident()
+        while True:
+            self._beat = time.monotonic()
+            await asyncio.sleep(self.interval)
+
+    # 事件循环关闭后心跳不再更新，线程随之退出，不要把它当成阻塞报告
+    def _watch(self):
+        while not self.loop.is_closed():
+            time.sleep(self.threshold / 4)
+            # 没有在运行的事件循环（如两次run_until_complete之间）不会刷新心跳，也不算阻塞
+            if not self.loop.is_running():
+                self._beat = time.monotonic()
+                continue
+            beat = self._beat
+            blocked = time.monotonic() - beat
+            if blocked < self.threshold or self._reported == beat or self._thread_id is None:
+                continue
+            # 同一次阻塞只报告一次
+            self._reported = beat
+            frame = sys._current_frames().get(self._thread_id)
+            if frame is None:
+                continue
+            # 下一次心跳本该在beat + interval执行，阻塞至少从那时开始，最多从beat开始
+            logging.warning('event loop blocked for %.3f-%.3fs so far, stack:\n%s' % (max(blocked - self.interval, 0), blocked, ''.join(traceback.format_stack(frame))))
+
+    def start(self):
+        self.loop.create_task(self._heartbeat())
+        t = threading.Thread(target=self._watch, name='loop-watchdog', daemon=True)
+        t.start()
+        return self
@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+In-process async job scheduler.
+
+    scheduler.add('users', refresh_users, interval=60, warm=True)
+    await scheduler.run('users')    # run now, or wait for the run in progress
+    scheduler.trigger('users')      # run in the background; a run in progress is followed by one more
+
+Periodic runs are spread by +/- jitter so workers started together don't query in lockstep,
+a failed job is retried with exponential backoff, and a job added with lock=True runs inside
+orm.advisory_lock so only one worker executes it at a time; the others skip that round.
+A triggered run can't be skipped that way (the worker holding the lock may have started before
+the change), so it waits up to lock_wait seconds for the lock and stays dirty until it has run.
+'''
+
+__author__ = 'Hongqing Wang'
+
+import time, random, asyncio, logging, contextvars
+
+import orm, metrics
+from config import configs
+
+job_runs = metrics.REGISTRY.counter('scheduler_job_runs_total', 'Scheduler job runs by result.', ('job', 'result'))
+job_duration = metrics.REGISTRY.histogram('scheduler_job_duration_seconds', 'Scheduler job run time.', ('job',))
+
+class Job(object):
+
+    def __init__(self, name, fn, interval=None, jitter=0.1, lock=True, warm=False):
+        self.name = name
+        self.fn = fn
+        self.interval = interval
+        self.jitter = jitter
+        self.lock = lock
+        self.warm = warm
+        self.failures = 0
+        self.last_run = None
+        self.last_error = None
+        # 正在执行的这一次，用于合并并发的run()
+        self.running = None
+        # 被trigger()过还没有执行：执行期间被trigger()的，或者因为锁在别的worker手里没能执行的，结束后需要再跑一次
+        self.dirty = False
+
+    # 距离下一次执行的秒数：失败后按retry * 2^(n-1)退避，不超过max_backoff
+    def next_delay(self, retry, max_backoff):
+        if self.failures:
+            delay = min(max_backoff, retry * 2 ** (self.failures - 1))
+        else:
+            delay = self.interval
+        return delay * (1 + random.uniform(-self.jitter, self.jitter))
+
+# 在空的context里创建task：trigger()常在请求里（如保存后的listener）被调用，
+# ensure_future默认复制当前context，任务会带上请求的截止时间和identity map
+def _spawn(coro):
+    return contextvars.Context().run(asyncio.ensure_future, coro)
+
+class Scheduler(object):
+
+    def __init__(self, retry=1, max_backoff=300, lock_wait=10):
+        self.retry = retry
+        self.max_backoff = max_backoff
+        self.lock_wait = lock_wait
+        self.jobs = dict()
+        self._tasks = []
+
+    def add(self, name, fn, interval=None, jitter=None, lock=True, warm=False):
+        if name in self.jobs:
+            raise ValueError('Duplicate job: %s' % name)
+        if jitter is None:
+            jitter = configs.scheduler.jitter
+        job = self.jobs[name] = Job(name, fn, interval, jitter, lock, warm)
+        return job
+
+    async def _run(self, job):
+        start = time.time()
+        # 这一次执行会包含开始之前的所有变化
+        triggered, job.dirty = job.dirty, False
+        try:
+            if job.lock:
+                # 定时执行时锁被占用就跳过这一轮；被trigger()的要等锁释放后再执行，否则数据变化后的刷新会丢掉
+                wait = self.lock_wait if triggered else 0
+                async with orm.advisory_lock('job:%s' % job.name, timeout=wait) as acquired:
+                    if not acquired:
+                        # 另一个worker正在执行
+                        job_runs.inc(job.name, 'skipped')
+                        if triggered and wait:
+                            job.dirty = True
+                        return False
+                    await job.fn()
+            else:
+                await job.fn()
+            job.failures = 0
+            job.last_error = None
+            job_runs.inc(job.name, 'ok')
+            return True
+        except Exception as e:
+            job.failures += 1
+            job.last_error = str(e)
+            job_runs.inc(job.name, 'error')
+            logging.exception('job %s failed (%s in a row): %s' % (job.name, job.failures, e))
+            return False
+        finally:
+            job.last_run = time.time()
+            job_duration.observe(job.name, value=job.last_run - start)
+
+    def _done(self, job, f):
+        job.running = None
+        # 被取消说明正在退出，不再重新执行
+        if job.dirty and not f.cancelled():
+            self.trigger(job.name)
+
+    # 立即执行一次，已经在执行时等待那一次的结果；返回是否执行成功
+    async def run(self, name):
+        job = self.jobs[name]
+        if job.running is None:
+            job.running = _spawn(self._run(job))
+            job.running.add_done_callback(lambda f: self._done(job, f))
+        return (await asyncio.shield(job.running))
+
+    # 在后台执行，不等待结果；用于数据变化后刷新，执行期间的多次trigger合并为结束后的一次
+    def trigger(self, name):
+        job = self.jobs[name]
+        job.dirty = True
+        if job.running is not None:
+            return job.running
+        return _spawn(self.run(name))
+
+    async def _loop(self, job):
+        while True:
+            await asyncio.sleep(job.next_delay(self.retry, self.max_backoff))
+            await self.run(job.name)
+
+    # 启动时执行所有warm=True的任务，最多等待timeout秒，超时的继续在后台执行
+    async def warm(self, timeout=None):
+        names = [j.name for j in self.jobs.values() if j.warm]
+        if not names:
+            return
+        start = time.time()
+        fut = asyncio.gather(*[self.run(n) for n in names])
+        try:
+            results = await asyncio.wait_for(asyncio.shield(fut), timeout)
+            logging.info('warmed %s/%s jobs in %.3fs' % (results.count(True), len(names), time.time() - start))
+        except asyncio.TimeoutError:
+            logging.warning('warm up not finished in %ss, continuing in background' % timeout)
+
+    def start(self, loop):
+        for job in self.jobs.values():
+            if job.interval:
+                self._tasks.append(loop.create_task(self._loop(job)))
+
+    async def stop(self):
+        tasks, self._tasks = self._tasks, []
+        for t in tasks:
+            t.cancel()
+        running = [j.running for j in self.jobs.values() if j.running is not None]
+        if running:
+            await asyncio.wait(running)
+
+    def status(self):
+        return [dict(name=j.name, interval=j.interval, lock=j.lock, failures=j.failures, last_run=j.last_run, last_error=j.last_error, running=j.running is not None) for j in self.jobs.values()]
+
+scheduler = Scheduler(configs.scheduler.retry, configs.scheduler.max_backoff, configs.scheduler.lock_wait)
+
+# 挂到app的生命周期上：先预热，再开始周期执行，关闭时停止
+async def init_scheduler(app, loop):
+    app['__scheduler__'] = scheduler
+    await scheduler.warm(configs.scheduler.warm_timeout)
+    scheduler.start(loop)
+    async def stop(app):
+        await scheduler.stop()
+    app.on_shutdown.append(stop)
@@ -0,0 +1,37 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Generate schema.sql from models: python3 schema.py > ../schema.sql
+'''
+
+__author__ = 'Hongqing Wang'
+
+from models import User, Blog, Comment, MaterializedView
+from archive import archive_ddl
+
+HEADER = '''-- schema.sql
+-- generated by www/schema.py from www/models.py, do not edit by hand.
+
+drop database if exists awesome;
+
+create database awesome;
+
+use awesome;
+
+grant select, insert, update, delete on awesome.* to 'www-data'@'localhost' identified by 'www-data';
+'''
+
+def generate(models=(User, Blog, Comment, MaterializedView), archived=(Blog, Comment)):
+    L = [HEADER]
+    for m in models:
+        L.append(m.__ddl__)
+        L.append('')
+    # 归档表，configs.archive.mode为table时使用
+    for m in archived:
+        L.append(archive_ddl(m))
+        L.append('')
+    return '\n'.join(L)
+
+if __name__ == '__main__':
+    print(generate(), end='')
@@ -0,0 +1,591 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Full-text search over blogs and comments, served by /api/search?q=...&kind=blog|comment&page=1.
+
+Every worker keeps an inverted index made of read-only segment files under configs.search.index_dir
+(memory-mapped, postings are read straight from the mapping) plus an in-memory delta that the
+save/update/remove listener writes to. The delta is flushed into a new segment every
+flush_interval seconds or flush_docs documents; the other workers see it when they re-read the
+MANIFEST on their next sync, so a write shows up everywhere within about flush_interval + sync_interval.
+Newer sources override older ones document by document, removals are written as tombstones.
+Once a day one worker rebuilds the index from the database into a single segment, which also
+drops the segments it replaces.
+
+Text is lowercased; runs of CJK characters are indexed as overlapping bigrams (single characters
+on their own), other runs of letters and digits as words. All query terms must match, results are
+ranked by BM25 with blog titles weighted title_boost times. With index_dir None the index only
+lives in memory and every worker builds its own at start up.
+
+init_search() opens the index directory (relative paths are resolved against this file's directory)
+and is called from app.init; until then the module holds an empty in-memory index. Tokenizing a
+saved document and scoring a query both run in the default executor, not on the event loop.
+'''
+
+__author__ = 'Hongqing Wang'
+
+import os, re, json, math, mmap, time, fcntl, struct, asyncio, logging
+from array import array
+
+import orm, metrics
+from apis import Page
+from config import configs
+from coroweb import cpu_bound
+from models import Blog, Comment
+from scheduler import scheduler
+
+index_docs = metrics.REGISTRY.gauge('search_index_docs', 'Documents in the search index of this worker.')
+index_flushes = metrics.REGISTRY.counter('search_index_flushes_total', 'Search index segment writes by kind.', ('kind',))
+
+_CJK = '\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff'
+_RE_TOKEN = re.compile('([%s]+)|([^\\W_%s]+)' % (_CJK, _CJK))
+
+# 过长的"词"多半是URL、base64之类，不值得索引
+MAX_WORD = 40
+
+def tokenize(text):
+    tokens = []
+    for m in _RE_TOKEN.finditer(text.lower()):
+        cjk, word = m.groups()
+        if cjk:
+            if len(cjk) == 1:
+                tokens.append(cjk)
+            else:
+                tokens.extend(cjk[i:i + 2] for i in range(len(cjk) - 1))
+        elif len(word) <= MAX_WORD:
+            tokens.append(word)
+    return tokens
+
+# parts为[(文本, 权重)]，返回 ({词: 词频}, 文档长度)，标题的词按权重重复计数
+def analyze(parts):
+    tfs = dict()
+    length = 0
+    for text, weight in parts:
+        for t in tokenize(text or ''):
+            tfs[t] = tfs.get(t, 0) + weight
+            length += weight
+    return tfs, length
+
+@cpu_bound
+def analyze_many(docs):
+    return [analyze(parts) for parts in docs]
+
+# 文档的键为"blog:<id>"或"comment:<id>"
+def doc_key(model):
+    return '%s:%s' % ('blog' if isinstance(model, Blog) else 'comment', model.id)
+
+def doc_parts(model):
+    if isinstance(model, Blog):
+        return [(model.name, configs.search.title_boost), (model.summary, 1), (model.content, 1)]
+    return [(model.content, 1)]
+
+class Delta(object):
+    '''
+    In-memory segment that accepts writes; a removed document is kept as a None tombstone.
+    '''
+
+    def __init__(self):
+        self.docs = dict()
+        self.terms = dict()
+        self.watermark = None
+        self.created = time.time()
+
+    def __len__(self):
+        return len(self.docs)
+
+    def _discard(self, key):
+        old = self.docs.pop(key, None)
+        if old is None:
+            return
+        for t in old[0]:
+            postings = self.terms[t]
+            del postings[key]
+            if not postings:
+                del self.terms[t]
+
+    def add(self, key, tfs, length, created_at=None):
+        self._discard(key)
+        self.docs[key] = (tfs, length)
+        for t, n in tfs.items():
+            self.terms.setdefault(t, dict())[key] = n
+        if created_at is not None and (self.watermark is None or created_at > self.watermark):
+            self.watermark = created_at
+
+    def remove(self, key):
+        self._discard(key)
+        self.docs[key] = None
+
+    # (键, 长度)，长度为-1表示已删除
+    def entries(self):
+        return [(k, -1 if v is None else v[1]) for k, v in self.docs.items()]
+
+    def postings(self, term):
+        return self.terms.get(term, dict()).items()
+
+    def close(self):
+        pass
+
+# 段文件：头部 | 文档表JSON [[键, 长度], ...] | 词典JSON {词: [偏移, 文档数]} | 倒排表
+# 倒排表是本机字节序的uint32数组，每个词占连续的 (文档序号, 词频) 对
+HEADER = struct.Struct('<4sIQQd')
+MAGIC = b'SIX1'
+
+def write_segment(path, delta):
+    entries = delta.entries()
+    numbers = dict((k, i) for i, (k, length) in enumerate(entries))
+    postings = array('I')
+    terms = dict()
+    for t, docs in delta.terms.items():
+        terms[t] = [len(postings), len(docs)]
+        for k, n in docs.items():
+            postings.append(numbers[k])
+            postings.append(n)
+    docs_data = json.dumps(entries, ensure_ascii=False).encode('utf-8')
+    terms_data = json.dumps(terms, ensure_ascii=False).encode('utf-8')
+    tmp = '%s.%s.tmp' % (path, os.getpid())
+    with open(tmp, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, 1, len(docs_data), len(terms_data), delta.watermark or 0))
+        f.write(docs_data)
+        f.write(terms_data)
+        postings.tofile(f)
+    os.replace(tmp, path)
+
+class Segment(object):
+    '''
+    Read-only segment file; the document table and term dictionary are loaded, postings stay in the mapping.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, docs_len, terms_len, self.watermark = HEADER.unpack_from(self._mm, 0)
+        if magic != MAGIC:
+            raise ValueError('Not a search segment: %s' % path)
+        start = HEADER.size
+        self._entries = json.loads(self._mm[start:start + docs_len].decode('utf-8'))
+        self._keys = [k for k, length in self._entries]
+        self._terms = json.loads(self._mm[start + docs_len:start + docs_len + terms_len].decode('utf-8'))
+        self._base = start + docs_len + terms_len
+
+    def __len__(self):
+        return len(self._entries)
+
+    def entries(self):
+        return self._entries
+
+    def postings(self, term):
+        e = self._terms.get(term)
+        if e is None:
+            return ()
+        offset, count = e
+        a = array('I')
+        start = self._base + offset * a.itemsize
+        a.frombytes(self._mm[start:start + count * 2 * a.itemsize])
+        keys = self._keys
+        return [(keys[a[i]], a[i + 1]) for i in range(0, len(a), 2)]
+
+    def close(self):
+        self._mm.close()
+
+# MANIFEST列出当前有效的段文件（旧的在前），修改时持有index_dir下LOCK文件的flock
+def read_manifest(index_dir):
+    try:
+        with open(os.path.join(index_dir, 'MANIFEST'), 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return dict(generation=0, segments=[])
+
+def write_manifest(index_dir, manifest):
+    path = os.path.join(index_dir, 'MANIFEST')
+    tmp = '%s.%s.tmp' % (path, os.getpid())
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f)
+    os.replace(tmp, path)
+
+class FileLock(object):
+
+    def __init__(self, path, blocking=True):
+        self.path = path
+        self.blocking = blocking
+        self._f = None
+
+    def acquire(self):
+        self._f = open(self.path, 'a')
+        try:
+            fcntl.flock(self._f, fcntl.LOCK_EX if self.blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            self._f.close()
+            self._f = None
+            return False
+        return True
+
+    def release(self):
+        if self._f is not None:
+            fcntl.flock(self._f, fcntl.LOCK_UN)
+            self._f.close()
+            self._f = None
+
+    def __enter__(self):
+        return self.acquire()
+
+    def __exit__(self, *exc):
+        self.release()
+
+_seq = 0
+
+def segment_name():
+    global _seq
+    _seq += 1
+    return 'seg-%d-%d-%d.six' % (int(time.time() * 1000), os.getpid(), _seq)
+
+# 把delta写成新的段文件，replace_since不为None时（全量重建）替换掉这之前加入的所有段
+def commit_segment(index_dir, delta, replace_since=None):
+    name = segment_name()
+    write_segment(os.path.join(index_dir, name), delta)
+    with FileLock(os.path.join(index_dir, 'LOCK')):
+        manifest = read_manifest(index_dir)
+        entry = dict(file=name, created=time.time(), watermark=delta.watermark)
+        if replace_since is None:
+            segments, dropped = manifest['segments'] + [entry], []
+        else:
+            # 重建期间别的worker写入的段比重建的结果新，保留在后面
+            kept = [s for s in manifest['segments'] if s['created'] >= replace_since]
+            dropped = [s for s in manifest['segments'] if s['created'] < replace_since]
+            segments = [entry] + kept
+        write_manifest(index_dir, dict(generation=manifest['generation'] + 1, segments=segments))
+    # 其他worker可能还映射着旧文件，删除目录项不影响已有的映射
+    for s in dropped:
+        try:
+            os.remove(os.path.join(index_dir, s['file']))
+        except OSError as e:
+            logging.warning('failed to remove search segment %s: %s' % (s['file'], e))
+
+def open_segments(index_dir, files, opened):
+    return [opened.get(name) or Segment(os.path.join(index_dir, name)) for name in files]
+
+class SearchIndex(object):
+
+    def __init__(self, index_dir=None, k1=1.2, b=0.75):
+        self.index_dir = index_dir
+        self.k1 = k1
+        self.b = b
+        # 从旧到新：段文件、正在写出的delta、当前的delta，同一个文档以最新的为准
+        self.segments = []
+        self.flushing = []
+        self.delta = Delta()
+        self.generation = None
+        self.ready = False
+        # 键 => (所在的段, 长度)
+        self.live = dict()
+        self.total_length = 0
+        # 正在线程池里执行的查询数；有查询时换下来的段等它们结束再关闭
+        self.readers = 0
+        self.retired = []
+        if index_dir:
+            os.makedirs(index_dir, exist_ok=True)
+
+    def _sources(self):
+        return self.segments + self.flushing + [self.delta]
+
+    def _resolve(self):
+        live = dict()
+        for src in self._sources():
+            for key, length in src.entries():
+                if length < 0:
+                    live.pop(key, None)
+                else:
+                    live[key] = (src, length)
+        self.live = live
+        self.total_length = sum(length for src, length in live.values())
+        index_docs.set(value=len(live))
+
+    def _set(self, key, src, length):
+        old = self.live.pop(key, None)
+        if old is not None:
+            self.total_length -= old[1]
+        if src is not None:
+            self.live[key] = (src, length)
+            self.total_length += length
+        index_docs.set(value=len(self.live))
+
+    def watermark(self):
+        marks = [s.watermark for s in self.segments if s.watermark]
+        return max(marks) if marks else None
+
+    def add(self, key, tfs, length, created_at=None):
+        self.delta.add(key, tfs, length, created_at)
+        self._set(key, self.delta, length)
+
+    def remove(self, key):
+        self.delta.remove(key)
+        self._set(key, None, -1)
+
+    # 返回按得分从高到低排好的 [(键, 得分)]，所有词都要出现
+    def search(self, query, kind=None):
+        terms = list(dict.fromkeys(tokenize(query)))
+        if not terms or not self.live:
+            return []
+        sources = [(src, src.postings) for src in self._sources()]
+        return self._score(terms, sources, self.live, len(self.live), self.total_length, kind)
+
+    # 和search()相同，但读取倒排表和计算得分在线程池里执行
+    # 当前delta还会被事件循环修改，先复制出这几个词的倒排表；段文件只读，flushing中的delta不再修改；
+    # live只按键读取，单次dict.get不会和事件循环里的修改冲突
+    async def query(self, query, kind=None):
+        terms = list(dict.fromkeys(tokenize(query)))
+        if not terms or not self.live:
+            return []
+        delta = self.delta
+        frozen = dict((t, list(delta.postings(t))) for t in terms)
+        sources = [(src, src.postings) for src in self.segments + self.flushing]
+        sources.append((delta, lambda t: frozen[t]))
+        fut = asyncio.get_event_loop().run_in_executor(None, self._score, terms, sources, self.live, len(self.live), self.total_length, kind)
+        self.readers += 1
+        fut.add_done_callback(self._release_reader)
+        # 请求被取消时线程里的查询还在读段文件，等它真正结束才减少readers
+        return (await asyncio.shield(fut))
+
+    def _release_reader(self, fut):
+        self.readers -= 1
+        self._close_retired()
+
+    def _close_retired(self):
+        if self.readers:
+            return
+        retired, self.retired = self.retired, []
+        for s in retired:
+            s.close()
+
+    def _score(self, terms, sources, live, n, total_length, kind):
+        avgdl = total_length / n or 1
+        scores = None
+        for t in terms:
+            hits = dict()
+            for src, postings in sources:
+                for key, tf in postings(t):
+                    doc = live.get(key)
+                    if doc is not None and doc[0] is src:
+                        hits[key] = (tf, doc[1])
+            if scores is not None:
+                hits = dict((k, e) for k, e in hits.items() if k in scores)
+            if not hits:
+                return []
+            idf = math.log(1 + (n - len(hits) + 0.5) / (len(hits) + 0.5))
+            next_scores = dict()
+            for key, (tf, dl) in hits.items():
+                s = idf * tf * (self.k1 + 1) / (tf + self.k1 * (1 - self.b + self.b * dl / avgdl))
+                next_scores[key] = (scores[key] if scores is not None else 0) + s
+            scores = next_scores
+        if kind:
+            prefix = kind + ':'
+            scores = dict((k, s) for k, s in scores.items() if k.startswith(prefix))
+        return sorted(scores.items(), key=lambda e: (-e[1], e[0]))
+
+    # 重新读取MANIFEST，有变化时换上新的段
+    async def reload(self):
+        loop = asyncio.get_event_loop()
+        manifest = await loop.run_in_executor(None, read_manifest, self.index_dir)
+        if manifest['generation'] == self.generation:
+            return False
+        opened = dict((os.path.basename(s.path), s) for s in self.segments)
+        files = [s['file'] for s in manifest['segments']]
+        segments = await loop.run_in_executor(None, open_segments, self.index_dir, files, opened)
+        old, self.segments = self.segments, segments
+        self.generation = manifest['generation']
+        self._resolve()
+        self.retired.extend(s for s in old if s not in segments)
+        self._close_retired()
+        logging.info('search index generation %s: %s segments, %s docs' % (self.generation, len(segments), len(self.live)))
+        return True
+
+    # 把当前delta写成段文件，写出期间新的修改进入新的delta
+    async def flush(self):
+        delta = self.delta
+        if not len(delta):
+            return
+        self.flushing.append(delta)
+        self.delta = Delta()
+        try:
+            await asyncio.get_event_loop().run_in_executor(None, commit_segment, self.index_dir, delta)
+            index_flushes.inc('delta')
+            await self.reload()
+        except Exception:
+            # 写失败的修改放回delta，下次再写
+            for key, doc in delta.docs.items():
+                if key not in self.delta.docs:
+                    self.delta.docs[key] = doc
+                    if doc is not None:
+                        for t, n in doc[0].items():
+                            self.delta.terms.setdefault(t, dict())[key] = n
+            raise
+        finally:
+            # 期间完成的重建可能已经把它去掉了
+            if delta in self.flushing:
+                self.flushing.remove(delta)
+            self._resolve()
+
+    # 用全量重建的结果替换所有的段；开始之前的delta也被结果覆盖，一起丢掉
+    async def replace(self, fresh, since):
+        if self.index_dir:
+            await asyncio.get_event_loop().run_in_executor(None, commit_segment, self.index_dir, fresh, since)
+            index_flushes.inc('rebuild')
+            await self.reload()
+        else:
+            self.segments = [fresh]
+        self.flushing = [d for d in self.flushing if d.created >= since]
+        self._resolve()
+
+# init_search()之前只是一个内存里的空索引，导入模块时不创建任何目录
+index = SearchIndex()
+
+# 相对路径按应用目录（本文件所在的目录）解析，不受启动时当前目录的影响
+def index_path(path):
+    if not path:
+        return None
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)), path)
+
+# 在app.init中调用：按配置打开索引目录，不存在时创建；bench.py等传入index_dir=None只用内存，不碰线上的索引
+# 目录建不了（如开发机上没有/var/lib的权限）时退回到内存索引，每个worker启动时各自全量建立
+def init_search(options=None):
+    global index
+    options = options or configs.search
+    path = index_path(options.index_dir)
+    try:
+        index = SearchIndex(path)
+    except OSError as e:
+        logging.warning('cannot open search index %s, using an in-memory index: %s' % (path, e))
+        index = SearchIndex()
+    logging.info('search index: %s' % (index.index_dir or 'memory'))
+    return index
+
+# 分片的表要读每个分片，按表归档时还要读归档表，归档的内容也可以被搜到
+# 按(created_at, id)每次select一块，不用stream长时间占用连接；since之后的行包括created_at正好等于since的
+async def scan(model, columns, since=None):
+    tables = [model.__table__]
+    archived = orm.archive_table(model)
+    if archived is not None:
+        tables.append(archived)
+    cols = ', '.join('`%s`' % c for c in ['id', 'created_at'] + columns)
+    chunk = configs.search.chunk
+    for table in tables:
+        for pool in (model._pools() or [None]):
+            cursor = None if since is None else (since, '')
+            while True:
+                if cursor is None:
+                    sql, args = 'select %s from `%s` order by `created_at`, `id` limit ?' % (cols, table), [chunk]
+                else:
+                    sql = 'select %s from `%s` where `created_at`>? or (`created_at`=? and `id`>?) order by `created_at`, `id` limit ?' % (cols, table)
+                    args = [cursor[0], cursor[0], cursor[1], chunk]
+                rs = await orm.select(sql, args, pool=pool)
+                if rs:
+                    yield [model(**r) for r in rs]
+                if len(rs) < chunk:
+                    break
+                cursor = (rs[-1]['created_at'], rs[-1]['id'])
+
+# target为Delta（全量重建）或SearchIndex（启动时补上新增的行），都有add(键, 词频, 长度, created_at)
+async def index_rows(target, since=None):
+    count = 0
+    for model, columns in ((Blog, ['name', 'summary', 'content']), (Comment, ['content'])):
+        async for rows in scan(model, columns, since):
+            # 分词在cpu pool里做，不长时间占用事件循环
+            results = await analyze_many([doc_parts(r) for r in rows])
+            for r, (tfs, length) in zip(rows, results):
+                target.add(doc_key(r), tfs, length, r.created_at)
+            count += len(rows)
+    return count
+
+async def rebuild():
+    since = time.time()
+    lock = FileLock(os.path.join(index.index_dir, 'REBUILD'), blocking=False) if index.index_dir else None
+    if lock is not None and not lock.acquire():
+        logging.info('search index rebuild already running in another worker.')
+        return
+    try:
+        # 当前delta里的修改都已经在数据库里，由这次扫描覆盖
+        index.flushing.append(index.delta)
+        index.delta = Delta()
+        fresh = Delta()
+        count = await index_rows(fresh)
+        await index.replace(fresh, since)
+        logging.info('search index rebuilt: %s docs in %.3fs' % (count, time.time() - since))
+    finally:
+        if lock is not None:
+            lock.release()
+
+# 启动时加载已有的段并补上水位线之后新增的行，没有段就全量重建；之后定期读取别的worker写出的段、写出自己的delta
+async def sync():
+    if index.index_dir:
+        await index.reload()
+    if not index.ready:
+        if not index.segments:
+            # 重建失败时下一次sync再试
+            if not await scheduler.run('search:rebuild'):
+                return
+        else:
+            count = await index_rows(index, index.watermark())
+            logging.info('search index caught up %s rows after %s' % (count, index.watermark()))
+        index.ready = True
+        return
+    delta = index.delta
+    if index.index_dir and len(delta) and (len(delta) >= configs.search.flush_docs or time.time() - delta.created >= configs.search.flush_interval):
+        await index.flush()
+
+# 键 => 还在分词的最新一次修改；同一个文档连续修改时只有最后一次的结果写进索引，删除会作废之前的修改
+_analyzing = dict()
+
+async def _analyze_and_add(key, parts, created_at):
+    try:
+        tfs, length = await asyncio.get_event_loop().run_in_executor(None, analyze, parts)
+    finally:
+        current = _analyzing.get(key) is asyncio.current_task()
+        if current:
+            del _analyzing[key]
+    if current:
+        index.add(key, tfs, length, created_at)
+
+# 分词在线程池里做，监听函数只创建任务
+@orm.add_listener
+def _index_rows(event, model):
+    if not isinstance(model, (Blog, Comment)):
+        return
+    key = doc_key(model)
+    if event == 'remove':
+        _analyzing.pop(key, None)
+        index.remove(key)
+    else:
+        _analyzing[key] = asyncio.ensure_future(_analyze_and_add(key, doc_parts(model), model.created_at))
+
+def snippet(text, query, width=120):
+    text = ' '.join((text or '').split())
+    low = text.lower()
+    found = [p for p in (low.find(w) for w in query.lower().split() + tokenize(query)) if p >= 0]
+    start = max(0, min(found) - width // 4) if found else 0
+    s = text[start:start + width]
+    return '%s%s%s' % ('...' if start > 0 else '', s, '...' if start + width < len(text) else '')
+
+async def search(query, kind=None, page_index=1, page_size=None):
+    hits = await index.query(query, kind)
+    p = Page(len(hits), page_index, page_size or configs.search.page_size)
+    if p.limit == 0:
+        return dict(page=p, results=())
+    page = hits[p.offset:p.offset + p.limit]
+    rows = await asyncio.gather(*[(Blog if key.startswith('blog:') else Comment).find(key.split(':', 1)[1]) for key, score in page])
+    results = []
+    for (key, score), r in zip(page, rows):
+        if r is None:
+            # 别的worker删除了但还没写出段，顺便从本地索引里去掉
+            index.remove(key)
+            continue
+        if isinstance(r, Blog):
+            results.append(dict(kind='blog', id=r.id, blog_id=r.id, title=r.name, user_name=r.user_name, created_at=r.created_at, score=score, snippet=snippet(r.content or r.summary, query)))
+        else:
+            results.append(dict(kind='comment', id=r.id, blog_id=r.blog_id, title=None, user_name=r.user_name, created_at=r.created_at, score=score, snippet=snippet(r.content, query)))
+    return dict(page=p, results=results)
+
+def register(scheduler):
+    scheduler.add('search:sync', sync, interval=configs.search.sync_interval, lock=False, warm=True)
+    # 段文件在本机目录里，用文件锁而不是数据库的命名锁，每台机器各自重建
+    scheduler.add('search:rebuild', rebuild, interval=configs.search.rebuild_interval or None, lock=False)
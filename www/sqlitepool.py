@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+A SQLite stand-in for the aiomysql pool, used by bench.py.
+
+It implements just the parts orm.py uses: pool.get()/acquire()/release(), conn.cursor(), cur.execute(),
+fetchmany()/fetchall(), rowcount and begin()/commit()/rollback().
+Statements run synchronously on the caller's thread; with an in-memory database
+this keeps the benchmark focused on the web stack instead of the database.
+'''
+
+__author__ = 'Hongqing Wang'
+
+import sqlite3, logging
+
+# MySQL的列类型到SQLite类型亲和性的映射，只取类型名的前缀判断
+def _sqlite_type(column_type):
+    t = column_type.lower()
+    if t.startswith(('bigint', 'int', 'boolean', 'bool')):
+        return 'integer'
+    if t.startswith(('real', 'float', 'double')):
+        return 'real'
+    return 'text'
+
+class Cursor(object):
+
+    def __init__(self, conn):
+        self._cur = conn.cursor()
+        self.rowcount = -1
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self._cur.close()
+
+    async def execute(self, sql, args=()):
+        # orm把?替换成了MySQL的%s，这里换回SQLite的?
+        sql = sql.replace('%s', '?')
+        # SQLite的写事务本来就锁住整个库，不支持也不需要select ... for update
+        if sql.rstrip().lower().endswith(' for update'):
+            sql = sql.rstrip()[:-len(' for update')]
+        self._cur.execute(sql, tuple(args or ()))
+        self.rowcount = self._cur.rowcount
+        return self.rowcount
+
+    def _rows(self, rows):
+        names = [d[0] for d in self._cur.description or ()]
+        return [dict(zip(names, r)) for r in rows]
+
+    async def fetchmany(self, size=None):
+        return self._rows(self._cur.fetchmany(size or self._cur.arraysize))
+
+    async def fetchall(self):
+        return self._rows(self._cur.fetchall())
+
+class Connection(object):
+
+    def __init__(self, db):
+        self._db = db
+
+    def cursor(self, cursorclass=None):
+        # 无论要求的是哪种cursor，都返回dict形式的行
+        return Cursor(self._db)
+
+    async def begin(self):
+        if not self._db.in_transaction:
+            self._db.execute('begin')
+
+    async def commit(self):
+        self._db.commit()
+
+    async def rollback(self):
+        self._db.rollback()
+
+    def close(self):
+        # 共享的sqlite连接不能被单个请求关闭
+        pass
+
+class _ConnectionContext(object):
+
+    def __init__(self, conn):
+        self._conn = conn
+
+    async def __aenter__(self):
+        return self._conn
+
+    async def __aexit__(self, exc_type, exc, tb):
+        pass
+
+class Pool(object):
+
+    # 单进程内使用，不需要orm.advisory_lock的跨进程锁
+    advisory_locks = False
+
+    def __init__(self, path=':memory:'):
+        # isolation_level=None即autocommit，和orm默认的autocommit=True一致
+        self._db = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self._conn = Connection(self._db)
+
+    def get(self):
+        return _ConnectionContext(self._conn)
+
+    async def acquire(self):
+        return self._conn
+
+    def release(self, conn):
+        pass
+
+    def create_tables(self, models):
+        for m in models:
+            columns = ['`%s` %s not null' % (k, _sqlite_type(v.column_type)) for k, v in m.__mappings__.items()]
+            columns.append('primary key (`%s`)' % m.__primary_key__)
+            self._db.execute('create table if not exists `%s` (%s)' % (m.__table__, ', '.join(columns)))
+            for k in m.__indexes__:
+                unique = 'unique ' if m.__mappings__[k].index == 'unique' else ''
+                self._db.execute('create %sindex if not exists `idx_%s_%s` on `%s` (`%s`)' % (unique, m.__table__, k, m.__table__, k))
+            logging.info('sqlite table created: %s' % m.__table__)
+
+    # 批量插入，用于快速准备测试数据
+    def insert_many(self, model, instances):
+        rows = []
+        for obj in instances:
+            args = list(map(obj.getValueOrDefault, model.__fields__))
+            args.append(obj.getValueOrDefault(model.__primary_key__))
+            rows.append(args)
+        self._db.executemany(model.__insert__, rows)
+
+    def close(self):
+        self._db.close()
+
+    async def wait_closed(self):
+        pass
+
+def create_pool(path=':memory:'):
+    return Pool(path)
@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = 'Hongqing Wang'
+
+import asyncio
+
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer
+
+import admission
+from admission import Limiter, Shed, HIGH, LOW
+from config import toDict
+
+def test_limit_queue_and_priority(loop):
+    l = Limiter('t', limit=1, max_queue=2, target=10)
+    order = []
+    async def go():
+        await l.acquire(LOW)
+        async def wait(name, priority):
+            await l.acquire(priority)
+            order.append(name)
+        low = asyncio.ensure_future(wait('low', LOW))
+        high = asyncio.ensure_future(wait('high', HIGH))
+        await asyncio.sleep(0)
+        assert l.active == 1 and len(l._waiters) == 2
+        with pytest.raises(Shed) as e:
+            await l.acquire(HIGH)
+        assert e.value.reason == 'queue_full'
+        # 先进队的是low，但high优先
+        l.release()
+        await asyncio.sleep(0)
+        l.release()
+        await asyncio.gather(low, high)
+        l.release()
+    loop.run_until_complete(go())
+    assert order == ['high', 'low'] and l.active == 0
+
+def test_cancelled_waiter_gives_back_its_slot(loop):
+    l = Limiter('t', limit=1, max_queue=10, target=10)
+    async def go():
+        await l.acquire(LOW)
+        waiter = asyncio.ensure_future(l.acquire(LOW))
+        await asyncio.sleep(0)
+        waiter.cancel()
+        l.release()
+        await asyncio.gather(waiter, return_exceptions=True)
+    loop.run_until_complete(go())
+    assert l.active == 0 and not l._waiters
+
+def test_codel_sheds_low_priority_after_interval(loop, monkeypatch):
+    l = Limiter('t', limit=1, max_queue=10, target=0.05, interval=0.1)
+    now = [0.0]
+    monkeypatch.setattr(l, '_loop_time', lambda: now[0])
+    async def go():
+        await l.acquire(LOW)
+        waiters = [asyncio.ensure_future(l.acquire(p)) for p in (LOW, LOW, HIGH, HIGH)]
+        await asyncio.sleep(0)
+        # 排队延迟高于target，但还没持续interval，照常放行（高优先级先出队）
+        now[0] = 0.1
+        l.release()
+        assert not l.dropping
+        # 持续超过interval进入dropping：低优先级直接拒绝，高优先级照常放行，新来的低优先级请求不再排队
+        now[0] = 0.3
+        l.release()
+        assert l.dropping and l.active == 1
+        with pytest.raises(Shed) as e:
+            await l.acquire(LOW)
+        assert e.value.reason == 'queue_delay'
+        # 队列排空后退出dropping
+        l.release()
+        results = await asyncio.gather(*waiters, return_exceptions=True)
+        assert results[2] is None and results[3] is None
+        assert [r.reason for r in results[:2]] == ['queue_delay', 'queue_delay']
+        assert not l.dropping and not l._waiters
+    loop.run_until_complete(go())
+
+def test_middleware_sheds_with_retry_after(loop):
+    options = toDict(dict(route_limit=1, global_limit=10, max_queue=0, target=0.05, interval=0.1, retry_after=7,
+                          high_priority=['/api/'], exempt=['/static/']))
+    started, release = asyncio.Event(), asyncio.Event()
+    async def slow(request):
+        started.set()
+        await release.wait()
+        return web.Response(text='ok')
+    app = web.Application(middlewares=[admission.admission_factory])
+    admission.init_admission(app, options)
+    app.router.add_route('GET', '/slow', slow)
+    app.router.add_route('GET', '/static/x', slow)
+    async def go():
+        async with TestClient(TestServer(app)) as client:
+            first = asyncio.ensure_future(client.get('/slow'))
+            await started.wait()
+            shed = await client.get('/slow')
+            assert shed.status == 503 and shed.headers['Retry-After'] == '7'
+            # exempt的路径不受限
+            started.clear()
+            exempt = asyncio.ensure_future(client.get('/static/x'))
+            await started.wait()
+            release.set()
+            assert (await first).status == 200 and (await exempt).status == 200
+        assert app['__admission__'].limiter('/slow').active == 0
+    loop.run_until_complete(go())
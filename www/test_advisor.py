@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = 'Hongqing Wang'
+
+import orm, advisor
+from models import User, Blog, Comment
+
+def test_index_columns_equality_then_order():
+    assert advisor.index_columns(Comment, '`blog_id`=?', 'created_at desc') == ['blog_id', 'created_at']
+    # 范围条件之后的排序列用不上索引
+    assert advisor.index_columns(Blog, 'user_id=? and created_at>?', 'name') == ['user_id', 'created_at']
+    assert advisor.index_columns(User, 'nosuch=?', None) == []
+
+def test_is_covered_needs_whole_prefix():
+    assert advisor.is_covered(Comment, ['blog_id'])
+    assert advisor.is_covered(Comment, ['id'])
+    assert not advisor.is_covered(Comment, ['blog_id', 'created_at'])
+    assert advisor.is_covered(User, ['email'])
+    assert not advisor.is_covered(Blog, ['name'])
+
+def test_create_table_ddl_has_declared_indexes():
+    assert 'key `idx_blog_id` (`blog_id`)' in Comment.__ddl__
+    assert 'primary key (`id`)' in Comment.__ddl__
+    assert Blog.__counters__ == ['comment_count', 'view_count']
+    assert 'comment_count' not in Blog.__update__
+
+def test_record_shape_normalizes_literals(db):
+    orm.record_shape('users', 'select 1', [], "email='a@b.com'", None)
+    orm.record_shape('users', 'select 1', [], "email='c@d.com'", None)
+    shapes = orm.get_query_shapes()
+    assert len(shapes) == 1
+    assert shapes[0]['where'] == 'email=?' and shapes[0]['count'] == 2
+
+def test_analyze_suggests_composite_index(loop, db, monkeypatch):
+    explained = []
+    async def fake_select(sql, args, size=None, pool=None):
+        explained.append((sql, pool))
+        return [dict(type='ref', Extra='Using where; Using filesort')]
+    monkeypatch.setattr(orm, 'select', fake_select)
+    shapes = [dict(table='comments', where='blog_id=?', orderBy='created_at desc', sql='select * from comments where blog_id=? order by created_at desc', args=['b'], count=9),
+              dict(table='users', where='email=?', orderBy='', sql='select * from users where email=?', args=['a'], count=1)]
+    report = loop.run_until_complete(advisor.analyze(shapes))
+    assert [r['table'] for r in report] == ['comments', 'users']
+    assert report[0]['suggestion'] == 'create index `idx_blog_id_created_at` on `comments` (`blog_id`, `created_at`);'
+    assert 'filesort' in advisor.format_report(report)
+
+def test_explain_runs_on_every_shard(loop, db, monkeypatch):
+    pools = []
+    async def fake_select(sql, args, size=None, pool=None):
+        pools.append(pool)
+        return [dict(type='ALL', Extra='')]
+    monkeypatch.setattr(orm, 'select', fake_select)
+    orm.set_shard_pool('s0', 'pool0')
+    orm.set_shard_pool('s1', 'pool1')
+    orm.set_shard_tables({'comments': ['s0', 's1']})
+    rs = loop.run_until_complete(advisor.explain(Comment, 'select * from comments', []))
+    assert pools == ['pool0', 'pool1'] and len(rs) == 2
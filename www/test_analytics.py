@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = 'Hongqing Wang'
+
+import time, asyncio
+
+import pytest
+
+import orm, analytics
+from models import Comment
+from scheduler import Scheduler
+
+@pytest.fixture(autouse=True)
+def fresh_series(monkeypatch):
+    monkeypatch.setattr(analytics, 'series', dict())
+    # 请求路径上不能用stream：它一直占着连接，也不受截止时间限制
+    def no_stream(*args, **kw):
+        raise AssertionError('orm.stream used by analytics')
+    monkeypatch.setattr(orm, 'stream', no_stream)
+
+def comments(loop, times):
+    for t in times:
+        loop.run_until_complete(Comment(blog_id='b', user_id='u', user_name='n', user_image='i', content='c', created_at=t).save())
+
+def test_rows_sharing_the_watermark_are_counted(loop, db):
+    t = time.time() - 3600
+    comments(loop, [t] * 5)
+    s = analytics.Series(Comment, chunk=2)
+    assert loop.run_until_complete(s.refresh()) == 5
+    assert s.watermark == t
+    # 和水位线同一时刻的新行也要算进去，已经读过的行不重复计数
+    comments(loop, [t, t + 1])
+    assert loop.run_until_complete(s.refresh()) == 2
+    assert s.total() == 7
+    assert loop.run_until_complete(s.refresh()) == 0
+    assert loop.run_until_complete(s.refresh(full=True)) == 7
+    assert s.total() == 7
+
+def test_histogram_stops_at_the_deadline_and_resumes(loop, db, monkeypatch):
+    now = time.time()
+    comments(loop, [now - i * 60 for i in range(10)])
+    select = orm.select
+    async def slow(*args, **kw):
+        await asyncio.sleep(0.02)
+        return (await select(*args, **kw))
+    monkeypatch.setattr(orm, 'select', slow)
+    monkeypatch.setattr(analytics.configs.analytics, 'chunk', 1)
+    async def request(timeout):
+        token = orm.set_deadline(timeout)
+        try:
+            return (await analytics.histogram('comments', days=2, window=1))
+        finally:
+            orm.reset_deadline(token)
+    r = loop.run_until_complete(request(0.07))
+    assert not r['complete']
+    assert 0 < r['total'] < 10
+    # 读到的块都已经记下，下一次从游标接着读
+    r = loop.run_until_complete(request(10))
+    assert r['complete'] and r['total'] == 10
+
+def test_refresh_job_keeps_viewed_tables_warm(loop, db):
+    s = Scheduler()
+    analytics.register(s)
+    assert s.jobs['analytics:refresh'].lock is False
+    comments(loop, [time.time()])
+    analytics.get_series('comments')
+    loop.run_until_complete(analytics.refresh())
+    assert analytics.series['comments'].total() == 1
+    assert list(analytics.series) == ['comments']
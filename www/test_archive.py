@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = 'Hongqing Wang'
+
+import time, sqlite3
+from datetime import datetime
+
+import pytest
+
+import orm, archive
+from config import configs, toDict
+from models import Comment
+from scheduler import Scheduler
+
+def comments(db, ages):
+    now = time.time()
+    cs = [Comment(blog_id='b', user_id='u', user_name='n', user_image='i', content='c%s' % i, created_at=now - age) for i, age in enumerate(ages)]
+    db.insert_many(Comment, cs)
+    db._db.execute('create table `comments_archive` as select * from `comments` where 0')
+    return cs
+
+def ids(db, table):
+    return set(r[0] for r in db._db.execute('select `id` from `%s`' % table))
+
+def test_archive_moves_old_rows_in_batches(loop, db):
+    cs = comments(db, (10, 200, 300, 400, 20))
+    moved = loop.run_until_complete(archive.archive_model(Comment, 'created_at', 100, batch=2, pause=0))
+    assert moved == 3
+    assert ids(db, 'comments') == set(c.id for c in (cs[0], cs[4]))
+    assert ids(db, 'comments_archive') == set(c.id for c in cs[1:4])
+
+def test_failed_delete_rolls_back_the_copy(loop, db):
+    cs = comments(db, (200, 300))
+    db._db.execute("create trigger `no_delete` before delete on `comments` begin select raise(abort, 'locked'); end")
+    with pytest.raises(sqlite3.DatabaseError):
+        loop.run_until_complete(archive.archive_model(Comment, 'created_at', 100, pause=0))
+    # 复制和删除在同一个事务里，删除失败时复制也被回滚，不会有两边都存在的行
+    assert ids(db, 'comments_archive') == set()
+    assert ids(db, 'comments') == set(c.id for c in cs)
+
+def test_partitions_use_integer_column(loop, db):
+    ddl = archive.partition_ddl(Comment, 'created_at', 'created_ts', datetime(2024, 11, 1), 3)
+    assert 'add column `created_ts` bigint as (floor(`created_at`)) stored' in ddl
+    assert 'partition by range (`created_ts`)' in ddl
+    assert 'floor(`created_at`)) (' not in ddl
+    assert 'partition p202501 values less than (%s)' % archive.month_start(2025, 2) in ddl
+    with pytest.raises(ValueError):
+        orm.set_archive('comments', 'created_at', 100, 'partition')
+    orm.set_archive('comments', 'created_at', 100, 'partition', 'created_ts')
+    where, args = Comment._prune('`blog_id`=?', ['b'])
+    assert where == '(`blog_id`=?) and `created_ts`>=?'
+    assert isinstance(args[1], int)
+
+def test_partition_mode_has_no_scheduler_job(monkeypatch):
+    options = toDict(dict(configs.archive, enabled=True))
+    monkeypatch.setattr(configs, 'archive', options)
+    s = Scheduler()
+    options.mode = 'partition'
+    archive.register(s)
+    assert 'archive' not in s.jobs
+    options.mode = 'table'
+    archive.register(s)
+    assert 'archive' in s.jobs
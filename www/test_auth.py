@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = 'Hongqing Wang'
+
+import time, asyncio
+
+import auth
+from models import User
+
+def test_cookie_roundtrip_and_tampering():
+    u = User(id='abc')
+    cookie = auth.user2cookie(u, 60)
+    assert auth.cookie2uid(cookie) == 'abc'
+    payload, sig = cookie.rsplit('-', 1)
+    assert auth.cookie2uid('%s-%s' % (payload, '0' * len(sig))) is None
+    # 改了过期时间签名就对不上
+    uid, expires = payload.rsplit('-', 1)
+    assert auth.cookie2uid('%s-%s-%s' % (uid, int(expires) + 1000, sig)) is None
+    assert auth.cookie2uid('garbage') is None
+    assert auth.cookie2uid(None) is None
+
+def test_expired_cookie(monkeypatch):
+    cookie = auth.user2cookie(User(id='abc'), 10)
+    now = time.time()
+    monkeypatch.setattr(auth.time, 'time', lambda: now + 11)
+    assert auth.cookie2uid(cookie) is None
+
+def test_password_hash_and_check(loop):
+    async def go():
+        hashed = await auth.hash_password('secret', 1000)
+        assert hashed.startswith('pbkdf2_sha256$1000$')
+        assert await auth.hash_password('secret', 1000) != hashed
+        return (await auth.check_password('secret', hashed), await auth.check_password('wrong', hashed),
+                await auth.check_password('secret', 'not-a-hash'))
+    assert loop.run_until_complete(go()) == (True, False, False)
+
+def test_user_cache_single_flight_and_invalidation(loop, db, monkeypatch):
+    u = User(name='a', email='a@b.com', passwd='x', image='i')
+    loop.run_until_complete(u.save())
+    calls = []
+    find = User.find.__func__
+    async def counting_find(cls, pk):
+        calls.append(pk)
+        await asyncio.sleep(0.01)
+        return await find(cls, pk)
+    monkeypatch.setattr(User, 'find', classmethod(counting_find))
+    cache = auth.UserCache(ttl=30)
+    monkeypatch.setattr(auth, 'user_cache', cache)
+    async def go():
+        users = await asyncio.gather(*[cache.get(u.id) for i in range(5)])
+        assert all(x.email == 'a@b.com' and x.passwd == '******' for x in users)
+        assert len(calls) == 1
+        await cache.get(u.id)
+        assert len(calls) == 1
+        # 写了这个用户之后缓存失效
+        u.name = 'b'
+        await u.update()
+        assert (await cache.get(u.id)).name == 'b'
+        assert len(calls) == 2
+    loop.run_until_complete(go())
+
+def test_user_cache_is_bounded():
+    cache = auth.UserCache(maxsize=2)
+    for uid in ('a', 'b', 'c'):
+        cache.put(uid, User(id=uid))
+    assert list(cache._data) == ['b', 'c']
@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = 'Hongqing Wang'
+
+import asyncio, functools
+
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer
+
+import orm
+from app import response_factory
+from admission import admission_factory, init_admission
+from config import configs, toDict
+from coroweb import get, add_route, add_routes
+from counters import counters
+from models import User, Blog
+
+# coroweb.add_route()用asyncio.coroutine包装@get/@post的wrapper，Python 3.11已经去掉了它
+@pytest.fixture(autouse=True)
+def legacy_coroutine(monkeypatch):
+    def coroutine(fn):
+        @functools.wraps(fn)
+        async def wrapper(*args, **kw):
+            r = fn(*args, **kw)
+            if asyncio.iscoroutine(r):
+                r = await r
+            return r
+        return wrapper
+    monkeypatch.setattr(asyncio, 'coroutine', coroutine, raising=False)
+
+def make_app(admission=None):
+    app = web.Application(middlewares=[admission_factory, response_factory])
+    init_admission(app, admission)
+    app['__request_timeout__'] = configs.request_timeout
+    add_routes(app, 'handlers')
+    return app
+
+def batch(loop, app, requests):
+    async def go():
+        async with TestClient(TestServer(app)) as client:
+            resp = await client.post('/api/batch', json=dict(requests=requests))
+            assert resp.status == 200
+            return (await resp.json())['responses']
+    return loop.run_until_complete(go())
+
+def test_batch_runs_api_routes_and_rejects_the_rest_before_running_them(loop, db):
+    loop.run_until_complete(User(name='a', email='a@b.com', passwd='x', image='i').save())
+    b = Blog(user_id='u', user_name='a', user_image='i', name='b', summary='s', content='c')
+    loop.run_until_complete(b.save())
+    views = counters.pending(Blog, 'view_count', b.id)
+    rs = batch(loop, make_app(), [
+        dict(path='/api/users'),
+        dict(path='/blog/%s' % b.id),
+        dict(method='POST', path='/api/authenticate', body=dict(email='a@b.com', passwd='x')),
+        dict(method='POST', path='/api/batch', body=dict(requests=[])),
+        dict(path='/api/nosuch'),
+        'junk'
+    ])
+    assert rs[0]['status'] == 200 and rs[0]['body']['users'][0]['name'] == 'a'
+    assert [r['status'] for r in rs[1:]] == [400, 400, 400, 404, 400]
+    assert rs[1]['body']['error'] == 'batch:invalid'
+    # 被拒绝的页面路由没有执行，阅读数没有增加
+    assert counters.pending(Blog, 'view_count', b.id) == views
+
+def test_sub_requests_are_charged_to_admission(loop, db, monkeypatch):
+    # 让查询真正让出事件循环，两个子请求同时在执行
+    select = orm.select
+    async def slow(*args, **kw):
+        await asyncio.sleep(0.01)
+        return (await select(*args, **kw))
+    monkeypatch.setattr(orm, 'select', slow)
+    options = toDict(dict(configs.admission, route_limit=1, max_queue=0))
+    app = make_app(options)
+    rs = batch(loop, app, [dict(path='/api/users?page=2'), dict(path='/api/users?page=2')])
+    assert sorted(r['status'] for r in rs) == [200, 503]
+    controller = app['__admission__']
+    assert controller.limiter('/api/users').active == 0 and controller.global_limiter.active == 0
+    # /api/batch本身不占名额
+    assert '/api/batch' not in controller.route_limiters
+
+def test_sub_requests_share_one_identity_map(loop, db, monkeypatch):
+    u = User(name='a', email='a@b.com', passwd='x', image='i')
+    loop.run_until_complete(u.save())
+    @get('/api/probe/{id}')
+    async def probe(id):
+        user = await User.find(id)
+        return dict(name=user.name, same=user is (await User.find(id)))
+    app = make_app()
+    add_route(app, probe)
+    queries = []
+    select = orm.select
+    async def counting(sql, args, size=None, pool=None):
+        queries.append(sql)
+        return (await select(sql, args, size, pool))
+    monkeypatch.setattr(orm, 'select', counting)
+    rs = batch(loop, app, [dict(path='/api/probe/%s' % u.id), dict(path='/api/probe/%s' % u.id)])
+    assert [r['body'] for r in rs] == [dict(name='a', same=True)] * 2
+    # 保存后台刷新物化视图的查询不算，按主键只查了一次
+    assert len([q for q in queries if q.endswith('where `id`=?')]) == 1
@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = 'Hongqing Wang'
+
+import argparse
+
+import aiohttp
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+import app, bench
+from models import User, Blog, Comment
+
+def test_percentile():
+    values = list(range(1, 101))
+    assert bench.percentile(values, 50) == 50
+    assert bench.percentile(values, 99) == 99
+    assert bench.percentile([7], 95) == 7
+    assert bench.percentile([], 50) is None
+
+def test_sqlite_pool_runs_the_orm(loop, db):
+    async def go():
+        u = User(name='a', email='a@b.com', passwd='x', image='i')
+        await u.save()
+        assert (await User.find(u.id)).email == 'a@b.com'
+        u.name = 'b'
+        await u.update()
+        assert [x.name for x in await User.findAll('email=?', ['a@b.com'])] == ['b']
+        assert await User.findNumber('id') == 1
+        await u.remove()
+        assert await User.find(u.id) is None
+    loop.run_until_complete(go())
+
+def test_seed(loop, db):
+    bench.seed(db, 4, 6, 10)
+    async def go():
+        return (await User.findNumber('id'), await Blog.findNumber('id'), await Comment.findNumber('id'),
+                await Comment.findAll(limit=1), await User.findAll('admin=?', [1]))
+    users, blogs, comments, sample, admins = loop.run_until_complete(go())
+    assert (users, blogs, comments) == (4, 6, 10)
+    assert loop.run_until_complete(Blog.find(sample[0].blog_id)) is not None
+    assert [u.name for u in admins] == ['user0']
+
+def test_drive_counts_errors(loop):
+    async def handler(request):
+        if request.query.get('fail'):
+            raise web.HTTPInternalServerError()
+        return web.Response(text='ok')
+    app = web.Application()
+    app.router.add_route('GET', '/', handler)
+    async def go():
+        server = TestServer(app)
+        await server.start_server()
+        try:
+            async with aiohttp.ClientSession() as s:
+                ok = await bench.drive(s, str(server.make_url('/')), 20, 4)
+                bad = await bench.drive(s, str(server.make_url('/?fail=1')), 5, 2)
+        finally:
+            await server.close()
+        return ok, bad
+    ok, bad = loop.run_until_complete(go())
+    assert ok['requests'] == 20 and ok['errors'] == 0 and ok['p50_ms'] is not None
+    assert bad['errors'] == 5
+
+def test_run_keeps_the_search_index_in_memory(loop, db, monkeypatch):
+    calls = []
+    class Server(object):
+        def close(self):
+            pass
+        async def wait_closed(self):
+            pass
+    async def init(loop, host, port, search_options=None):
+        calls.append(search_options)
+        return Server()
+    monkeypatch.setattr(app, 'init', init)
+    options = argparse.Namespace(db=':memory:', users=2, blogs=2, comments=2, host='127.0.0.1', port=0, concurrency=1, requests=1, paths=[])
+    loop.run_until_complete(bench.run(loop, options))
+    # 种下的假数据不能写进磁盘上的索引
+    assert calls[0].index_dir is None
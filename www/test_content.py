@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = 'Hongqing Wang'
+
+import os, asyncio
+
+import content
+
+def test_sanitize_strips_event_attributes_inside_tags_only():
+    html = '<p>x onload=1 and href=javascript:go</p><img src="a.png" onerror="alert(1)"><a href="javascript:alert(1)">a</a>'
+    out = content.sanitize(html)
+    # 正文里的文字原样保留
+    assert '<p>x onload=1 and href=javascript:go</p>' in out
+    assert '<img src="a.png">' in out
+    assert '<a href="#alert(1)">a</a>' in out
+
+def test_render_markdown_escapes_raw_html():
+    out = content.render_markdown('hello <script>alert(1)</script> onclick=x\n\n[a](javascript:alert(1))')
+    assert '<script>' not in out
+    assert 'onclick=x' in out
+    assert 'javascript:' not in out.split('</p>', 1)[1]
+
+def test_text2html():
+    assert content.text2html('a<b\n\n c ') == '<p>a&lt;b</p><p> c </p>'
+
+def test_cache_memory_disk_and_single_flight(loop, tmp_path, monkeypatch):
+    calls = []
+    def render(text):
+        calls.append(text)
+        return '<p>%s</p>' % text
+    monkeypatch.setattr(content, 'render_markdown', render)
+    cache = content.ContentCache(max_bytes=1024, cache_dir=str(tmp_path), offload_size=10 ** 6)
+
+    async def go():
+        return await asyncio.gather(*[cache.render('hello') for i in range(5)])
+    assert loop.run_until_complete(go()) == ['<p>hello</p>'] * 5
+    assert calls == ['hello']
+    key = content.content_key('hello')
+    assert os.path.exists(cache._path(key))
+    # 新的进程内存里没有，从磁盘读出来，不再渲染
+    fresh = content.ContentCache(max_bytes=1024, cache_dir=str(tmp_path), offload_size=10 ** 6)
+    assert loop.run_until_complete(fresh.render('hello')) == '<p>hello</p>'
+    assert calls == ['hello']
+    assert loop.run_until_complete(cache.render('')) == ''
+
+def test_cache_is_bounded_by_bytes(loop, monkeypatch):
+    monkeypatch.setattr(content, 'render_markdown', lambda text: text * 10)
+    cache = content.ContentCache(max_bytes=25, offload_size=10 ** 6)
+    for text in ('a', 'b', 'c'):
+        loop.run_until_complete(cache.render(text))
+    assert cache.size <= 25
+    assert list(cache._data) == [content.content_key('b'), content.content_key('c')]
+
+def test_plain_text_fallback_is_reported_and_cached_separately(monkeypatch, caplog):
+    key = content.content_key('# title')
+    assert content.check_renderer()
+    monkeypatch.setattr(content, 'markdown2', None)
+    assert not content.check_renderer()
+    assert 'markdown2 is not installed' in caplog.text
+    assert content.render_markdown('# title') == '<p># title</p>'
+    assert content.content_key('# title') != key
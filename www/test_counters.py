@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = 'Hongqing Wang'
+
+import time
+
+import pytest
+from aiohttp import web
+
+import orm
+import app as appmod
+import counters as countersmod
+from counters import Counters, reconcile
+from models import Blog, Comment
+
+def blog(loop, **kw):
+    b = Blog(user_id='u', user_name='a', user_image='i', name='b', summary='s', content='c', **kw)
+    loop.run_until_complete(b.save())
+    return b
+
+def stored(loop, b, field):
+    return (loop.run_until_complete(orm.select('select `%s` from `blogs` where `id`=?' % field, [b.id])))[0][field]
+
+def test_flush_batches_deltas_and_apply_adds_pending(loop, db):
+    c = Counters(max_batch=1)
+    b1, b2 = blog(loop), blog(loop)
+    c.incr(Blog, 'view_count', b1.id)
+    c.incr(Blog, 'view_count', b1.id)
+    c.incr(Blog, 'view_count', b2.id, 2)
+    assert c.size() == 2
+    obj = loop.run_until_complete(Blog.find(b1.id))
+    c.apply(obj)
+    assert obj.view_count == 2
+    assert loop.run_until_complete(c.flush()) == 2
+    assert c.size() == 0 and c.pending(Blog, 'view_count', b1.id) == 0
+    assert stored(loop, b1, 'view_count') == 2 and stored(loop, b2, 'view_count') == 2
+
+def test_failed_archive_update_does_not_apply_twice(loop, db):
+    c = Counters()
+    hot = blog(loop)
+    # missing既不在热表里，归档表也还不存在，归档表的update失败，整个事务回滚
+    orm.set_archive('blogs', 'created_at', 86400)
+    c.incr(Blog, 'view_count', hot.id, 3)
+    c.incr(Blog, 'view_count', 'missing', 3)
+    assert loop.run_until_complete(c.flush()) == 0
+    assert stored(loop, hot, 'view_count') == 0
+    assert c.pending(Blog, 'view_count', hot.id) == 3
+    db._db.execute('create table `blogs_archive` as select * from `blogs` where 0')
+    assert loop.run_until_complete(c.flush()) == 2
+    assert stored(loop, hot, 'view_count') == 3
+
+def comment(loop, b, created_at):
+    loop.run_until_complete(Comment(blog_id=b.id, user_id='u', user_name='a', user_image='i', content='x', created_at=created_at).save())
+
+def test_reconcile_fixes_only_settled_rows(loop, db, monkeypatch):
+    now = time.time()
+    quiet, busy, local = blog(loop), blog(loop), blog(loop)
+    # 换掉模块里的counters，保存评论时监听器加上的增量就像是其他worker的、已经丢失的增量，三行的计数都是0
+    for b, t in ((quiet, now - 600), (busy, now - 1), (local, now - 600)):
+        monkeypatch.setattr(countersmod, 'counters', Counters())
+        comment(loop, b, t)
+    c = Counters()
+    monkeypatch.setattr(countersmod, 'counters', c)
+    c.incr(Blog, 'comment_count', local.id)
+    flushed = []
+    async def flush():
+        flushed.append(True)
+        return 0
+    monkeypatch.setattr(c, 'flush', flush)
+    assert loop.run_until_complete(reconcile(window=3600, settle=60)) == 1
+    # 先写回本worker的增量
+    assert flushed == [True]
+    assert stored(loop, quiet, 'comment_count') == 1
+    # 最近还有评论的行其他worker可能还没写回，本worker有未写回增量的行也跳过
+    assert stored(loop, busy, 'comment_count') == 0
+    assert stored(loop, local, 'comment_count') == 0
+
+def test_transaction_rolls_back_on_error(loop, db):
+    b = blog(loop)
+    async def go():
+        async with orm.transaction() as tx:
+            rs = await tx.select('select `id` from `blogs` where `id`=? for update', [b.id])
+            assert rs == [dict(id=b.id)]
+            assert (await tx.execute('update `blogs` set `view_count`=? where `id`=?', [5, b.id])) == 1
+            raise RuntimeError('boom')
+    with pytest.raises(RuntimeError):
+        loop.run_until_complete(go())
+    assert stored(loop, b, 'view_count') == 0
+
+def test_pending_increments_survive_shutdown(loop, db, monkeypatch):
+    c = Counters()
+    monkeypatch.setattr(countersmod, 'counters', c)
+    b = blog(loop)
+    c.incr(Blog, 'view_count', b.id, 5)
+    steps = []
+    class Server(object):
+        def close(self):
+            steps.append('close')
+        async def wait_closed(self):
+            pass
+    class Handler(object):
+        async def shutdown(self, timeout):
+            steps.append('handler')
+    async def stop_scheduler(app):
+        steps.append('scheduler')
+    app = web.Application()
+    app.on_shutdown.append(stop_scheduler)
+    app.on_shutdown.append(countersmod.on_shutdown)
+    app.freeze()
+    loop.run_until_complete(appmod.shutdown(app, Server(), Handler()))
+    assert steps == ['close', 'scheduler', 'handler']
+    assert stored(loop, b, 'view_count') == 5 and c.size() == 0
@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = 'Hongqing Wang'
+
+import time, asyncio, threading
+
+from aiohttp import web
+
+import coroweb
+
+def slow_square(n):
+    time.sleep(0.05)
+    return n * n
+
+@coroweb.cpu_bound
+def whoami():
+    return threading.get_ident()
+
+@coroweb.cpu_bound
+def square(n):
+    return n * n
+
+def test_cpu_bound_runs_off_the_loop_thread(loop):
+    coroweb.init_cpu_pool('thread', 2, 8)
+    assert loop.run_until_complete(whoami()) != threading.get_ident()
+
+def test_full_queue_is_rejected(loop):
+    pool = coroweb.CPUPool('thread', workers=1, max_queue=2)
+    async def go():
+        results = await asyncio.gather(*[pool.run(slow_square, n) for n in range(3)], return_exceptions=True)
+        assert results[:2] == [0, 1]
+        assert isinstance(results[2], web.HTTPServiceUnavailable)
+        assert results[2].headers['Retry-After'] == '1'
+        assert pool.pending == 0
+        # 队列空出来之后又可以提交
+        assert await pool.run(slow_square, 3) == 9
+    try:
+        loop.run_until_complete(go())
+    finally:
+        pool.shutdown()
+
+def test_process_pool_calls_module_level_function(loop):
+    coroweb.init_cpu_pool('process', 1, 4)
+    try:
+        assert loop.run_until_complete(square(7)) == 49
+    finally:
+        coroweb.init_cpu_pool('thread', 4, 64)
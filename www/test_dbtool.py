@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = 'Hongqing Wang'
+
+import time
+
+import orm, dbtool
+from models import Comment
+
+def _comments(n, content='x'):
+    now = time.time()
+    return [Comment(blog_id='b%s' % (i % 3), user_id='u', user_name='n', user_image='i', content='%s %s' % (content, i), created_at=now - i) for i in range(n)]
+
+def test_archive_tables_are_exported_and_imported(loop, db, tmp_path):
+    assert dbtool.MODELS['comments_archive'] is Comment
+    db._db.execute('create table `comments_archive` as select * from `comments` where 0')
+    archived = _comments(5, 'old')
+    db.insert_many(Comment, archived)
+    db._db.execute('insert into `comments_archive` select * from `comments`')
+    db._db.execute('delete from `comments`')
+    path = str(tmp_path / 'comments_archive.ndjson')
+    assert loop.run_until_complete(dbtool.export(Comment, path, chunk=2, table='comments_archive')) == 5
+    db._db.execute('delete from `comments_archive`')
+    assert loop.run_until_complete(dbtool.import_(Comment, path, chunk=2, workers=1, table='comments_archive')) == 5
+    rows = db._db.execute('select `id`, `content` from `comments_archive` order by `id`').fetchall()
+    assert rows == sorted((c.id, c.content) for c in archived)
+    # 原表不受影响
+    assert db._db.execute('select count(*) from `comments`').fetchone()[0] == 0
+
+def test_split_by_size_counts_escapes_and_utf8():
+    rows = [('a' * 100,), ('中' * 100,), ("'" * 100,), ('b',)]
+    sizes = [dbtool.row_size(r) for r in rows]
+    # 中文每个字符3字节，引号转义后翻倍
+    assert sizes[1] >= 300 and sizes[2] >= 200
+    batches = list(dbtool.split_by_size(rows, 350, head=20))
+    assert [len(b) for b in batches] == [1, 1, 2]
+    for b in batches:
+        assert len(b) == 1 or 20 + sum(map(dbtool.row_size, b)) <= 350
+    # 超过上限的单行自成一批
+    assert list(dbtool.split_by_size([('x' * 1000,)], 100)) == [[('x' * 1000,)]]
+
+def test_insert_rows_splits_statements_by_bytes(loop, db, monkeypatch):
+    statements = []
+    execute = orm.execute
+    async def counting(sql, args, autocommit=True, pool=None):
+        statements.append(len(sql) + sum(len(str(a).encode('utf-8')) for a in args))
+        return (await execute(sql, args, autocommit, pool))
+    monkeypatch.setattr(orm, 'execute', counting)
+    cs = _comments(20, 'y' * 200)
+    cols = dbtool.columns(Comment)
+    values = [tuple(c.getValueOrDefault(k) for k in cols) for c in cs]
+    loop.run_until_complete(dbtool.insert_rows(Comment, cols, values, max_bytes=2000))
+    assert len(statements) > 1
+    assert all(n <= 2000 for n in statements)
+    assert db._db.execute('select count(*) from `comments`').fetchone()[0] == 20
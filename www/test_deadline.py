@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = 'Hongqing Wang'
+
+import asyncio
+
+import pytest
+
+import orm
+from scheduler import Scheduler
+
+class FakeCursor(object):
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
+    async def execute(self, sql, args=None):
+        self.conn.executed.append(sql)
+        if sql.startswith('KILL QUERY'):
+            # 被KILL的查询以1317错误返回
+            self.conn.target.running.set_exception(RuntimeError('1317 query interrupted'))
+            return
+        self.conn.running = asyncio.get_event_loop().create_future()
+        await self.conn.running
+
+class FakeConnection(object):
+
+    def __init__(self, target=None):
+        self.target = target
+        self.executed = []
+        self.running = None
+        self.closed = False
+
+    def thread_id(self):
+        return 42
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def close(self):
+        self.closed = True
+
+KW = dict(host='db', port=3306, user='www-data', password='www-data', db='awesome')
+
+def test_earlier_deadline_wins(loop):
+    async def go():
+        outer = orm.set_deadline(0.5)
+        inner = orm.set_deadline(10)
+        try:
+            assert orm.remaining_time() <= 0.5
+        finally:
+            orm.reset_deadline(inner)
+            orm.reset_deadline(outer)
+        assert orm.remaining_time() is None
+    loop.run_until_complete(go())
+
+def test_waiting_for_a_connection_is_bounded(loop):
+    class FullPool(object):
+        async def acquire(self):
+            await asyncio.sleep(10)
+    async def go():
+        token = orm.set_deadline(0.05)
+        try:
+            async with orm._Connection(FullPool()):
+                pass
+        finally:
+            orm.reset_deadline(token)
+    with pytest.raises(orm.DeadlineExceeded):
+        loop.run_until_complete(go())
+
+def test_slow_query_is_killed_with_a_connect_timeout(loop, monkeypatch):
+    conn = FakeConnection()
+    connects = []
+    async def connect(**kw):
+        connects.append(kw)
+        return FakeConnection(conn)
+    monkeypatch.setattr(orm.aiomysql, 'connect', connect)
+    monkeypatch.setattr(orm, '_get_pool_kw', lambda pool=None: KW)
+    async def go():
+        token = orm.set_deadline(0.05)
+        try:
+            await orm._execute_with_deadline(conn, conn.cursor(), 'select sleep(10)', ())
+        finally:
+            orm.reset_deadline(token)
+    with pytest.raises(orm.DeadlineExceeded):
+        loop.run_until_complete(go())
+    assert connects[0]['connect_timeout'] == orm.KILL_CONNECT_TIMEOUT
+    # 查询已被中断，连接还可以放回pool
+    assert not conn.closed
+
+def test_unreachable_killer_closes_the_connection(loop, monkeypatch):
+    conn = FakeConnection()
+    async def connect(**kw):
+        raise OSError('connect timed out')
+    monkeypatch.setattr(orm.aiomysql, 'connect', connect)
+    monkeypatch.setattr(orm, '_get_pool_kw', lambda pool=None: KW)
+    async def go():
+        token = orm.set_deadline(0.05)
+        try:
+            await orm._execute_with_deadline(conn, conn.cursor(), 'select sleep(10)', ())
+        finally:
+            orm.reset_deadline(token)
+    with pytest.raises(orm.DeadlineExceeded):
+        loop.run_until_complete(go())
+    assert conn.closed
+
+def test_triggered_job_does_not_inherit_the_request_context(loop):
+    s = Scheduler()
+    seen = []
+    async def job():
+        seen.append((orm.remaining_time(), orm._identity_map.get()))
+    s.add('job', job, lock=False)
+    async def request():
+        token = orm.set_deadline(0.01)
+        orm.begin_identity_scope()
+        try:
+            await s.trigger('job')
+            await s.run('job')
+        finally:
+            orm.reset_deadline(token)
+    loop.run_until_complete(request())
+    assert seen == [(None, None), (None, None)]
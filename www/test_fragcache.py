@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = 'Hongqing Wang'
+
+import time
+
+import app, handlers
+from fragcache import FragmentCache, fragment_cache
+from models import Blog, Comment
+
+def test_ttl_lru_and_tags(monkeypatch):
+    cache = FragmentCache(maxsize=2)
+    cache.set('a', 'A', 10, ['t'])
+    cache.set('b', 'B', None, ['t', 'u'])
+    assert cache.get('a') == 'A'
+    # a刚被访问过，淘汰的是b
+    cache.set('c', 'C')
+    assert cache.get('b') is None and cache.get('a') == 'A'
+    now = time.time()
+    monkeypatch.setattr(time, 'time', lambda: now + 11)
+    assert cache.get('a') is None
+    cache.set('d', 'D', None, ['u'])
+    cache.invalidate_tag('u')
+    assert cache.get('d') is None and cache.get('c') == 'C'
+
+def test_cache_tag_renders_once(loop):
+    env = dict()
+    app.init_jinja2(env)
+    t = env['__templating__'].from_string("{% cache 'test:x', 60, 'xs' %}<b>{{ n }}</b>{% endcache %}")
+    try:
+        assert t.render(n=1) == '<b>1</b>'
+        assert t.render(n=2) == '<b>1</b>'
+        fragment_cache.invalidate_tag('xs')
+        assert t.render(n=3) == '<b>3</b>'
+    finally:
+        fragment_cache.clear()
+
+def test_comment_write_invalidates_only_its_blog(loop, db):
+    fragment_cache.set('blog:comments:1', 'one', 60, ['comments:1'])
+    fragment_cache.set('blog:comments:2', 'two', 60, ['comments:2'])
+    try:
+        c = Comment(blog_id='1', user_id='u', user_name='a', user_image='i', content='hi')
+        loop.run_until_complete(c.save())
+        assert fragment_cache.get('blog:comments:1') is None
+        assert fragment_cache.get('blog:comments:2') == 'two'
+    finally:
+        fragment_cache.clear()
+
+def test_get_blog_skips_comments_when_fragment_cached(loop, db, monkeypatch):
+    b = Blog(user_id='u', user_name='a', user_image='i', name='b', summary='s', content='body')
+    loop.run_until_complete(b.save())
+    loop.run_until_complete(Comment(blog_id=b.id, user_id='u', user_name='a', user_image='i', content='first').save())
+    queries = []
+    find_all = Comment.findAll
+    async def counting(*args, **kw):
+        queries.append(args)
+        return (await find_all(*args, **kw))
+    monkeypatch.setattr(Comment, 'findAll', counting)
+    env = dict()
+    app.init_jinja2(env, filters=dict(datetime=app.datetime_filter))
+    template = env['__templating__'].get_template('blog.html')
+    try:
+        r = loop.run_until_complete(handlers.get_blog(b.id))
+        assert r['comments_html'] is None and len(r['comments']) == 1
+        first = template.render(**r)
+        assert 'first' in first
+        r = loop.run_until_complete(handlers.get_blog(b.id))
+        # 片段命中，评论不再查询
+        assert len(queries) == 1
+        assert r['comments'] == () and 'first' in r['comments_html']
+        assert 'first' in template.render(**r)
+    finally:
+        fragment_cache.clear()
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = 'Hongqing Wang'
+
+import json, time
+
+import pytest
+
+import orm, hub as hubmod
+from hub import Hub, Poller, sse_frame, hub
+from models import Blog, Comment
+
+@pytest.fixture
+def clean_hub():
+    topics, published = hub.topics, hub._published
+    hub.topics, hub._published = dict(), type(published)()
+    yield hub
+    hub.topics, hub._published = topics, published
+
+def test_sse_frame():
+    assert sse_frame('comment', 'a\nb', 7) == b'id: 7\nevent: comment\ndata: a\ndata: b\n\n'
+
+def test_slow_consumer_is_dropped(loop):
+    h = Hub(buffer_size=1)
+    fast, slow = h.subscribe('t'), h.subscribe('t')
+    h.publish('t', b'1')
+    loop.run_until_complete(fast.get())
+    h.publish('t', b'2')
+    assert slow.dropped and h.count == 1
+    assert loop.run_until_complete(slow.get()) is None
+    assert loop.run_until_complete(fast.get()) == b'2'
+
+def test_local_save_is_published_once(loop, db, clean_hub):
+    sub = hub.subscribe('blog:b1')
+    c = Comment(blog_id='b1', user_id='u', user_name='a', user_image='i', content='hi')
+    loop.run_until_complete(c.save())
+    frame = loop.run_until_complete(sub.get())
+    assert json.loads(frame.decode('utf-8').split('data: ')[1])['content'] == 'hi'
+    # 轮询到本worker已经推送过的行时不再推送
+    loop.run_until_complete(Poller(lookback=5).poll())
+    assert sub.queue.empty()
+
+def test_poll_publishes_rows_saved_by_other_workers(loop, db, clean_hub):
+    comments, blogs = hub.subscribe('blog:b1'), hub.subscribe('blogs')
+    poller = Poller(lookback=5)
+    # 模拟其他worker：直接写库，不经过本进程的listener
+    now = time.time()
+    loop.run_until_complete(orm.execute('insert into `comments` (`id`, `blog_id`, `user_id`, `user_name`, `user_image`, `content`, `created_at`) values (?, ?, ?, ?, ?, ?, ?)',
+                                        ['c1', 'b1', 'u', 'a', 'i', 'remote', now]))
+    loop.run_until_complete(orm.execute('insert into `blogs` (`id`, `user_id`, `user_name`, `user_image`, `name`, `summary`, `content`, `created_at`, `comment_count`, `view_count`) values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                                        ['b2', 'u', 'a', 'i', 'remote blog', 's', 'body', now, 0, 0]))
+    loop.run_until_complete(poller.poll())
+    assert b'remote' in loop.run_until_complete(comments.get())
+    frame = loop.run_until_complete(blogs.get())
+    assert b'remote blog' in frame and b'body' not in frame
+    # 下一次轮询的窗口和上一次重叠，但不会重复推送
+    loop.run_until_complete(poller.poll())
+    assert comments.queue.empty() and blogs.queue.empty()
+
+def test_no_query_without_subscribers(loop, db, clean_hub, monkeypatch):
+    queries = []
+    async def find_all(*args, **kw):
+        queries.append(args)
+        return []
+    monkeypatch.setattr(Comment, 'findAll', find_all)
+    monkeypatch.setattr(Blog, 'findAll', find_all)
+    loop.run_until_complete(Poller().poll())
+    assert queries == []
+
+def test_first_seen_forgets_old_ids(monkeypatch):
+    h = Hub(remember=10)
+    monkeypatch.setattr(hubmod.time, 'time', lambda: 105)
+    assert h.first_seen('a', 100) and not h.first_seen('a', 100)
+    monkeypatch.setattr(hubmod.time, 'time', lambda: 200)
+    assert h.first_seen('b', 195)
+    assert list(h._published) == ['b']
@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = 'Hongqing Wang'
+
+import json
+
+import pytest
+
+import idgen, migrate_ids
+from apis import json_dumps
+from models import User
+
+def test_b32_roundtrip_keeps_order():
+    values = [0, 1, 31, 32, 2 ** 40 + 7, 2 ** 63 - 1]
+    encoded = [idgen.b32encode(n) for n in values]
+    assert [idgen.b32decode(s) for s in encoded] == values
+    assert encoded == sorted(encoded)
+    assert all(len(s) == idgen.B32_LENGTH for s in encoded)
+
+def test_next_int_is_monotonic_within_one_ms(monkeypatch):
+    g = idgen.SnowflakeIdGenerator(worker_id=3)
+    monkeypatch.setattr(idgen.time, 'time', lambda: 1500000000.0)
+    ids = [g.next_int() for i in range(idgen.MAX_SEQUENCE + 10)]
+    assert ids == sorted(ids) and len(set(ids)) == len(ids)
+    # 序号用完后借用下一毫秒
+    assert g.timestamp(g.encode(ids[-1])) == 1500000000.001
+    assert (ids[0] >> idgen.SEQUENCE_BITS) & idgen.MAX_WORKER == 3
+
+def test_workers_do_not_collide(monkeypatch):
+    monkeypatch.setattr(idgen.time, 'time', lambda: 1500000000.0)
+    a, b = idgen.SnowflakeIdGenerator(worker_id=1), idgen.SnowflakeIdGenerator(worker_id=2)
+    assert a.next_id() != b.next_id()
+
+def test_next_id_requires_worker_id():
+    g = idgen.SnowflakeIdGenerator()
+    with pytest.raises(RuntimeError):
+        g.next_id()
+
+def test_claim_worker_id(loop, db):
+    g = idgen.SnowflakeIdGenerator()
+    assert loop.run_until_complete(idgen.claim_worker_id(g)) == 0
+    assert g.worker_id == 0 and g.next_id()
+    # 已经有worker id时不再领取
+    g.worker_id = 7
+    assert loop.run_until_complete(idgen.claim_worker_id(g)) == 7
+
+def test_from_timestamp_carries_overflow():
+    g = idgen.SnowflakeIdGenerator(worker_id=0)
+    t = 1500000000.0
+    assert g.from_timestamp(t, idgen.MAX_SEQUENCE + 1) == g.from_timestamp(t + 0.001, 0)
+    assert g.from_timestamp(t, idgen.MAX_SEQUENCE) < g.from_timestamp(t, idgen.MAX_SEQUENCE + 1)
+
+def test_build_mapping_unique_for_crowded_ms(loop, db):
+    t = 1500000000.0
+    users = [User(name='u%s' % n, email='u%s@x' % n, passwd='x', image='i', created_at=t if n < 5000 else t + 0.001) for n in range(5010)]
+    db.insert_many(User, users)
+    g = idgen.SnowflakeIdGenerator(worker_id=0)
+    mapping = loop.run_until_complete(migrate_ids.build_mapping(User, g))
+    assert len(mapping) == 5010
+    assert len(set(mapping.values())) == 5010
+
+def test_json_dumps_stringifies_bigint_ids():
+    g = idgen.SnowflakeIdGenerator(worker_id=1, storage='bigint')
+    n = g.next_id()
+    assert n > 2 ** 53
+    assert json.loads(json_dumps(dict(id=n, count=3, ok=True))) == dict(id=str(n), count=3, ok=True)
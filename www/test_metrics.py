@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = 'Hongqing Wang'
+
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer
+
+import orm, metrics
+
+def test_histogram_render_is_cumulative():
+    r = metrics.Registry()
+    h = r.histogram('t_seconds', 'test.', ('route',), buckets=(0.1, 1.0))
+    for v in (0.05, 0.5, 0.5, 5):
+        h.observe('/a', value=v)
+    text = r.render()
+    assert 't_seconds_bucket{route="/a",le="0.1"} 1' in text
+    assert 't_seconds_bucket{route="/a",le="1.0"} 3' in text
+    assert 't_seconds_bucket{route="/a",le="+Inf"} 4' in text
+    assert 't_seconds_count{route="/a"} 4' in text
+    assert 't_seconds_sum{route="/a"} 6.05' in text
+
+def test_labels_are_escaped_and_kinds_checked():
+    r = metrics.Registry()
+    r.counter('c_total', 'test.', ('sql',)).inc('a "b"\n')
+    assert 'c_total{sql="a \\"b\\"\\n"} 1' in r.render()
+    with pytest.raises(ValueError):
+        r.gauge('c_total', 'test.')
+
+def _count(route, method, status):
+    return metrics.http_requests.children.get((route, method, status), 0)
+
+def test_middleware_counts_by_route_template(loop):
+    async def ok(request):
+        return web.Response(status=201)
+    async def missing(request):
+        raise web.HTTPNotFound()
+    app = web.Application(middlewares=[metrics.metrics_factory])
+    app.router.add_route('GET', '/items/{id}', ok)
+    app.router.add_route('GET', '/gone/{id}', missing)
+    before = (_count('/items/{id}', 'GET', '201'), _count('/gone/{id}', 'GET', '404'))
+    async def go():
+        async with TestClient(TestServer(app)) as client:
+            for i in range(3):
+                await (await client.get('/items/%s' % i)).release()
+            await (await client.get('/gone/1')).release()
+    loop.run_until_complete(go())
+    assert _count('/items/{id}', 'GET', '201') == before[0] + 3
+    assert _count('/gone/{id}', 'GET', '404') == before[1] + 1
+    assert metrics.http_in_flight.children[('/items/{id}',)] == 0
+
+def test_sql_latency_keyed_by_template(loop, db):
+    loop.run_until_complete(orm.select("select * from users where email='a@b.com'", []))
+    assert ('select * from users where email=?',) in metrics.sql_latency.children
+    with pytest.raises(Exception):
+        loop.run_until_complete(orm.select('select * from nosuch', []))
+    assert metrics.sql_errors.children[('select * from nosuch',)] >= 1
@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = 'Hongqing Wang'
+
+import re, time, asyncio, logging
+
+import pytest
+
+import profiler
+
+def busy_function(seconds):
+    end = time.time() + seconds
+    while time.time() < end:
+        pass
+
+def test_profile_samples_the_loop_thread(loop):
+    async def go():
+        loop.call_later(0.02, busy_function, 0.15)
+        return await profiler.profile(0.1, interval=0.002)
+    text = loop.run_until_complete(go())
+    lines = text.strip().split('\n')
+    assert any('busy_function (test_profiler.py' in l for l in lines)
+    stack, n = lines[0].rsplit(' ', 1)
+    assert int(n) > 0 and ';' in stack
+
+def test_only_one_profile_at_a_time(loop):
+    async def go():
+        first = asyncio.ensure_future(profiler.profile(0.05))
+        await asyncio.sleep(0)
+        with pytest.raises(RuntimeError):
+            await profiler.profile(0.05)
+        await first
+    loop.run_until_complete(go())
+
+def test_watchdog_reports_blocking_callback(loop, caplog):
+    profiler.BlockingWatchdog(loop, threshold=0.05).start()
+    async def go():
+        await asyncio.sleep(0.05)
+        busy_function(0.2)
+        await asyncio.sleep(0.05)
+    with caplog.at_level(logging.WARNING):
+        loop.run_until_complete(go())
+    reports = [r.getMessage() for r in caplog.records if 'event loop blocked' in r.getMessage()]
+    assert reports and 'busy_function' in reports[0]
+    # 报告的是阻塞时长的范围，宽度为心跳间隔，下限不会超过真正阻塞的时间
+    low, high = map(float, re.match(r'event loop blocked for ([\d.]+)-([\d.]+)s', reports[0]).groups())
+    assert 0.05 <= high and low <= 0.2 and abs(high - low - 0.005) <= 0.0011
@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = 'Hongqing Wang'
+
+import json, asyncio
+
+import orm, matview
+from scheduler import Scheduler
+from models import User
+
+class FakeLock(object):
+    '''
+    advisory_lock stand-in: the first `held` attempts find the lock taken by another worker.
+    '''
+
+    attempts = []
+    held = 0
+
+    def __init__(self, name, timeout=0):
+        self.timeout = timeout
+
+    async def __aenter__(self):
+        FakeLock.attempts.append(self.timeout)
+        if FakeLock.held:
+            FakeLock.held -= 1
+            return False
+        return True
+
+    async def __aexit__(self, *args):
+        pass
+
+def fake_lock(monkeypatch, held):
+    FakeLock.attempts, FakeLock.held = [], held
+    monkeypatch.setattr(orm, 'advisory_lock', FakeLock)
+
+def test_run_is_single_flight_and_trigger_during_run_reruns(loop):
+    s = Scheduler()
+    calls = []
+    release = asyncio.Event()
+    async def job():
+        calls.append(len(calls))
+        if len(calls) == 1:
+            await release.wait()
+    s.add('job', job, lock=False)
+    async def go():
+        first = asyncio.ensure_future(s.run('job'))
+        while not calls:
+            await asyncio.sleep(0)
+        second = asyncio.ensure_future(s.run('job'))
+        s.trigger('job')
+        s.trigger('job')
+        release.set()
+        assert (await first) and (await second)
+        while s.jobs['job'].running is not None or s.jobs['job'].dirty:
+            await asyncio.sleep(0.01)
+    loop.run_until_complete(go())
+    # 两次run合并成一次，执行期间的两次trigger合并成结束后的一次
+    assert calls == [0, 1]
+
+def test_failures_back_off_exponentially():
+    s = Scheduler(retry=1, max_backoff=5)
+    job = s.add('job', None, interval=60, jitter=0)
+    assert job.next_delay(s.retry, s.max_backoff) == 60
+    delays = []
+    for n in range(1, 5):
+        job.failures = n
+        delays.append(job.next_delay(s.retry, s.max_backoff))
+    assert delays == [1, 2, 4, 5]
+
+def test_periodic_run_skips_a_held_lock(loop, monkeypatch):
+    fake_lock(monkeypatch, held=1)
+    s = Scheduler(lock_wait=3)
+    calls = []
+    async def job():
+        calls.append(1)
+    s.add('job', job)
+    assert loop.run_until_complete(s.run('job')) is False
+    assert FakeLock.attempts == [0] and calls == [] and not s.jobs['job'].dirty
+
+def test_triggered_run_waits_for_the_lock_and_stays_dirty(loop, monkeypatch):
+    fake_lock(monkeypatch, held=2)
+    s = Scheduler(lock_wait=3)
+    calls = []
+    async def job():
+        calls.append(1)
+    s.add('job', job)
+    async def go():
+        s.trigger('job')
+        while s.jobs['job'].running is not None or s.jobs['job'].dirty:
+            await asyncio.sleep(0.01)
+    loop.run_until_complete(go())
+    # 两次等锁超时后仍然保持dirty，第三次拿到锁执行
+    assert FakeLock.attempts == [3, 3, 3] and calls == [1]
+
+def test_materialized_view_refresh_and_trigger_on_write(loop, db, monkeypatch):
+    s = Scheduler()
+    monkeypatch.setattr(matview, 'scheduler', s)
+    monkeypatch.setattr(matview, 'views', dict())
+    async def compute():
+        return [u.name for u in (await User.findAll(orderBy='name'))]
+    view = matview.materialize('test:names', tables=('users',), ttl=0)(compute)
+    assert loop.run_until_complete(view.get()) == []
+    async def go():
+        await User(name='a', email='a@b.com', passwd='x', image='i').save()
+        job = s.jobs['test:names']
+        while job.running is not None or job.dirty:
+            await asyncio.sleep(0.01)
+        return (await view.get())
+    assert loop.run_until_complete(go()) == ['a']
+    row = loop.run_until_complete(orm.select('select `value` from `materialized_views` where `name`=?', ['test:names']))
+    assert json.loads(row[0]['value']) == ['a']
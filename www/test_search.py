@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = 'Hongqing Wang'
+
+import os, asyncio, threading
+
+import pytest
+
+import search
+from config import configs, toDict
+from models import Blog
+
+@pytest.fixture(autouse=True)
+def memory_index(monkeypatch):
+    monkeypatch.setattr(search, 'index', search.SearchIndex())
+    monkeypatch.setattr(search, '_analyzing', dict())
+
+def blog(loop, name, content):
+    b = Blog(user_id='u', user_name='n', user_image='i', name=name, summary='', content=content)
+    loop.run_until_complete(b.save())
+    return b
+
+def settle(loop):
+    loop.run_until_complete(asyncio.gather(*search._analyzing.values()))
+
+def test_index_dir_is_created_by_init_relative_to_the_app(monkeypatch, tmp_path):
+    app_dir, cwd = tmp_path / 'www', tmp_path / 'cwd'
+    app_dir.mkdir()
+    cwd.mkdir()
+    monkeypatch.chdir(cwd)
+    monkeypatch.setattr(search, '__file__', str(app_dir / 'search.py'))
+    index = search.init_search(toDict(dict(configs.search, index_dir='idx')))
+    assert index is search.index
+    assert index.index_dir == str(app_dir / 'idx') and os.path.isdir(index.index_dir)
+    assert os.listdir(cwd) == []
+    assert search.init_search(toDict(dict(configs.search, index_dir=None))).index_dir is None
+    # 建不了目录时退回到内存索引
+    (tmp_path / 'file').write_text('')
+    assert search.init_search(toDict(dict(configs.search, index_dir=str(tmp_path / 'file' / 'idx')))).index_dir is None
+
+def test_listener_tokenizes_off_the_loop(loop, db, monkeypatch):
+    threads = []
+    analyze = search.analyze
+    def recording(parts):
+        threads.append(threading.get_ident())
+        return analyze(parts)
+    monkeypatch.setattr(search, 'analyze', recording)
+    b = blog(loop, 'Python tips', 'asyncio and executors')
+    assert search.index.search('asyncio') == []
+    settle(loop)
+    assert threads and threading.get_ident() not in threads
+    assert [k for k, s in search.index.search('asyncio')] == ['blog:%s' % b.id]
+
+def test_remove_cancels_pending_analysis(loop, db):
+    b = blog(loop, 'gone', 'soon removed')
+    loop.run_until_complete(b.remove())
+    settle(loop)
+    assert search.index.search('removed') == []
+    # 连续两次修改只有后一次生效
+    b = blog(loop, 'first', 'alpha')
+    b.content = 'beta'
+    loop.run_until_complete(b.update())
+    settle(loop)
+    assert search.index.search('alpha') == []
+    assert [k for k, s in search.index.search('beta')] == ['blog:%s' % b.id]
+
+def test_query_scores_in_a_thread(loop, db, monkeypatch):
+    for i in range(5):
+        blog(loop, 'post %s' % i, 'shared words ' + 'rare ' * i)
+    settle(loop)
+    threads = []
+    score = search.SearchIndex._score
+    def recording(self, *args):
+        threads.append(threading.get_ident())
+        return score(self, *args)
+    monkeypatch.setattr(search.SearchIndex, '_score', recording)
+    expected = search.index.search('shared rare')
+    threads.clear()
+    assert loop.run_until_complete(search.index.query('shared rare')) == expected
+    assert len(expected) == 4
+    assert threads and threading.get_ident() not in threads
+    assert search.index.readers == 0
+
+def test_catch_up_scan_reads_chunks_from_the_watermark(loop, db, monkeypatch):
+    monkeypatch.setattr(configs.search, 'chunk', 2)
+    old = Blog(user_id='u', user_name='n', user_image='i', name='old', summary='', content='x', created_at=100.0)
+    loop.run_until_complete(old.save())
+    for i in range(3):
+        loop.run_until_complete(Blog(user_id='u', user_name='n', user_image='i', name='tie %s' % i, summary='', content='x', created_at=200.0).save())
+    settle(loop)
+    target = search.Delta()
+    # 和水位线同一时刻的行也要补上
+    assert loop.run_until_complete(search.index_rows(target, 200.0)) == 3
+    assert 'blog:%s' % old.id not in target.docs
+    assert loop.run_until_complete(search.index_rows(search.Delta())) == 4
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = 'Hongqing Wang'
+
+import pytest
+
+import orm, idgen, sqlitepool, migrate_ids
+from orm import Model, StringField
+from models import User, Blog, Comment
+
+@pytest.fixture
+def shards(db):
+    pools = []
+    for name in ('s0', 's1'):
+        p = sqlitepool.create_pool()
+        p.create_tables((User, Comment))
+        orm.set_shard_pool(name, p)
+        pools.append(p)
+    orm.set_shard_tables({'users': ['s0', 's1'], 'comments': ['s0', 's1']})
+    yield pools
+    for p in pools:
+        p.close()
+
+def rows(pool, table):
+    return [r[0] for r in pool._db.execute('select `id` from `%s`' % table)]
+
+def test_unknown_shard_key_raises_value_error():
+    with pytest.raises(ValueError):
+        class Bad(Model):
+            __table__ = 'bad'
+            __shard_key__ = 'nosuch'
+            id = StringField(primary_key=True, ddl='varchar(50)')
+
+def test_rows_are_placed_and_gathered_across_shards(loop, shards):
+    async def go():
+        blog = Blog(user_id='u', user_name='a', user_image='i', name='b', summary='s', content='c')
+        await blog.save()
+        users = []
+        for n in range(6):
+            u = User(name='u%s' % n, email='u%s@b.com' % n, passwd='x', image='i', created_at=float(n))
+            await u.save()
+            users.append(u)
+            await Comment(blog_id='blog%s' % (n % 3), user_id=u.id, user_name=u.name, user_image='i', content='c', created_at=float(n)).save()
+        return users
+    users = loop.run_until_complete(go())
+    for u in users:
+        assert u.id in rows(shards[orm.shard_index(u.id, 2)], 'users')
+    assert len(rows(shards[0], 'users')) + len(rows(shards[1], 'users')) == 6
+    # 分片键不确定时查询所有分片，合并排序后再截取
+    found = loop.run_until_complete(User.findAll(orderBy='created_at desc', limit=(1, 3)))
+    assert [u.name for u in found] == ['u4', 'u3', 'u2']
+    assert loop.run_until_complete(User.findNumber('id')) == 6
+    assert loop.run_until_complete(User.find(users[2].id)).name == 'u2'
+    # where以分片键开头时只查一个分片
+    assert len(loop.run_until_complete(Comment.findAll('blog_id=?', ['blog1']))) == 2
+
+def test_migrate_ids_rewrites_and_moves_rows_on_every_shard(loop, shards):
+    async def go():
+        blogs = []
+        for n in range(4):
+            u = User(name='u%s' % n, email='u%s@b.com' % n, passwd='x', image='i', created_at=1.5e9 + n)
+            await u.save()
+            b = Blog(user_id=u.id, user_name=u.name, user_image='i', name='b%s' % n, summary='s', content='c', created_at=1.5e9 + n)
+            await b.save()
+            blogs.append(b)
+            for k in range(2):
+                await Comment(blog_id=b.id, user_id=u.id, user_name=u.name, user_image='i', content='c%s' % k, created_at=1.5e9 + n + k).save()
+        mappings = await migrate_ids.run(idgen.get_generator())
+        return mappings
+    mappings = loop.run_until_complete(go())
+    users, blogs = mappings['users'], mappings['blogs']
+    assert len(users) == 4 and len(blogs) == 4 and len(mappings['comments']) == 8
+    # 每一行都在新分片键所在的分片上，引用列指向新的id
+    for p in shards:
+        for uid, in p._db.execute('select `id` from `users`'):
+            assert p is shards[orm.shard_index(uid, 2)]
+        for blog_id, user_id in p._db.execute('select `blog_id`, `user_id` from `comments`'):
+            assert p is shards[orm.shard_index(blog_id, 2)]
+            assert blog_id in set(str(v) for v in blogs.values())
+            assert user_id in set(str(v) for v in users.values())
+    total = sum(len(rows(p, 'comments')) for p in shards)
+    assert total == 8
+    async def check():
+        for b in (await Blog.findAll()):
+            assert b.user_id in set(str(v) for v in users.values())
+            assert (await Comment.findNumber('id', 'blog_id=?', [b.id])) == 2
+    loop.run_until_complete(check())